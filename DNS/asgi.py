@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'DNS.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up, since it loads the DNS handler and models.
+from doh.asgi import DoHApplication  # noqa: E402
+
+# Wire-format DoH queries skip Django's middleware; the rest goes to Django.
+application = DoHApplication(django_application)
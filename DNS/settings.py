@@ -115,13 +115,63 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# DNS server
+
+# Upstream recursive resolvers, as "address" or "address:port"
+# ("[address]:port" for IPv6).
+DNS_UPSTREAM_NAMESERVERS = ["8.8.8.8", "1.1.1.1"]
+DNS_UPSTREAM_TIMEOUT = 3
+DNS_UPSTREAM_LIFETIME = 5
+DNS_CACHE_MAX_ENTRIES = 100_000
+DNS_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DNS_CACHE_SWEEP_INTERVAL = 1.0
+# Where the DNS server saves its cache every DNS_CACHE_SNAPSHOT_INTERVAL
+# seconds and on shutdown, to start warm after a restart; None disables it.
+# Under --workers, each worker writes its own file: {worker} in the path
+# is replaced by the worker's index, which is otherwise appended.
+DNS_CACHE_SNAPSHOT_PATH = None
+DNS_CACHE_SNAPSHOT_INTERVAL = 60
+DNS_NEGATIVE_CACHE_MAX_ENTRIES = 20_000
+DNS_NEGATIVE_CACHE_MAX_BYTES = 8 * 1024 * 1024
+DNS_NEGATIVE_CACHE_MAX_TTL = 3600
+DNS_INVALIDATION_POLL_INTERVAL = 0.05
+DNS_SERVE_STALE_WINDOW = 3600
+DNS_SERVE_STALE_TTL = 30
+DNS_SERVE_STALE_CLIENT_TIMEOUT = 1.8
+DNS_PREFETCH_MIN_HITS = 5
+DNS_PREFETCH_THRESHOLD = 0.1
+DNS_AUTHORITATIVE_ZONES = []
+DNS_LOCAL_NEGATIVE_TTL = 300
+DNS_MAX_CNAME_CHAIN = 8
+# Per-process Prometheus listener of the DNS server; 0 disables it. Worker N
+# of a --workers pool listens on DNS_METRICS_PORT + N.
+DNS_METRICS_PORT = 9153
+DNS_TCP_IDLE_TIMEOUT = 10
+# UDP datagrams read or written per recvmmsg/sendmmsg call (Linux); 0 uses
+# one system call per datagram.
+DNS_UDP_BATCH_SIZE = 0
+DNS_TCP_MAX_CONNECTIONS = 1024
+# DNS over TLS listener (853 is the standard port); 0 disables it.
+DNS_TLS_PORT = 0
+DNS_TLS_CERTFILE = None
+DNS_TLS_KEYFILE = None
+# NDJSON log of answered queries, rotated by size; None disables it. Use
+# {pid} in the path when running --workers, so each process has its own file.
+DNS_QUERY_LOG_PATH = None
+DNS_QUERY_LOG_SAMPLE_RATE = 1.0
+DNS_QUERY_LOG_MAX_BYTES = 100 * 1024 * 1024
+DNS_QUERY_LOG_BACKUP_COUNT = 5
+# Largest number of questions in one batch POST to the DoH JSON API.
+DNS_DOH_MAX_BATCH_SIZE = 100
+
 
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
     "handlers": {
         "console": {
-            "class": "logging.StreamHandler",
+            # Writes to stderr from a background thread, off the query path.
+            "class": "dnsserver.logs.BackgroundHandler",
         },
     },
     "root": {
@@ -0,0 +1,27 @@
+"""
+Settings for the DNS server process (dnsserver/server.py).
+
+The same as DNS.settings, minus the web stack: the server only uses the
+ORM to read the records app, so the admin, auth, sessions, messages,
+static files, templates and middleware are never loaded, which cuts the
+startup time and memory of every worker. The DoH views and the records
+API keep running under DNS.settings (DNS/asgi.py, DNS/wsgi.py).
+"""
+
+from DNS.settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'records',
+]
+
+MIDDLEWARE = []
+
+TEMPLATES = []
+
+AUTH_PASSWORD_VALIDATORS = []
+
+USE_I18N = False
+
+# Nothing here renders debug pages, and with DEBUG on the ORM would keep a
+# log of its last queries in every worker.
+DEBUG = False
@@ -7,4 +7,6 @@ urlpatterns = [
     path("", include("records.urls")),
 
     path("", include("doh.urls")),
+
+    path("", include("dnsserver.urls")),
 ]
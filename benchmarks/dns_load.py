@@ -0,0 +1,462 @@
+"""
+End-to-end load generator for the DNS server.
+
+Replays a query corpus (JSONL, one {"name": ..., "type": ...} object per
+line) or synthetic Zipf-distributed names against the UDP, TCP and DoH
+endpoints. With ``--rate`` queries are sent open-loop on a fixed schedule
+and latency is measured from the scheduled send time, so a stalled server
+shows up in the percentiles instead of just slowing the generator down;
+without it ``--concurrency`` queries are kept in flight.
+
+Cache hit ratio and resident memory come from the server's /metrics
+endpoint. ``--output`` saves the run as JSON and ``--compare`` prints the
+change against an earlier one. To run fully offline, point the server at
+the stub upstream:
+
+    python -m dnsserver.stub --port 5300 --fixture benchmarks/fixtures/stub.json &
+    python dnsserver/server.py --port 8053 --upstream 127.0.0.1:5300 &
+    python -m benchmarks.dns_load --transport udp --transport tcp \\
+        --zipf 10000 --rate 5000 --queries 50000 --output run.json
+
+DoH is sent to ``--doh-url`` over HTTP/1.1 keep-alive connections, so it
+needs the ASGI application running under an ASGI server.
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import resource
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit
+
+import dns.message
+import dns.rcode
+
+from benchmarks.udp_load import percentile
+
+TRANSPORTS = ("udp", "tcp", "doh")
+
+
+class QueryError(Exception):
+    pass
+
+
+def load_corpus(path, default_type):
+    queries = []
+    with open(path) as corpus:
+        for line in corpus:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            name = item.get("name") or item.get("domain")
+            record_type = item.get("type") or item.get("record_type") or default_type
+            queries.append((name, record_type.upper()))
+    if not queries:
+        raise SystemExit(f"{path}: no queries")
+    return queries
+
+
+def zipf_names(count, exponent, suffix):
+    """
+    ``count`` names and their cumulative weights: name k is asked for with
+    probability proportional to 1 / k**exponent, the popularity curve of
+    real resolver traffic.
+    """
+
+    names = [f"n{rank}.{suffix}" for rank in range(1, count + 1)]
+    weights = [1 / rank ** exponent for rank in range(1, count + 1)]
+    return names, list(itertools.accumulate(weights))
+
+
+def make_workload(args):
+    rng = random.Random(args.seed)
+    if args.corpus:
+        corpus = load_corpus(args.corpus, args.type)
+        picked = (corpus[i % len(corpus)] for i in range(args.queries))
+    else:
+        names, cum_weights = zipf_names(args.zipf, args.zipf_exponent, args.suffix)
+        picked = (
+            (name, args.type)
+            for name in rng.choices(names, cum_weights=cum_weights, k=args.queries)
+        )
+
+    # Queries are encoded up front (ID 0) so encoding is not measured.
+    wires = {}
+    workload = []
+    for name, record_type in picked:
+        key = (name, record_type)
+        if key not in wires:
+            query = dns.message.make_query(name, record_type)
+            query.id = 0
+            wires[key] = query.to_wire()
+        workload.append(wires[key])
+    return workload
+
+
+class QueryIds:
+
+    def __init__(self):
+        self.ids = itertools.cycle(range(1, 65536))
+        self.pending = {}
+
+    def register(self, future):
+        query_id = next(self.ids)
+        while query_id in self.pending:
+            query_id = next(self.ids)
+        self.pending[query_id] = future
+        return query_id
+
+    def resolve(self, response):
+        future = self.pending.pop(int.from_bytes(response[:2], "big"), None)
+        if future is not None and not future.done():
+            future.set_result(response)
+
+
+class UDPClient(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.ids = QueryIds()
+        self.transport = None
+
+    @classmethod
+    async def connect(cls, args):
+        loop = asyncio.get_running_loop()
+        _, client = await loop.create_datagram_endpoint(
+            cls, remote_addr=(args.host, args.port)
+        )
+        return client
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.ids.resolve(data)
+
+    async def query(self, wire):
+        future = asyncio.get_running_loop().create_future()
+        query_id = self.ids.register(future)
+        try:
+            self.transport.sendto(query_id.to_bytes(2, "big") + wire[2:])
+            return await future
+        finally:
+            self.ids.pending.pop(query_id, None)
+
+    async def close(self):
+        self.transport.close()
+
+
+class TCPClient:
+    """Pipelines queries over ``--connections`` connections, matched by ID."""
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.next_connection = itertools.cycle(range(len(connections)))
+
+    @classmethod
+    async def connect(cls, args):
+        connections = []
+        for _ in range(args.connections):
+            reader, writer = await asyncio.open_connection(args.host, args.port)
+            ids = QueryIds()
+            reading = asyncio.create_task(cls.read_responses(reader, ids))
+            connections.append((writer, ids, reading))
+        return cls(connections)
+
+    @staticmethod
+    async def read_responses(reader, ids):
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), "big")
+                ids.resolve(await reader.readexactly(length))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            for future in ids.pending.values():
+                if not future.done():
+                    future.set_exception(QueryError("connection closed"))
+
+    async def query(self, wire):
+        writer, ids, _ = self.connections[next(self.next_connection)]
+        future = asyncio.get_running_loop().create_future()
+        query_id = ids.register(future)
+        try:
+            writer.write(len(wire).to_bytes(2, "big") + query_id.to_bytes(2, "big") + wire[2:])
+            return await future
+        finally:
+            ids.pending.pop(query_id, None)
+
+    async def close(self):
+        for writer, _, reading in self.connections:
+            writer.close()
+            reading.cancel()
+
+
+class DoHClient:
+    """RFC 8484 POSTs over a pool of HTTP/1.1 keep-alive connections."""
+
+    def __init__(self, url, size):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = parts.scheme == "https"
+        self.path = parts.path or "/dns-query"
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+
+    @classmethod
+    async def connect(cls, args):
+        return cls(args.doh_url, args.connections)
+
+    async def query(self, wire):
+        async with self.slots:
+            if self.idle:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+            try:
+                writer.write(
+                    f"POST {self.path} HTTP/1.1\r\n"
+                    f"Host: {self.host}\r\n"
+                    "Content-Type: application/dns-message\r\n"
+                    "Accept: application/dns-message\r\n"
+                    f"Content-Length: {len(wire)}\r\n\r\n".encode() + wire
+                )
+                head = await reader.readuntil(b"\r\n\r\n")
+                status = int(head.split(b" ", 2)[1])
+                headers = dict(
+                    (name.strip().lower(), value.strip().lower())
+                    for name, _, value in (
+                        line.partition(b":") for line in head.split(b"\r\n")[1:]
+                    )
+                )
+                body = await reader.readexactly(int(headers.get(b"content-length", 0)))
+            except BaseException:
+                writer.close()
+                raise
+
+            if headers.get(b"connection") == b"close":
+                writer.close()
+            else:
+                self.idle.append((reader, writer))
+
+        if status != 200:
+            raise QueryError(f"HTTP {status}")
+        return body
+
+    async def close(self):
+        for _, writer in self.idle:
+            writer.close()
+
+
+CLIENTS = {"udp": UDPClient, "tcp": TCPClient, "doh": DoHClient}
+
+
+async def run_load(client, workload, rate, concurrency, timeout):
+    latencies = []
+    rcodes = collections.Counter()
+    errors = collections.Counter()
+    in_flight = asyncio.Semaphore(concurrency)
+
+    async def send(wire, scheduled):
+        try:
+            response = await asyncio.wait_for(client.query(wire), timeout)
+        except asyncio.TimeoutError:
+            errors["timeout"] += 1
+            return
+        except (QueryError, OSError, ValueError, asyncio.IncompleteReadError) as exc:
+            errors[type(exc).__name__] += 1
+            return
+        latencies.append(time.perf_counter() - scheduled)
+        rcodes[dns.rcode.to_text(response[3] & 0x0F)] += 1
+
+    async def limited(wire, scheduled):
+        try:
+            await send(wire, scheduled)
+        finally:
+            in_flight.release()
+
+    started = time.perf_counter()
+    tasks = []
+    for i, wire in enumerate(workload):
+        if rate:
+            scheduled = started + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await in_flight.acquire()
+        if not rate:
+            scheduled = time.perf_counter()
+        tasks.append(asyncio.create_task(limited(wire, scheduled)))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "queries": len(workload),
+        "answered": len(latencies),
+        "errors": dict(errors),
+        "elapsed_s": round(elapsed, 3),
+        "qps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            **{
+                f"p{str(pct).replace('.', '')}": round(percentile(latencies, pct) * 1000, 3)
+                for pct in (50, 90, 99, 99.9)
+            },
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        "rcodes": dict(rcodes),
+    }
+
+
+def scrape(url):
+    """Sum the samples of each metric on a Prometheus text page."""
+
+    if not url:
+        return None
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            text = response.read().decode()
+    except (urllib.error.URLError, OSError):
+        return None
+
+    totals = collections.Counter()
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        sample, _, value = line.rpartition(" ")
+        totals[sample.split("{", 1)[0]] += float(value)
+    return totals
+
+
+def server_stats(before, after):
+    if before is None or after is None:
+        return {}
+
+    queries = after["dns_queries_total"] - before["dns_queries_total"]
+    hits = after["dns_cache_hits_total"] - before["dns_cache_hits_total"]
+    return {
+        "server_queries": int(queries),
+        "cache_hit_ratio": round(hits / queries, 4) if queries else None,
+        "server_rss_bytes": int(after["process_resident_memory_bytes"]),
+    }
+
+
+async def run_transport(transport, workload, args):
+    client = await CLIENTS[transport].connect(args)
+    try:
+        before = await asyncio.to_thread(scrape, args.metrics_url)
+        result = await run_load(client, workload, args.rate, args.concurrency, args.timeout)
+        after = await asyncio.to_thread(scrape, args.metrics_url)
+    finally:
+        await client.close()
+    return {"transport": transport, **result, **server_stats(before, after)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(result):
+    latency = result["latency_ms"]
+    errors = sum(result["errors"].values())
+    line = (
+        f"{result['transport']:<4} {result['answered']}/{result['queries']} answered "
+        f"({errors} errors) in {result['elapsed_s']:.2f}s  QPS {result['qps']:.0f}  "
+        f"p50 {latency['p50']:.2f} ms  p99 {latency['p99']:.2f} ms  "
+        f"p99.9 {latency['p999']:.2f} ms"
+    )
+    if result.get("cache_hit_ratio") is not None:
+        line += f"  hit ratio {result['cache_hit_ratio']:.1%}"
+    if result.get("server_rss_bytes"):
+        line += f"  server RSS {result['server_rss_bytes'] / 2**20:.1f} MiB"
+    print(line)
+
+
+def compare(results, path):
+    with open(path) as baseline_file:
+        baseline = {r["transport"]: r for r in json.load(baseline_file)["results"]}
+
+    for result in results:
+        old = baseline.get(result["transport"])
+        if old is None:
+            continue
+        changes = [
+            ("QPS", old["qps"], result["qps"]),
+            ("p50", old["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+            ("p99", old["latency_ms"]["p99"], result["latency_ms"]["p99"]),
+        ]
+        print(f"{result['transport']:<4} vs {path}: " + "  ".join(
+            f"{label} {(new - before) / before:+.1%}" if before else f"{label} n/a"
+            for label, before, new in changes
+        ))
+
+
+async def run(args, workload):
+    results = []
+    for transport in args.transports:
+        results.append(await run_transport(transport, workload, args))
+        report(results[-1])
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DNS end-to-end load generator.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8053)
+    parser.add_argument("--doh-url", default="http://127.0.0.1:8000/dns-query")
+    parser.add_argument("--metrics-url", default="http://127.0.0.1:9153/metrics",
+                        help="server /metrics for hit ratio and memory ('' to skip)")
+    parser.add_argument("--transport", action="append", dest="transports", choices=TRANSPORTS,
+                        help="repeatable; defaults to udp")
+    parser.add_argument("--corpus", help="JSONL query corpus to replay in order")
+    parser.add_argument("--zipf", type=int, default=10000,
+                        help="number of distinct synthetic names (without --corpus)")
+    parser.add_argument("--zipf-exponent", type=float, default=1.0)
+    parser.add_argument("--suffix", default="bench.example")
+    parser.add_argument("--type", default="A")
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=0,
+                        help="target queries per second (0: as fast as --concurrency allows)")
+    parser.add_argument("--concurrency", type=int, default=256, help="max queries in flight")
+    parser.add_argument("--connections", type=int, default=8, help="TCP/DoH connections")
+    parser.add_argument("--timeout", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="earlier --output file to compare against")
+    args = parser.parse_args(argv)
+    args.transports = args.transports or ["udp"]
+
+    workload = make_workload(args)
+    results = asyncio.run(run(args, workload))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "commit": git_commit(),
+                "timestamp": time.time(),
+                "config": vars(args),
+                "client_max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                "results": results,
+            }, output, indent=2)
+            output.write("\n")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
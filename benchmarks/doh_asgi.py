@@ -0,0 +1,112 @@
+"""
+Requests-per-second benchmark for the DoH ASGI fast path.
+
+Drives the ASGI applications in-process (no HTTP server or socket in the
+way), with the answer already cached, so the numbers isolate per-request
+framework overhead: the full Django stack (middleware, HttpRequest, view)
+against doh.asgi.DoHApplication:
+
+    python -m benchmarks.doh_asgi --requests 5000
+"""
+
+import argparse
+import asyncio
+import base64
+import logging
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "DNS.settings")
+
+import dns.message  # noqa: E402
+
+from DNS.asgi import application, django_application  # noqa: E402
+from dnsserver.cache import set_cache  # noqa: E402
+
+NAME = "bench.example.com"
+
+
+def make_scope(method, query_string=b"", content_type=None):
+    headers = [(b"host", b"localhost"), (b"accept", b"application/dns-message")]
+    if content_type:
+        headers.append((b"content-type", content_type))
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": "/dns-query",
+        "raw_path": b"/dns-query",
+        "query_string": query_string,
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 80),
+    }
+
+
+async def call(app, scope, body):
+    sent = []
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # Django keeps listening for a disconnect until the response is sent.
+        await asyncio.Future()
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    status = sent[0]["status"]
+    if status != 200:
+        raise AssertionError(f"unexpected status {status}: {sent[-1].get('body')}")
+    return b"".join(m.get("body", b"") for m in sent[1:])
+
+
+async def measure(app, scope, body, requests):
+    await call(app, scope, body)
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        await call(app, scope, body)
+    return requests / (time.perf_counter() - started)
+
+
+async def run(requests):
+    query = dns.message.make_query(NAME, "A")
+    query.id = 0
+    wire = query.to_wire()
+    encoded = base64.urlsafe_b64encode(wire).rstrip(b"=")
+
+    cases = {
+        "GET ?dns=": (make_scope("GET", b"dns=" + encoded), b""),
+        "POST wire": (make_scope("POST", content_type=b"application/dns-message"), wire),
+    }
+
+    for label, (scope, body) in cases.items():
+        django_rps = await measure(django_application, scope, body, requests)
+        fast_rps = await measure(application, scope, body, requests)
+        print(
+            f"{label:<10} django {django_rps:8.0f} req/s  "
+            f"fast path {fast_rps:8.0f} req/s  "
+            f"speedup {fast_rps / django_rps:4.1f}x"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DoH ASGI fast path benchmark.")
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    # Per-query INFO logging would dominate both sides of the comparison.
+    logging.disable(logging.INFO)
+    set_cache(NAME, "A", [{"name": NAME, "type": 1, "TTL": 3600, "data": "192.0.2.1"}])
+
+    asyncio.run(run(args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Microbenchmark for cache-hit response rendering.
+
+Compares build_dns_response (text rrset parsing on every hit) with
+rendering a cached ResponseTemplate, after checking that both produce
+byte-identical responses:
+
+    python -m benchmarks.response_build
+"""
+
+import argparse
+import timeit
+
+import dns.flags
+import dns.message
+
+from dnsserver.response_builder import (
+    build_dns_response,
+    build_response_template,
+    render_template,
+    template_key,
+)
+
+ANSWERS = {
+    "A": [
+        {"name": "bench.example.com", "type": 1, "TTL": 300, "data": f"192.0.2.{i}"}
+        for i in range(1, 5)
+    ],
+    "MX": [
+        {"name": "bench.example.com", "type": 15, "TTL": 3600, "data": "10 mail.example.com"},
+        {"name": "bench.example.com", "type": 15, "TTL": 60, "data": "20 backup.example.net"},
+    ],
+    "TXT": [
+        {"name": "bench.example.com", "type": 16, "TTL": 120, "data": "v=spf1 -all"},
+    ],
+}
+
+
+def with_elapsed(answers, elapsed):
+    return [dict(ans, TTL=max(ans["TTL"] - elapsed, 0)) for ans in answers]
+
+
+def make_request(qname, record_type, edns, rd):
+    request = dns.message.make_query(qname, record_type, use_edns=0 if edns else None)
+    if not rd:
+        request.flags &= ~dns.flags.RD
+    return request
+
+
+def check_identical():
+    checked = 0
+    for record_type, answers in ANSWERS.items():
+        for edns in (False, True):
+            seed = make_request("bench.example.com", record_type, edns, rd=True)
+            template = build_response_template(seed, answers)
+
+            for qname in ("bench.example.com", "BeNcH.Example.COM"):
+                for rd in (True, False):
+                    for elapsed in (0, 1, 59, 500):
+                        request = make_request(qname, record_type, edns, rd)
+                        assert template_key(request) == template_key(seed)
+
+                        expected = build_dns_response(request, with_elapsed(answers, elapsed))
+                        actual = render_template(template, request, elapsed)
+                        if actual != expected:
+                            raise AssertionError(
+                                f"{record_type} {qname} edns={edns} rd={rd} "
+                                f"elapsed={elapsed}: template output differs"
+                            )
+                        checked += 1
+    return checked
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cache-hit rendering microbenchmark.")
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    print(f"byte-identical: {check_identical()} request variants checked")
+
+    for record_type, answers in ANSWERS.items():
+        request = make_request("bench.example.com", record_type, edns=True, rd=True)
+        template = build_response_template(request, answers)
+
+        build = timeit.timeit(
+            lambda: build_dns_response(request, answers), number=args.number
+        )
+        render = timeit.timeit(
+            lambda: render_template(template, request, 7), number=args.number
+        )
+
+        print(
+            f"{record_type:<4} {len(answers)} answers: "
+            f"build {build / args.number * 1e6:8.2f} us  "
+            f"template {render / args.number * 1e6:6.2f} us  "
+            f"speedup {build / render:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Cold start time and memory of the DNS server process.
+
+Starts ``dnsserver/server.py`` repeatedly under each settings module and
+reports how long it takes until it answers its first query, and its
+resident memory at that point:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --settings DNS.settings --settings DNS.settings_dns
+
+Readiness is probed with an EDNS version 1 query, which the server answers
+with BADVERS without a lookup, so no upstream is needed. Each ``--workers``
+process pays the import and setup cost again, and its memory is what
+remains after fork, so the per-process numbers are what matter.
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import dns.message
+
+from benchmarks.udp_load import percentile
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dnsserver", "server.py")
+SETTINGS = ("DNS.settings", "DNS.settings_dns")
+
+
+def probe() -> bytes:
+    return dns.message.make_query("startup.invalid", "A", use_edns=1).to_wire()
+
+
+def resident_memory(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def start_once(settings_module, port, timeout):
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.01)
+    query = probe()
+
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, SERVER, "--port", str(port), "--metrics-port", "0",
+         "--upstream", "127.0.0.1:9"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            sock.sendto(query, ("127.0.0.1", port))
+            try:
+                sock.recv(512)
+            except (socket.timeout, ConnectionRefusedError):
+                if server.poll() is not None:
+                    raise RuntimeError(f"server exited with {server.returncode}")
+                continue
+            return time.perf_counter() - started, resident_memory(server.pid)
+        raise RuntimeError("server did not answer in time")
+    finally:
+        server.terminate()
+        server.wait()
+        sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DNS server cold start benchmark.")
+    parser.add_argument("--settings", action="append", help="settings module (repeatable)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8353)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args(argv)
+
+    for settings_module in args.settings or SETTINGS:
+        times, memory = [], []
+        for _ in range(args.runs):
+            elapsed, rss = start_once(settings_module, args.port, args.timeout)
+            times.append(elapsed)
+            memory.append(rss)
+
+        print(
+            f"{settings_module:<20} ready in {statistics.median(times) * 1000:6.0f} ms "
+            f"(p90 {percentile(times, 90) * 1000:.0f} ms)  "
+            f"RSS {statistics.median(memory) / 2**20:.1f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Packets-per-second benchmark for the UDP I/O layer alone.
+
+A responder process answers every query with a fixed, pre-built response
+(only the ID is copied over), so the numbers are dominated by system calls
+and buffer handling rather than by query processing. It runs once per I/O
+mode:
+
+    plain    recvfrom() + sendto() per datagram (a new bytes object per read)
+    pooled   recvfrom_into() a reusable buffer pool + sendto() per datagram
+    mmsg     recvmmsg() + sendmmsg(), a whole batch per system call
+
+    python -m benchmarks.udp_batch --seconds 5 --batch 32
+
+The client keeps ``--window`` queries in flight, sent and received with
+the batched calls, so the same client drives every mode. For the whole
+server, compare ``dnsserver/server.py --udp-batch 32`` with ``--udp-batch 0``
+under benchmarks/dns_load.py instead.
+"""
+
+import argparse
+import multiprocessing
+import socket
+import time
+
+import dns.message
+import dns.rrset
+
+from dnsserver.udpbatch import MMSG_AVAILABLE, UDP_BATCH_SIZE, DatagramBatcher
+
+MODES = ("plain", "pooled", "mmsg")
+
+
+def fixed_response() -> bytes:
+    query = dns.message.make_query("bench.example.com", "A")
+    response = dns.message.make_response(query)
+    response.answer.append(dns.rrset.from_text("bench.example.com.", 300, "IN", "A", "192.0.2.1"))
+    return response.to_wire()
+
+
+def respond(mode, port, batch_size, ready):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", port))
+    tail = fixed_response()[2:]
+    ready.set()
+
+    if mode == "plain":
+        while True:
+            data, addr = sock.recvfrom(4096)
+            sock.sendto(data[:2] + tail, addr)
+
+    batcher = DatagramBatcher(sock, batch_size, use_mmsg=mode == "mmsg")
+    while True:
+        batcher.send([(bytes(view[:2]) + tail, addr) for view, addr in batcher.recv()])
+
+
+def drive(port, seconds, window, batch_size):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.settimeout(0.2)
+    batcher = DatagramBatcher(sock, batch_size)
+    query = dns.message.make_query("bench.example.com", "A").to_wire()
+    server = ("127.0.0.1", port)
+
+    answered = lost = 0
+    deadline = time.perf_counter() + seconds
+    started = time.perf_counter()
+    while time.perf_counter() < deadline:
+        batcher.send([(query, server)] * window)
+        waiting = window
+        try:
+            while waiting:
+                waiting -= len(batcher.recv())
+        except socket.timeout:
+            lost += waiting
+        answered += window - waiting
+
+    elapsed = time.perf_counter() - started
+    return answered / elapsed, lost
+
+
+def run_mode(mode, port, seconds, window, batch_size):
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=respond, args=(mode, port, batch_size, ready), daemon=True
+    )
+    server.start()
+    ready.wait()
+    try:
+        return drive(port, seconds, window, batch_size)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UDP I/O packets-per-second benchmark.")
+    parser.add_argument("--port", type=int, default=8153)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--window", type=int, default=64, help="queries in flight")
+    parser.add_argument("--batch", type=int, default=UDP_BATCH_SIZE)
+    parser.add_argument("--mode", action="append", choices=MODES, dest="modes")
+    args = parser.parse_args(argv)
+
+    modes = args.modes or [m for m in MODES if m != "mmsg" or MMSG_AVAILABLE]
+    baseline = None
+    for mode in modes:
+        pps, lost = run_mode(mode, args.port, args.seconds, args.window, args.batch)
+        baseline = baseline or pps
+        print(f"{mode:>7}: {pps:10.0f} pps  ({pps / baseline:.2f}x, {lost} lost)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+UDP load benchmark for the DNS server.
+
+Keeps ``--concurrency`` queries in flight against a running server and
+reports throughput and latency percentiles. Compare the two engines with:
+
+    python dnsserver/server.py --engine threaded --port 8053
+    python -m benchmarks.udp_load --port 8053
+
+    python dnsserver/server.py --engine asyncio --port 8054
+    python -m benchmarks.udp_load --port 8054
+
+Use names that are local records (or already cached) so the upstream
+resolver does not dominate the numbers.
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import statistics
+import time
+
+import dns.message
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class LoadClientProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query_id = int.from_bytes(data[:2], "big")
+        future = self.pending.pop(query_id, None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+
+async def run_load(host, port, names, record_type, total, concurrency, timeout):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        LoadClientProtocol,
+        remote_addr=(host, port),
+    )
+
+    wires = [
+        dns.message.make_query(name, record_type).to_wire()
+        for name in names
+    ]
+    ids = itertools.cycle(range(1, 65536))
+    counter = itertools.count()
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while next(counter) < total:
+            query_id = next(ids)
+            wire = query_id.to_bytes(2, "big") + random.choice(wires)[2:]
+            future = loop.create_future()
+            protocol.pending[query_id] = future
+
+            started = time.perf_counter()
+            transport.sendto(wire)
+            try:
+                await asyncio.wait_for(future, timeout)
+                latencies.append(time.perf_counter() - started)
+            except asyncio.TimeoutError:
+                protocol.pending.pop(query_id, None)
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    transport.close()
+
+    return {
+        "queries": total,
+        "answered": len(latencies),
+        "errors": errors,
+        "elapsed": elapsed,
+        "qps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DNS UDP load benchmark.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8053)
+    parser.add_argument("--name", action="append", dest="names")
+    parser.add_argument("--type", default="A")
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run_load(
+        args.host,
+        args.port,
+        args.names or ["example.com"],
+        args.type,
+        args.queries,
+        args.concurrency,
+        args.timeout,
+    ))
+
+    print(
+        f"{result['answered']}/{result['queries']} answered "
+        f"({result['errors']} timeouts) in {result['elapsed']:.2f}s"
+    )
+    print(
+        f"QPS: {result['qps']:.0f}  p50: {result['p50_ms']:.2f} ms  "
+        f"p99: {result['p99_ms']:.2f} ms  mean: {result['mean_ms']:.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,395 @@
+import heapq
+import threading
 import time
-from typing import List, Dict, Tuple
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Optional
 
-DNS_CACHE: Dict[Tuple[str, str], Dict] = {}
+from django.conf import settings
 
+from dnsserver.response_builder import DNS_TYPE_MAP
+from dnsserver.threads import ensure_thread
 
-def get_from_cache(domain: str, record_type: str):
+CACHE_MAX_ENTRIES = getattr(settings, "DNS_CACHE_MAX_ENTRIES", 100_000)
+CACHE_MAX_BYTES = getattr(settings, "DNS_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+CACHE_SWEEP_INTERVAL = getattr(settings, "DNS_CACHE_SWEEP_INTERVAL", 1.0)
+
+NEGATIVE_CACHE_MAX_ENTRIES = getattr(settings, "DNS_NEGATIVE_CACHE_MAX_ENTRIES", 20_000)
+NEGATIVE_CACHE_MAX_BYTES = getattr(settings, "DNS_NEGATIVE_CACHE_MAX_BYTES", 8 * 1024 * 1024)
+NEGATIVE_CACHE_MAX_TTL = getattr(settings, "DNS_NEGATIVE_CACHE_MAX_TTL", 3600)
+
+# RFC 8767: keep expired answers this long, to be served if upstream fails.
+SERVE_STALE_WINDOW = getattr(settings, "DNS_SERVE_STALE_WINDOW", 3600)
+SERVE_STALE_TTL = getattr(settings, "DNS_SERVE_STALE_TTL", 30)
+
+# Refresh-ahead: an entry hit at least PREFETCH_MIN_HITS times is refreshed
+# in the background once less than PREFETCH_THRESHOLD of its TTL remains.
+PREFETCH_MIN_HITS = getattr(settings, "DNS_PREFETCH_MIN_HITS", 5)
+PREFETCH_THRESHOLD = getattr(settings, "DNS_PREFETCH_THRESHOLD", 0.1)
+
+# Rough per-object costs (including an answer's share of the wire templates
+# rendered on hits), so the byte cap tracks real memory use without calling
+# sys.getsizeof on every insert.
+ENTRY_OVERHEAD = 400
+ANSWER_OVERHEAD = 350
+
+
+def estimate_size(key: Tuple[str, str], answers: List[dict], authority=()) -> int:
+    size = ENTRY_OVERHEAD + len(key[0]) + len(key[1])
+    for ans in (*answers, *authority):
+        size += ANSWER_OVERHEAD + len(ans["name"]) + len(str(ans["data"]))
+    return size
+
+
+class DNSCache:
+    """
+    Thread-safe LRU cache with TTL expiry.
+
+    Entries are evicted least-recently-used first once either ``max_entries``
+    or ``max_bytes`` is exceeded. Expired entries stop being returned by
+    get() but are kept for another ``stale_window`` seconds for get_stale().
+    Discard times are kept in a min-heap that a background thread drains
+    every ``sweep_interval`` seconds, so old names are dropped even if
+    nobody asks for them again.
+
+    Entries loaded from a snapshot (dnsserver/snapshot.py) are attached
+    undecoded and only moved into the cache when first looked up.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES,
+        sweep_interval: float = CACHE_SWEEP_INTERVAL,
+        stale_window: float = SERVE_STALE_WINDOW,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.stale_window = stale_window
+
+        self._entries: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self._expiry: List[Tuple[float, Tuple[str, str]]] = []
+        self._lock = threading.Lock()
+        self._warm = None
+
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_hits = 0
+        self.prefetches = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Tuple[str, str], count_miss: bool = True) -> Optional[Dict]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None and self._warm is not None:
+                item = self._restore(key)
+
+            if item is None:
+                self.misses += count_miss
+                return None
+
+            now = time.time()
+            if now > item["expires_at"]:
+                if now > item["discard_at"]:
+                    self._remove(key)
+                    self.expirations += 1
+                self.misses += count_miss
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            item["hits"] += 1
+            return item
+
+    def get_stale(self, key: Tuple[str, str]) -> Optional[Dict]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None and self._warm is not None:
+                item = self._restore(key)
+            if item is None or time.time() > item["discard_at"]:
+                return None
+
+            self.stale_hits += 1
+            return item
+
+    def count_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def claim_prefetch(self, item: Dict) -> bool:
+        """
+        Return True exactly once for a hot entry that is about to expire;
+        the caller is then expected to refresh it in the background.
+        """
+        if item["hits"] < PREFETCH_MIN_HITS or item["refreshing"]:
+            return False
+
+        remaining = item["expires_at"] - time.time()
+        if remaining > item["ttl"] * PREFETCH_THRESHOLD:
+            return False
+
+        with self._lock:
+            if item["refreshing"]:
+                return False
+            item["refreshing"] = True
+            self.prefetches += 1
+            return True
+
+    def set(
+        self,
+        key: Tuple[str, str],
+        answers: List[dict],
+        ttl: float,
+        rcode: int = 0,
+        authority: List[dict] = (),
+        local: bool = False,
+    ):
+        self._ensure_sweeper()
+
+        now = time.time()
+        expires_at = now + ttl
+        discard_at = expires_at + self.stale_window
+        item = {
+            "answers": answers,
+            "rcode": rcode,
+            "authority": authority,
+            "ttl": ttl,
+            "stored_at": now,
+            "expires_at": expires_at,
+            "discard_at": discard_at,
+            "size": estimate_size(key, answers, authority),
+            "hits": 0,
+            # Built from local records, which record changes invalidate
+            # by key only.
+            "local": local,
+        }
+
+        with self._lock:
+            if self._warm is not None:
+                self._warm.discard(key)
+            self._insert(key, item)
+
+    def delete(self, key: Tuple[str, str]) -> bool:
+        with self._lock:
+            warm = self._warm is not None and self._warm.discard(key)
+            if key not in self._entries:
+                return warm
+            self._remove(key)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry.clear()
+            self.bytes = 0
+            self._warm = None
+
+    def attach_snapshot(self, warm):
+        """
+        Serve the entries of ``warm`` (a snapshot.WarmEntries) from now on,
+        decoding each on its first lookup.
+        """
+        self._ensure_sweeper()
+        with self._lock:
+            self._warm = warm
+
+    def snapshot_items(self):
+        """A copy of the entries, and the snapshot entries not yet decoded."""
+        with self._lock:
+            return list(self._entries.items()), self._warm
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        purged = 0
+
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                discard_at, key = heapq.heappop(self._expiry)
+                item = self._entries.get(key)
+                # Skip heap entries left behind by a later set() of the key.
+                if item is not None and item["discard_at"] == discard_at:
+                    self._remove(key)
+                    self.expirations += 1
+                    purged += 1
+
+        return purged
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale_hits": self.stale_hits,
+                "prefetches": self.prefetches,
+                "snapshot_entries": len(self._warm) if self._warm is not None else 0,
+            }
+
+    def _insert(self, key, item):
+        if key in self._entries:
+            self._remove(key)
+
+        item["refreshing"] = False
+        # Pre-rendered wire responses, filled in lazily on hits.
+        item["templates"] = {}
+        self._entries[key] = item
+        self.bytes += item["size"]
+        heapq.heappush(self._expiry, (item["discard_at"], key))
+
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or self.bytes > self.max_bytes
+        ):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+        if len(self._expiry) > 2 * len(self._entries) + 1024:
+            self._compact_expiry()
+
+    def _restore(self, key):
+        item = self._warm.pop(key)
+        if not self._warm:
+            self._warm = None
+        if item is not None:
+            item["size"] = estimate_size(key, item["answers"], item["authority"])
+            self._insert(key, item)
+        return item
+
+    def _remove(self, key):
+        item = self._entries.pop(key)
+        self.bytes -= item["size"]
+
+    def _compact_expiry(self):
+        self._expiry = [
+            (item["discard_at"], key) for key, item in self._entries.items()
+        ]
+        heapq.heapify(self._expiry)
+
+    def _ensure_sweeper(self):
+        if self.sweep_interval:
+            ensure_thread(self, self._sweep_forever, "dns-cache-sweeper")
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.purge_expired()
+
+
+DNS_CACHE = DNSCache()
+
+# NXDOMAIN/NODATA answers (RFC 2308) live in their own, smaller cache so a
+# flood of random names cannot push real answers out of DNS_CACHE.
+NEGATIVE_CACHE = DNSCache(
+    max_entries=NEGATIVE_CACHE_MAX_ENTRIES,
+    max_bytes=NEGATIVE_CACHE_MAX_BYTES,
+)
+
+
+def get_cache_entry(domain: str, record_type: str) -> Optional[Dict]:
     key = (domain, record_type)
-    item = DNS_CACHE.get(key)
+    item = DNS_CACHE.get(key, count_miss=False) or NEGATIVE_CACHE.get(key, count_miss=False)
+    # One lookup is one miss, counted against DNS_CACHE, however many of
+    # the two caches it went through.
+    if item is None:
+        DNS_CACHE.count_miss()
+    return item
+
+
+def cache_age(item: Dict) -> int:
+    return int(time.time() - item["stored_at"])
+
+
+def with_ttl_elapsed(records: List[dict], elapsed: int) -> List[dict]:
+    if not elapsed:
+        return records
+
+    return [
+        dict(ans, TTL=max(ans["TTL"] - elapsed, 0))
+        for ans in records
+    ]
+
+
+def cached_answers(item: Dict) -> List[dict]:
+    return with_ttl_elapsed(item["answers"], cache_age(item))
+
+
+def cached_authority(item: Dict) -> List[dict]:
+    return with_ttl_elapsed(item["authority"], cache_age(item))
+
+
+def get_from_cache(domain: str, record_type: str):
+    item = DNS_CACHE.get((domain, record_type))
 
     if not item:
         return None
 
-    if time.time() > item["expires_at"]:
-        DNS_CACHE.pop(key, None)
-        return None
+    return cached_answers(item)
+
+
+def get_stale_entry(domain: str, record_type: str) -> Optional[Dict]:
+    key = (domain, record_type)
+    return DNS_CACHE.get_stale(key) or NEGATIVE_CACHE.get_stale(key)
+
+
+def stale_records(records: List[dict]) -> List[dict]:
+    return [dict(ans, TTL=SERVE_STALE_TTL) for ans in records]
+
 
-    return item["answers"]
+def claim_prefetch(item: Dict) -> bool:
+    cache = NEGATIVE_CACHE if item["authority"] else DNS_CACHE
+    return cache.claim_prefetch(item)
 
 
-def set_cache(domain: str, record_type: str, answers: List[dict]):
+def set_cache(domain: str, record_type: str, answers: List[dict], local: bool = False):
     if not answers:
         return
 
     ttl = min(ans.get("TTL", 60) for ans in answers)
 
-    DNS_CACHE[(domain, record_type)] = {
-        "answers": answers,
-        "expires_at": time.time() + ttl
-    }
+    DNS_CACHE.set((domain, record_type), answers, ttl, local=local)
+
+
+def set_negative_cache(
+    domain: str,
+    record_type: str,
+    rcode: int,
+    authority: List[dict],
+    answers: List[dict] = (),
+    local: bool = False,
+):
+    # Without an SOA there is no negative TTL, and RFC 2308 says not to cache.
+    if not authority:
+        return
+
+    # ``answers`` is the CNAME chain, if any, that led to the missing name.
+    ttl = min(NEGATIVE_CACHE_MAX_TTL, min(ans["TTL"] for ans in (*authority, *answers)))
+    authority = [dict(ans, TTL=min(ans["TTL"], ttl)) for ans in authority]
+
+    NEGATIVE_CACHE.set((domain, record_type), list(answers), ttl, rcode, authority, local)
+
+
+def invalidate(domain: str, record_type: str):
+    # A CNAME answers (and heads cached chains for) every type of its name.
+    types = DNS_TYPE_MAP if record_type == "CNAME" else (record_type,)
+    for record_type in types:
+        key = (domain, record_type)
+        DNS_CACHE.delete(key)
+        NEGATIVE_CACHE.delete(key)
+
+
+def clear_cache():
+    DNS_CACHE.clear()
+    NEGATIVE_CACHE.clear()
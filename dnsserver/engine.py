@@ -0,0 +1,470 @@
+import asyncio
+import logging
+import signal
+import socket
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.exception
+import dns.message
+import dns.rcode
+from django.conf import settings
+
+from dnsserver.cache import clear_cache
+from dnsserver.handler import handle_query_async
+from dnsserver.response_builder import (
+    EDNS_UDP_PAYLOAD,
+    MAX_MESSAGE_SIZE,
+    badvers_response,
+    truncate_response,
+    udp_payload_size,
+)
+from dnsserver.invalidation import LISTENER
+from dnsserver.metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    DROPPED,
+    QUERY_SECONDS,
+    REGISTRY,
+    STAGE_SECONDS,
+    TCP_REJECTED,
+    TRUNCATED,
+    record_response,
+    since,
+)
+from dnsserver.querylog import QUERY_LOG
+from dnsserver.snapshot import CACHE_SNAPSHOT_PATH, CacheSnapshots
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 32
+MAX_PENDING = 2048
+TCP_IDLE_TIMEOUT = getattr(settings, "DNS_TCP_IDLE_TIMEOUT", 10)
+MAX_TCP_CONNECTIONS = getattr(settings, "DNS_TCP_MAX_CONNECTIONS", 1024)
+# Queries answered concurrently on one connection; beyond this the engine
+# stops reading from it until an answer has been written.
+MAX_TCP_PIPELINE = 64
+SHUTDOWN_TIMEOUT = 5
+# Datagrams read or written per recvmmsg/sendmmsg call; 0 keeps asyncio's
+# own datagram transport, one system call per datagram.
+UDP_BATCH_SIZE = getattr(settings, "DNS_UDP_BATCH_SIZE", 0)
+
+# DNS over TLS (RFC 7858) on the same engine; 0 disables it.
+TLS_PORT = getattr(settings, "DNS_TLS_PORT", 0)
+TLS_CERTFILE = getattr(settings, "DNS_TLS_CERTFILE", None)
+TLS_KEYFILE = getattr(settings, "DNS_TLS_KEYFILE", None)
+
+
+def parse_request(data: bytes):
+    try:
+        return dns.message.from_wire(data)
+    except dns.exception.DNSException as exc:
+        logger.debug("Malformed DNS message: %s", exc)
+        return None
+
+
+def servfail_response(dns_request):
+    response = dns.message.make_response(dns_request, our_payload=EDNS_UDP_PAYLOAD)
+    response.set_rcode(dns.rcode.SERVFAIL)
+    return response.to_wire(max_size=MAX_MESSAGE_SIZE)
+
+
+class DNSDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if not self.engine.submit(self.answer(data, addr, time.perf_counter())):
+            DROPPED.inc()
+            logger.warning("UDP query from %s dropped: server overloaded", addr)
+
+    async def answer(self, data, addr, started):
+        response = await self.engine.resolve(data, started, udp=True)
+        if response is not None and not self.transport.is_closing():
+            sending = time.perf_counter()
+            self.transport.sendto(response, addr)
+            elapsed = since(sending, "send") - started
+            QUERY_SECONDS.observe(elapsed, "udp")
+            QUERY_LOG.log("udp", addr, response, elapsed)
+
+    def error_received(self, exc):
+        logger.warning("UDP DNS error: %s", exc)
+
+
+class BatchedDatagramEndpoint:
+    """
+    UDP serving with recvmmsg/sendmmsg in place of the datagram transport.
+
+    Every time the socket becomes readable one batch is read; responses
+    finished in the same event loop iteration go out together in one
+    sendmmsg call. If the socket buffer is full, the rest wait for the
+    socket to become writable again. Each query is still copied out of the
+    receive buffer once, as ``bytes``, before it is parsed.
+    """
+
+    def __init__(self, engine, sock, batch_size: int):
+        from dnsserver.udpbatch import DatagramBatcher
+
+        self.engine = engine
+        self.sock = sock
+        self.batcher = DatagramBatcher(sock, batch_size)
+        self.loop = asyncio.get_running_loop()
+        self.outgoing = []
+        self.flushing = False
+        self.closed = False
+
+        self.loop.add_reader(sock.fileno(), self.readable)
+
+    def readable(self):
+        try:
+            datagrams = self.batcher.recv()
+        except OSError as exc:
+            logger.warning("UDP DNS error: %s", exc)
+            return
+
+        for view, addr in datagrams:
+            # One copy, at the datagram's exact size: dnspython cannot parse
+            # a memoryview (it fails building the name's labels), and the
+            # slot may be overwritten by the next read before the task runs.
+            data = bytes(view)
+            if not self.engine.submit(self.answer(data, addr, time.perf_counter())):
+                DROPPED.inc()
+                logger.warning("UDP query from %s dropped: server overloaded", addr)
+
+    async def answer(self, data, addr, started):
+        response = await self.engine.resolve(data, started, udp=True)
+        if response is None or self.closed:
+            return
+
+        self.outgoing.append((response, addr, started, time.perf_counter()))
+        if not self.flushing:
+            self.flushing = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        if self.closed:
+            return
+
+        outgoing = self.outgoing
+        sent = self.batcher.send([(response, addr) for response, addr, _, _ in outgoing])
+        now = time.perf_counter()
+        for response, addr, started, sending in outgoing[:sent]:
+            STAGE_SECONDS.observe(now - sending, "send")
+            QUERY_SECONDS.observe(now - started, "udp")
+            QUERY_LOG.log("udp", addr, response, now - started)
+
+        self.outgoing = outgoing[sent:]
+        if self.outgoing:
+            self.loop.add_writer(self.sock.fileno(), self.flush)
+        else:
+            self.loop.remove_writer(self.sock.fileno())
+            self.flushing = False
+
+    def close(self):
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        self.loop.remove_writer(self.sock.fileno())
+        self.sock.close()
+
+
+class DNSServerEngine:
+
+    def __init__(
+        self,
+        host: str = "0.0.0.0",
+        port: int = 8053,
+        max_workers: int = MAX_WORKERS,
+        max_pending: int = MAX_PENDING,
+        reuse_port: bool = False,
+        metrics_port: int = 0,
+        max_tcp_connections: int = MAX_TCP_CONNECTIONS,
+        tcp_idle_timeout: float = TCP_IDLE_TIMEOUT,
+        tls_port: int = 0,
+        tls_certfile: str = None,
+        tls_keyfile: str = None,
+        udp_batch_size: int = UDP_BATCH_SIZE,
+        cache_snapshot_path: str = CACHE_SNAPSHOT_PATH,
+    ):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.metrics_port = metrics_port
+        self.max_pending = max_pending
+        self.max_tcp_connections = max_tcp_connections
+        self.tcp_idle_timeout = tcp_idle_timeout
+        self.tls_port = tls_port
+        self.tls_certfile = tls_certfile
+        self.tls_keyfile = tls_keyfile
+        self.udp_batch_size = udp_batch_size
+        self.snapshots = CacheSnapshots(
+            cache_snapshot_path.format(worker=0) if cache_snapshot_path else None
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="dns-query",
+        )
+
+        self._tasks = set()
+        self._writers = set()
+        self._udp_transport = None
+        self._udp_batched = None
+        self._tcp_server = None
+        self._tls_server = None
+        self._metrics_server = None
+
+    def submit(self, coro) -> bool:
+        if len(self._tasks) >= self.max_pending:
+            coro.close()
+            return False
+
+        self.track(asyncio.get_running_loop().create_task(coro))
+        return True
+
+    def track(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def resolve(self, data: bytes, started: float, udp: bool = False):
+        dns_request = parse_request(data)
+        since(started, "parse")
+        if dns_request is None or not dns_request.question:
+            return None
+
+        try:
+            response = badvers_response(dns_request) or await handle_query_async(
+                dns_request=dns_request,
+                executor=self.executor,
+            )
+        except Exception:
+            logger.exception("DNS query failed")
+            response = servfail_response(dns_request)
+
+        if udp:
+            max_size = udp_payload_size(dns_request)
+            if len(response) > max_size:
+                TRUNCATED.inc()
+                response = truncate_response(response, max_size)
+
+        record_response(response)
+        return response
+
+    async def handle_tcp_client(self, reader, writer, transport="tcp"):
+        """
+        Serve one TCP (or TLS) connection as RFC 7766 asks: the connection
+        stays open for further queries, queries are answered concurrently
+        and each answer is written as soon as it is ready, so responses may
+        go out in a different order than the queries came in (clients match
+        them by ID). The connection is closed after ``tcp_idle_timeout``
+        seconds without a query while nothing is in flight, or once the
+        client closes its side and the outstanding answers are sent.
+        """
+
+        addr = writer.get_extra_info("peername")
+        if len(self._writers) >= self.max_tcp_connections:
+            TCP_REJECTED.inc()
+            logger.warning("%s connection from %s refused: connection limit reached",
+                           transport.upper(), addr)
+            writer.close()
+            return
+
+        self._writers.add(writer)
+        pending = set()
+        slots = asyncio.Semaphore(MAX_TCP_PIPELINE)
+
+        try:
+            while not writer.is_closing():
+                try:
+                    # readexactly() only consumes the buffer once it has all
+                    # the bytes, so a timed out read loses nothing.
+                    length_bytes = await asyncio.wait_for(
+                        reader.readexactly(2), self.tcp_idle_timeout
+                    )
+                except asyncio.TimeoutError:
+                    if pending:
+                        continue
+                    break
+                except asyncio.IncompleteReadError:
+                    break
+
+                length = int.from_bytes(length_bytes, "big")
+                try:
+                    data = await asyncio.wait_for(
+                        reader.readexactly(length), self.tcp_idle_timeout
+                    )
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+
+                await slots.acquire()
+                task = self.track(asyncio.create_task(self.answer_stream(
+                    writer, data, addr, transport, time.perf_counter()
+                )))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                task.add_done_callback(lambda _: slots.release())
+
+            # The client may half-close after its last query; it still
+            # expects the answers.
+            if pending:
+                await asyncio.wait(pending, timeout=SHUTDOWN_TIMEOUT)
+
+        except (ConnectionError, ssl.SSLError) as exc:
+            logger.debug("%s DNS connection from %s lost: %s", transport.upper(), addr, exc)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def answer_stream(self, writer, data, addr, transport, started):
+        response = await self.resolve(data, started)
+        if response is None:
+            # Not a DNS query: the client is not speaking DNS, or the
+            # framing is out of step. Either way the stream is unusable.
+            writer.close()
+            return
+        if writer.is_closing():
+            return
+
+        sending = time.perf_counter()
+        writer.write(len(response).to_bytes(2, "big") + response)
+        try:
+            await writer.drain()
+        except (ConnectionError, ssl.SSLError):
+            return
+        elapsed = since(sending, "send") - started
+        QUERY_SECONDS.observe(elapsed, transport)
+        QUERY_LOG.log(transport, addr, response, elapsed)
+
+    def tls_context(self):
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(self.tls_certfile, self.tls_keyfile)
+        context.set_alpn_protocols(["dot"])
+        return context
+
+    async def handle_metrics_client(self, reader, writer):
+        """
+        Answer a Prometheus scrape. This is deliberately not an HTTP server:
+        it reads the request head, serves the registry for GET /metrics and
+        closes the connection.
+        """
+
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), TCP_IDLE_TIMEOUT)
+            method, path = head.split(b" ", 2)[:2]
+            if method == b"GET" and path.split(b"?", 1)[0] == b"/metrics":
+                status, body = "200 OK", REGISTRY.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {METRICS_CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def udp_socket(self):
+        family, type_, proto, _, address = socket.getaddrinfo(
+            self.host, self.port, type=socket.SOCK_DGRAM
+        )[0]
+        sock = socket.socket(family, type_, proto)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setblocking(False)
+        sock.bind(address)
+        return sock
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, LISTENER.ensure_started)
+        await loop.run_in_executor(self.executor, self.snapshots.load)
+        self.snapshots.ensure_started()
+
+        if self.udp_batch_size:
+            # Only imported when enabled, as it loads ctypes.
+            from dnsserver.udpbatch import MMSG_AVAILABLE
+
+            if MMSG_AVAILABLE:
+                self._udp_batched = BatchedDatagramEndpoint(
+                    self, self.udp_socket(), self.udp_batch_size
+                )
+            else:
+                logger.info("recvmmsg/sendmmsg unavailable, UDP answered one datagram at a time")
+
+        if self._udp_batched is None:
+            self._udp_transport, _ = await loop.create_datagram_endpoint(
+                lambda: DNSDatagramProtocol(self),
+                local_addr=(self.host, self.port),
+                reuse_port=self.reuse_port,
+            )
+        self._tcp_server = await asyncio.start_server(
+            self.handle_tcp_client,
+            self.host,
+            self.port,
+            reuse_port=self.reuse_port,
+        )
+
+        if self.tls_port:
+            self._tls_server = await asyncio.start_server(
+                lambda reader, writer: self.handle_tcp_client(reader, writer, "dot"),
+                self.host,
+                self.tls_port,
+                ssl=self.tls_context(),
+                ssl_handshake_timeout=self.tcp_idle_timeout,
+                reuse_port=self.reuse_port,
+            )
+
+        if self.metrics_port:
+            self._metrics_server = await asyncio.start_server(
+                self.handle_metrics_client,
+                self.host,
+                self.metrics_port,
+            )
+
+    async def stop(self):
+        if self._udp_transport is not None:
+            self._udp_transport.close()
+        if self._udp_batched is not None:
+            self._udp_batched.close()
+        for server in (self._tcp_server, self._tls_server):
+            if server is not None:
+                server.close()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+
+        for writer in list(self._writers):
+            writer.close()
+
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=SHUTDOWN_TIMEOUT)
+
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.snapshots.stop)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        QUERY_LOG.stop()
+
+    async def serve_forever(self):
+        await self.start()
+
+        loop = asyncio.get_running_loop()
+        shutdown = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            loop.add_signal_handler(sig, shutdown.set)
+        loop.add_signal_handler(signal.SIGUSR1, clear_cache)
+
+        await shutdown.wait()
+        await self.stop()
+
+
+def run(**options):
+    engine = DNSServerEngine(**options)
+    asyncio.run(engine.serve_forever())
@@ -1,67 +1,404 @@
+import asyncio
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import dns.rdatatype
+from django.conf import settings
 
-from records.models import DNSRecord
-from dnsserver.cache import get_from_cache, set_cache
-from dnsserver.upstream import query_upstream_dns
-from dnsserver.response_builder import build_dns_response, DNS_TYPE_MAP
+from dnsserver.cache import (
+    cache_age,
+    cached_answers,
+    cached_authority,
+    claim_prefetch,
+    get_cache_entry,
+    get_stale_entry,
+    set_cache,
+    set_negative_cache,
+    stale_records,
+)
+from dnsserver.invalidation import LISTENER
+from dnsserver.metrics import QUERIES, UPSTREAM_FAILURES, since
+from dnsserver.zone_index import ZONE_INDEX
+from dnsserver.upstream import query_upstream_dns, query_upstream_dns_async
+from dnsserver.response_builder import (
+    build_dns_response,
+    build_response_template,
+    render_template,
+    template_key,
+)
 
 logger = logging.getLogger(__name__)
 
+# RFC 8767 client response timer: how long a client waits for upstream
+# before getting a stale answer instead (the refresh carries on regardless).
+SERVE_STALE_CLIENT_TIMEOUT = getattr(settings, "DNS_SERVE_STALE_CLIENT_TIMEOUT", 1.8)
+
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="dns-prefetch")
+
+# Longest CNAME chain followed for one query (RFC 1034 asks for a limit).
+MAX_CNAME_CHAIN = getattr(settings, "DNS_MAX_CNAME_CHAIN", 8)
+
+# Strong references to fire-and-forget tasks, which asyncio only holds weakly.
+_background_tasks = set()
+
+
+def parse_question(dns_request):
+    question = dns_request.question[0]
+    domain = question.name.to_text().rstrip(".")
+    record_type = dns.rdatatype.to_text(question.rdtype)
+    return domain, record_type
+
+
+def answer_locally(domain, record_type):
+    """
+    Return ``(answers, status, authority, cacheable, local)`` from the zone
+    index, or None when the name is outside our zones and has to go upstream.
+    """
+
+    started = time.perf_counter()
+    answers = ZONE_INDEX.lookup_or_cname(domain, record_type)
+    if answers:
+        since(started, "local")
+        logger.debug("LOCAL RECORD: %s %s", domain, record_type)
+        return answers, 0, [], True, True
+
+    # Wildcard and negative answers are not cached: a record change only
+    # invalidates its own (domain, type) key, which would miss them, and
+    # the trie answers them in memory anyway.
+    local = ZONE_INDEX.resolve(domain, record_type)
+    since(started, "local")
+    if local is not None:
+        logger.debug("LOCAL ZONE: %s %s status=%s", domain, record_type, local[1])
+        return (*local, False, True)
+    return None
+
+
+def lookup_local_records(domain, record_type):
+    LISTENER.ensure_started()
+    return answer_locally(domain, record_type)
+
+
+def build_cached_response(dns_request, item):
+    elapsed = cache_age(item)
+    key = template_key(dns_request)
+
+    if key is not None:
+        template = item["templates"].get(key)
+        if template is None:
+            template = build_response_template(
+                dns_request, item["answers"], item["rcode"], item["authority"]
+            )
+            item["templates"][key] = template
+
+        response = render_template(template, dns_request, elapsed)
+        if response is not None:
+            return response
+
+    return build_dns_response(
+        dns_request, cached_answers(item), item["rcode"], cached_authority(item)
+    )
+
+
+def answer_from_cache(domain, record_type, dns_request=None, prefetch=None):
+    started = time.perf_counter()
+    item = get_cache_entry(domain, record_type)
+    started = since(started, "cache")
+    if not item:
+        return None
+
+    logger.debug("CACHE HIT: %s %s", domain, record_type)
+    if prefetch and claim_prefetch(item):
+        logger.info("PREFETCH: %s %s", domain, record_type)
+        prefetch(domain, record_type)
+
+    if dns_request:
+        response = build_cached_response(dns_request, item)
+        since(started, "build")
+        return response
+    return cached_answers(item)
+
+
+def upstream_answer(upstream_response, started):
+    since(started, "upstream")
+    if upstream_response.get("Status") == 2:
+        UPSTREAM_FAILURES.inc()
+    return (
+        upstream_response.get("Answer", []),
+        upstream_response.get("Status", 0),
+        upstream_response.get("Authority", []),
+        True,
+        False,
+    )
+
+
+def cache_answer(domain, record_type, answers, status, authority, local=False):
+    if status == 3 or (status == 0 and authority):
+        # NXDOMAIN or NODATA, possibly at the end of a CNAME chain
+        set_negative_cache(domain, record_type, status, authority, answers, local)
+    elif status == 0 and answers:
+        set_cache(domain, record_type, answers, local)
+
+
+def chain_target(answers, domain, record_type):
+    """
+    Follow the CNAMEs in ``answers`` from ``domain`` and return the name the
+    chain still has to be resolved at, or None when it is complete.
+    """
+
+    if record_type == "CNAME":
+        return None
+
+    cnames = {}
+    owners = set()
+    for ans in answers:
+        owner = ans["name"].lower()
+        if ans["type"] == dns.rdatatype.CNAME:
+            cnames[owner] = ans["data"].lower().rstrip(".")
+        else:
+            owners.add(owner)
+
+    name = domain
+    while name in cnames:
+        # pop() so a loop inside one answer cannot spin forever.
+        name = cnames.pop(name)
+
+    if name == domain or name in owners:
+        return None
+    return name
+
+
+class CNAMEChain:
+    """
+    Accumulates the links of a CNAME chain being chased for one query.
+
+    Each link is resolved from the cache, local zones or upstream, and the
+    flattened result is cached under the original (domain, type) as one
+    entry, unless a link came from a synthesized local answer, or from local
+    records anywhere after the first link (directly or through the cache):
+    a record change only invalidates its own key, never the chains that
+    pass through it.
+    """
+
+    def __init__(self, domain, record_type):
+        self.domain = domain
+        self.record_type = record_type
+        self.answers = []
+        self.status = 0
+        self.authority = []
+        self.cacheable = True
+        self.local = False
+        self.visited = {domain}
+        self.target = domain
+
+    def add(self, link):
+        answers, self.status, self.authority, cacheable, local = link
+        self.answers.extend(answers)
+        self.cacheable = self.cacheable and cacheable
+        self.local = self.local or local
+
+        if self.status != 0:
+            self.target = None
+            return
+
+        target = chain_target(answers, self.target, self.record_type)
+        if target is None:
+            self.target = None
+        elif target in self.visited or len(self.visited) > MAX_CNAME_CHAIN:
+            logger.warning(
+                "CNAME chain for %s %s loops or is too long", self.domain, self.record_type
+            )
+            self.status, self.authority, self.cacheable = 2, [], False
+            self.target = None
+        else:
+            self.visited.add(target)
+            self.target = target
+
+    def result(self):
+        if self.cacheable:
+            cache_answer(
+                self.domain, self.record_type, self.answers, self.status, self.authority,
+                self.local,
+            )
+        return self.answers, self.status, self.authority
+
+
+def cached_link(domain, record_type):
+    item = get_cache_entry(domain, record_type)
+    if item:
+        logger.debug("CACHE HIT: %s %s", domain, record_type)
+        # Only ever a later link, so an entry built from local records
+        # makes the chain uncacheable, as later_link does.
+        local = item["local"]
+        return cached_answers(item), item["rcode"], cached_authority(item), not local, local
+    return None
+
+
+def answer_stale(domain, record_type, dns_request=None):
+    item = get_stale_entry(domain, record_type)
+    if not item:
+        return None
+
+    logger.info("SERVE STALE: %s %s", domain, record_type)
+    answers = stale_records(item["answers"])
+    if dns_request:
+        return build_dns_response(
+            dns_request, answers, item["rcode"], stale_records(item["authority"])
+        )
+    return answers
+
+
+def later_link(local, later):
+    # A change to a local record further down a chain only invalidates
+    # that record's own key, so a chain through it must not be cached as
+    # a unit under the first name.
+    if local is not None and later:
+        return (*local[:3], False, True)
+    return local
+
+
+def resolve_link(domain, record_type, use_cache=True):
+    link = cached_link(domain, record_type) if use_cache else None
+    if link is None:
+        link = later_link(lookup_local_records(domain, record_type), use_cache)
+    if link is None:
+        logger.debug("UPSTREAM QUERY: %s %s", domain, record_type)
+        started = time.perf_counter()
+        link = upstream_answer(query_upstream_dns(domain, record_type), started)
+    return link
+
+
+def resolve_uncached(domain, record_type):
+    chain = CNAMEChain(domain, record_type)
+    # The first link skips the cache: we only get here on a miss, or to
+    # refresh the entry ahead of its expiry.
+    chain.add(resolve_link(domain, record_type, use_cache=False))
+    while chain.target:
+        chain.add(resolve_link(chain.target, record_type))
+    return chain.result()
+
+
+def prefetch(domain, record_type):
+    future = PREFETCH_EXECUTOR.submit(resolve_uncached, domain, record_type)
+    future.add_done_callback(log_prefetch_error)
+
+
+def log_prefetch_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Prefetch failed: %s", future.exception())
+
 
 def handle_query(domain=None, record_type=None, dns_request=None):
 
 
     if dns_request:
-        question = dns_request.question[0]
-        domain = question.name.to_text().rstrip(".")
-        record_type = dns.rdatatype.to_text(question.rdtype)
+        domain, record_type = parse_question(dns_request)
 
+    domain = domain.lower()
     record_type = record_type.upper()
-    logger.info(f"DNS QUERY: {domain} {record_type}")
+    QUERIES.inc(record_type)
+    logger.debug("DNS QUERY: %s %s", domain, record_type)
 
 
-    cached_answers = get_from_cache(domain, record_type)
-    if cached_answers:
-        logger.info(f"CACHE HIT: {domain} {record_type}")
-        return (
-            build_dns_response(dns_request, cached_answers)
-            if dns_request
-            else cached_answers
-        )
+    cached = answer_from_cache(domain, record_type, dns_request, prefetch)
+    if cached is not None:
+        return cached
 
 
-    records = DNSRecord.objects.filter(domain=domain, record_type=record_type)
-    answers = []
+    answers, status, authority = resolve_uncached(domain, record_type)
 
-    if records.exists():
-        logger.info(f"LOCAL RECORD: {domain} {record_type}")
+    if status == 2:
+        stale = answer_stale(domain, record_type, dns_request)
+        if stale is not None:
+            return stale
 
-        for record in records:
-            data = record.value
-            if record.record_type == "MX":
-                data = f"{record.priority} {record.value}"
 
-            answers.append({
-                "name": domain,
-                "type": DNS_TYPE_MAP[record_type],
-                "TTL": record.ttl,
-                "data": data,
-            })
+    if not dns_request:
+        return answers
 
-        set_cache(domain, record_type, answers)
+    started = time.perf_counter()
+    response = build_dns_response(dns_request, answers, status, authority)
+    since(started, "build")
+    return response
 
-    else:
 
-        logger.info(f"UPSTREAM QUERY: {domain} {record_type}")
+async def resolve_link_async(domain, record_type, use_cache=True):
+    link = cached_link(domain, record_type) if use_cache else None
+    if link is None:
+        link = later_link(answer_locally(domain, record_type), use_cache)
+    if link is None:
+        logger.debug("UPSTREAM QUERY: %s %s", domain, record_type)
+        started = time.perf_counter()
+        link = upstream_answer(await query_upstream_dns_async(domain, record_type), started)
+    return link
 
-        upstream_response = query_upstream_dns(domain, record_type)
-        answers = upstream_response.get("Answer", [])
-        set_cache(domain, record_type, answers)
 
+async def resolve_uncached_async(domain, record_type, executor=None):
+    if not LISTENER.running:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, LISTENER.ensure_started)
 
-    return (
-        build_dns_response(dns_request, answers)
-        if dns_request
-        else answers
-    )
+    chain = CNAMEChain(domain, record_type)
+    chain.add(await resolve_link_async(domain, record_type, use_cache=False))
+    while chain.target:
+        chain.add(await resolve_link_async(chain.target, record_type))
+    return chain.result()
+
+
+def run_in_background(coro):
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(log_prefetch_error)
+    return task
+
+
+async def handle_query_async(domain=None, record_type=None, dns_request=None, executor=None):
+    """
+    Same as handle_query, but upstream lookups run on the event loop and the
+    one-off zone index load on ``executor``, so the calling loop never blocks.
+    """
+
+    if dns_request:
+        domain, record_type = parse_question(dns_request)
+
+    domain = domain.lower()
+    record_type = record_type.upper()
+    QUERIES.inc(record_type)
+    logger.debug("DNS QUERY: %s %s", domain, record_type)
+
+
+    def prefetch_async(domain, record_type):
+        run_in_background(resolve_uncached_async(domain, record_type, executor))
+
+    cached = answer_from_cache(domain, record_type, dns_request, prefetch_async)
+    if cached is not None:
+        return cached
+
+
+    # The lookup runs as its own task so that, if the client timer fires and
+    # a stale answer goes out, the refresh still completes and fills the cache.
+    task = run_in_background(resolve_uncached_async(domain, record_type, executor))
+    try:
+        answers, status, authority = await asyncio.wait_for(
+            asyncio.shield(task), SERVE_STALE_CLIENT_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        stale = answer_stale(domain, record_type, dns_request)
+        if stale is not None:
+            return stale
+        answers, status, authority = await task
+
+    if status == 2:
+        stale = answer_stale(domain, record_type, dns_request)
+        if stale is not None:
+            return stale
+
+
+    if not dns_request:
+        return answers
+
+    started = time.perf_counter()
+    response = build_dns_response(dns_request, answers, status, authority)
+    since(started, "build")
+    return response
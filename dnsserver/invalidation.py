@@ -0,0 +1,95 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from records.models import RecordChange
+from dnsserver import threads
+from dnsserver.cache import clear_cache, invalidate
+from dnsserver.zone_index import ZONE_INDEX
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_POLL_INTERVAL = getattr(settings, "DNS_INVALIDATION_POLL_INTERVAL", 0.05)
+INVALIDATION_BATCH_SIZE = 1000
+
+
+class ChangeLogListener:
+    """
+    Follows the records.RecordChange table so that record writes made by any
+    process (the admin API, another worker, a management command) purge the
+    affected cache keys and refresh the zone index in this one.
+    """
+
+    def __init__(self, interval: float = INVALIDATION_POLL_INTERVAL):
+        self.interval = interval
+        self.last_id = 0
+
+    @property
+    def running(self) -> bool:
+        return threads.running(self)
+
+    def ensure_started(self):
+        threads.ensure_started(self, self._start)
+
+    def _start(self):
+        # Take the position before loading, so writes that race with the
+        # load are replayed rather than lost.
+        self.last_id = latest_change_id()
+        ZONE_INDEX.ensure_loaded()
+        threads.start_daemon(self._poll_forever, "dns-invalidation")
+
+    def poll(self) -> int:
+        changes = list(
+            RecordChange.objects.filter(id__gt=self.last_id)
+            .order_by("id")
+            .values_list("id", "domain", "record_type")[:INVALIDATION_BATCH_SIZE]
+        )
+
+        if not changes:
+            return 0
+
+        keys = set()
+        full_reload = False
+        for change_id, domain, record_type in changes:
+            self.last_id = change_id
+            if not domain:
+                full_reload = True
+            else:
+                keys.add((domain, record_type))
+
+        if full_reload:
+            ZONE_INDEX.load()
+            clear_cache()
+            logger.info("Record change log: full reload")
+            return len(changes)
+
+        for domain, record_type in keys:
+            ZONE_INDEX.refresh(domain, record_type)
+            invalidate(domain.lower(), record_type)
+
+        logger.info("Record change log: invalidated %s keys", len(keys))
+        return len(changes)
+
+    def _poll_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Record change log poll failed")
+                close_old_connections()
+
+
+def latest_change_id() -> int:
+    latest = RecordChange.objects.order_by("-id").values_list("id", flat=True).first()
+    return latest or 0
+
+
+def oldest_change_id():
+    """The id of the oldest change still in the log, None when it is empty."""
+    return RecordChange.objects.order_by("id").values_list("id", flat=True).first()
+
+
+LISTENER = ChangeLogListener()
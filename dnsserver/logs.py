@@ -0,0 +1,89 @@
+import logging
+import queue
+import weakref
+from logging.handlers import QueueHandler, QueueListener
+
+from dnsserver import threads
+
+LOG_QUEUE_SIZE = 10_000
+# How long a WARNING or worse record waits for room in a full queue before
+# it is dropped as well.
+LOG_QUEUE_TIMEOUT = 0.1
+
+_handlers = weakref.WeakSet()
+
+
+def dropped_records() -> int:
+    """Records dropped by every BackgroundHandler in this process."""
+    return sum(handler.dropped for handler in list(_handlers))
+
+
+class FlushingListener(QueueListener):
+    def enqueue_sentinel(self):
+        # QueueListener uses put_nowait(), which raises on a full queue;
+        # wait for the writer to make room, so stop() flushes everything.
+        self.queue.put(self._sentinel)
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Logging handler that hands records to a background thread, which
+    formats and writes them with ``target`` (a StreamHandler on stderr by
+    default). A slow or blocked stderr then no longer stalls the thread that
+    is answering a query.
+
+    Records are queued unformatted, so both the %-interpolation of the
+    message and the formatter run on the writer thread; callers must pass
+    immutable arguments (log with ``"%s", value``, not pre-formatted text).
+
+    When the queue is full, records below WARNING are dropped and counted
+    rather than blocking the caller; WARNING and worse wait up to
+    LOG_QUEUE_TIMEOUT for room first. The count is exported on /metrics as
+    dns_log_dropped_total. Used from ``DNS/settings.py`` LOGGING:
+
+        "console": {"class": "dnsserver.logs.BackgroundHandler"}
+    """
+
+    def __init__(self, target=None, queue_size: int = LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(queue_size))
+        self.target = target if target is not None else logging.StreamHandler()
+        self.queue_size = queue_size
+        self.dropped = 0
+        _handlers.add(self)
+
+        self.listener = None
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def ensure_started(self):
+        threads.ensure_started(self, self._start_listener)
+
+    def _start_listener(self):
+        # The parent's queue may have been forked mid-operation.
+        self.queue = queue.Queue(self.queue_size)
+        self.dropped = 0
+        self.listener = FlushingListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        self.ensure_started()
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=LOG_QUEUE_TIMEOUT)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None and threads.running(self):
+            self.listener.stop()
+        self.listener = None
+        threads.mark_stopped(self)
+        self.target.close()
+        super().close()
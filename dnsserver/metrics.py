@@ -0,0 +1,314 @@
+import os
+import resource
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+METRICS_PORT = getattr(settings, "DNS_METRICS_PORT", 9153)
+
+# Latency buckets in seconds, from cache hits (tens of microseconds) up to
+# upstream timeouts.
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+# Prometheus text exposition format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """
+    Base for metrics updated from the query path.
+
+    Every thread writes to its own shard (a plain dict held in a
+    threading.local), so updates take no lock and never contend; shards are
+    only summed when the metrics are scraped. Dict copies run without
+    releasing the GIL, so a scrape always sees a consistent shard.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def snapshot(self) -> list:
+        with self._shards_lock:
+            return [dict(shard) for shard in self._shards]
+
+    def reset(self):
+        # Used after fork(): the child must not report its parent's counts.
+        self._local = threading.local()
+        with self._shards_lock:
+            self._shards = []
+
+    def label_text(self, values, extra=""):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self) -> dict:
+        totals = {}
+        for shard in self.snapshot():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render(self) -> list:
+        lines = super().render()
+        for labels, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{self.label_text(labels)} {value}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        shard = self.shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # One slot per bucket, one for +Inf, then the running sum.
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def values(self) -> dict:
+        totals = {}
+        for shard in self.snapshot():
+            for labels, counts in shard.items():
+                total = totals.setdefault(labels, [0] * (len(self.buckets) + 2))
+                for i, count in enumerate(counts):
+                    total[i] += count
+        return totals
+
+    def render(self) -> list:
+        lines = super().render()
+        for labels, counts in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = self.label_text(labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{self.label_text(labels)} {counts[-1]:.6f}")
+            lines.append(f"{self.name}_count{self.label_text(labels)} {cumulative}")
+        return lines
+
+
+class Collector(Metric):
+    """
+    A value read from ``collect`` at scrape time, for state the server
+    already tracks (cache and upstream statistics), so the hot path pays
+    nothing for it. ``collect`` returns ``{label values: value}``.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, collect, labels=(), kind="gauge"):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def render(self) -> list:
+        lines = super().render()
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{self.label_text(labels)} {value}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "dns_stage_duration_seconds",
+    "Time spent in each stage of answering a query.",
+    labels=("stage",),
+))
+QUERY_SECONDS = REGISTRY.register(Histogram(
+    "dns_query_duration_seconds",
+    "Time from receiving a query to handing its response to the transport.",
+    labels=("transport",),
+))
+QUERIES = REGISTRY.register(Counter(
+    "dns_queries_total",
+    "Queries received, by record type.",
+    labels=("type",),
+))
+RESPONSES = REGISTRY.register(Counter(
+    "dns_responses_total",
+    "Responses sent, by RCODE.",
+    labels=("rcode",),
+))
+UPSTREAM_FAILURES = REGISTRY.register(Counter(
+    "dns_upstream_failures_total",
+    "Upstream lookups that ended in SERVFAIL after trying every nameserver.",
+))
+DROPPED = REGISTRY.register(Counter(
+    "dns_dropped_queries_total",
+    "Queries dropped because too many were already in flight.",
+))
+TCP_REJECTED = REGISTRY.register(Counter(
+    "dns_tcp_rejected_connections_total",
+    "TCP and TLS connections refused because too many were open.",
+))
+TRUNCATED = REGISTRY.register(Counter(
+    "dns_truncated_responses_total",
+    "UDP responses too large for the client's buffer, sent with TC set.",
+))
+QUERY_LOG_DROPPED = REGISTRY.register(Counter(
+    "dns_query_log_dropped_total",
+    "Query log entries dropped because the log writer fell behind.",
+))
+
+
+def cache_stats(key):
+    def collect():
+        from dnsserver.cache import DNS_CACHE, NEGATIVE_CACHE
+
+        return {
+            ("positive",): DNS_CACHE.stats()[key],
+            ("negative",): NEGATIVE_CACHE.stats()[key],
+        }
+    return collect
+
+
+def upstream_stats(key):
+    def collect():
+        from dnsserver.upstream import UPSTREAM
+
+        return {
+            (ns["nameserver"],): ns[key] for ns in UPSTREAM.stats()["nameservers"]
+        }
+    return collect
+
+
+for stat, kind, help in (
+    ("hits", "counter", "Cache lookups answered from the cache."),
+    ("misses", "counter", "Cache lookups that missed."),
+    ("stale_hits", "counter", "Expired entries served under RFC 8767."),
+    ("prefetches", "counter", "Background refreshes of hot entries."),
+    ("evictions", "counter", "Entries evicted by the size limits."),
+    ("entries", "gauge", "Entries currently cached."),
+    ("bytes", "gauge", "Estimated size of the cache."),
+):
+    REGISTRY.register(Collector(
+        f"dns_cache_{stat}" + ("_total" if kind == "counter" else ""),
+        help,
+        cache_stats(stat),
+        labels=("cache",),
+        kind=kind,
+    ))
+
+for stat, kind, help in (
+    ("queries", "counter", "Queries sent to each upstream nameserver."),
+    ("errors", "counter", "Failed queries to each upstream nameserver."),
+    ("timeouts", "counter", "Timed out queries to each upstream nameserver."),
+):
+    REGISTRY.register(Collector(
+        f"dns_upstream_{stat}_total",
+        help,
+        upstream_stats(stat),
+        labels=("nameserver",),
+        kind=kind,
+    ))
+
+
+def log_dropped():
+    from dnsserver.logs import dropped_records
+
+    return {(): dropped_records()}
+
+
+REGISTRY.register(Collector(
+    "dns_log_dropped_total",
+    "Log records dropped because the log writer fell behind.",
+    log_dropped,
+    kind="counter",
+))
+
+
+def process_memory():
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return {(): pages * os.sysconf("SC_PAGE_SIZE")}
+    except OSError:
+        # No /proc: fall back to the peak, in bytes on macOS and KiB elsewhere.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {(): peak if sys.platform == "darwin" else peak * 1024}
+
+
+REGISTRY.register(Collector(
+    "process_resident_memory_bytes",
+    "Resident memory of this process.",
+    process_memory,
+))
+
+
+def since(started: float, stage: str) -> float:
+    """Record the time since ``started`` under ``stage``; return the current time."""
+    now = time.perf_counter()
+    STAGE_SECONDS.observe(now - started, stage)
+    return now
+
+
+def record_response(response: bytes):
+    RESPONSES.inc(RCODE_NAMES.get(response[3] & 0x0F, "OTHER"))
+
+
+RCODE_NAMES = {
+    0: "NOERROR", 1: "FORMERR", 2: "SERVFAIL", 3: "NXDOMAIN", 4: "NOTIMP", 5: "REFUSED",
+}
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import queue
+import random
+import time
+from logging.handlers import QueueListener, RotatingFileHandler
+
+import dns.exception
+import dns.name
+import dns.rdatatype
+from django.conf import settings
+
+from dnsserver import threads
+from dnsserver.logs import LOG_QUEUE_SIZE
+from dnsserver.metrics import QUERY_LOG_DROPPED, RCODE_NAMES
+
+QUERY_LOG_PATH = getattr(settings, "DNS_QUERY_LOG_PATH", None)
+QUERY_LOG_SAMPLE_RATE = getattr(settings, "DNS_QUERY_LOG_SAMPLE_RATE", 1.0)
+QUERY_LOG_MAX_BYTES = getattr(settings, "DNS_QUERY_LOG_MAX_BYTES", 100 * 1024 * 1024)
+QUERY_LOG_BACKUP_COUNT = getattr(settings, "DNS_QUERY_LOG_BACKUP_COUNT", 5)
+
+
+class QueryRecord:
+    """
+    The little a query log entry needs on the query path: the response wire
+    is kept as is and only decoded on the writer thread. Passed straight to
+    the file handler, so it stands in for a LogRecord.
+    """
+
+    __slots__ = ("created", "transport", "client", "response", "duration", "line")
+
+    msg = ""
+    args = ()
+
+    def __init__(self, transport, client, response, duration):
+        self.created = time.time()
+        self.transport = transport
+        self.client = client
+        self.response = response
+        self.duration = duration
+        self.line = None
+
+
+def question(wire: bytes):
+    # The question name is the first name in the message, so it is never
+    # compressed and can be read without parsing the rest.
+    try:
+        name, used = dns.name.from_wire(wire, 12)
+        record_type = int.from_bytes(wire[12 + used:14 + used], "big")
+    except (dns.exception.DNSException, IndexError):
+        return None, None
+    return name.to_text(omit_final_dot=True).lower(), dns.rdatatype.to_text(record_type)
+
+
+class QueryLogFormatter(logging.Formatter):
+    """Formats a QueryRecord as one NDJSON line."""
+
+    def format(self, record):
+        # RotatingFileHandler formats each record twice: once to check the
+        # size, once to write it.
+        if record.line is None:
+            wire = record.response
+            name, record_type = question(wire)
+            record.line = json.dumps({
+                "ts": round(record.created, 6),
+                "client": record.client[0] if record.client else None,
+                "transport": record.transport,
+                "name": name,
+                "type": record_type,
+                "rcode": RCODE_NAMES.get(wire[3] & 0x0F, wire[3] & 0x0F),
+                "answers": int.from_bytes(wire[6:8], "big"),
+                "size": len(wire),
+                "ms": round(record.duration * 1000, 3),
+            }, separators=(",", ":"))
+        return record.line
+
+
+class QueryLog:
+    """
+    Structured per-query log, one NDJSON object per line, written by a
+    background thread to a size-rotated file.
+
+    Only a sample of queries is logged when ``sample_rate`` is below 1;
+    SERVFAIL responses are always logged. When the writer falls behind and
+    its queue fills up, entries are dropped and counted in
+    dns_query_log_dropped_total rather than slowing down the query path.
+
+    ``path`` may contain ``{pid}``, so forked workers write separate files
+    (rotation is not safe with several processes writing one file).
+    """
+
+    def __init__(
+        self,
+        path: str = QUERY_LOG_PATH,
+        sample_rate: float = QUERY_LOG_SAMPLE_RATE,
+        max_bytes: int = QUERY_LOG_MAX_BYTES,
+        backup_count: int = QUERY_LOG_BACKUP_COUNT,
+        queue_size: int = LOG_QUEUE_SIZE,
+    ):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue_size = queue_size
+
+        self.queue = None
+        self.listener = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and self.sample_rate > 0
+
+    def ensure_started(self):
+        threads.ensure_started(self, self._start_listener)
+
+    def _start_listener(self):
+        handler = RotatingFileHandler(
+            self.path.format(pid=os.getpid()),
+            maxBytes=self.max_bytes,
+            backupCount=self.backup_count,
+            encoding="utf-8",
+            delay=True,
+        )
+        handler.setFormatter(QueryLogFormatter())
+
+        self.queue = queue.Queue(self.queue_size)
+        self.listener = QueueListener(self.queue, handler)
+        self.listener.start()
+
+    def log(self, transport: str, client, response: bytes, duration: float):
+        if not self.enabled:
+            return
+        if (
+            self.sample_rate < 1
+            and response[3] & 0x0F != 2
+            and random.random() >= self.sample_rate
+        ):
+            return
+
+        self.ensure_started()
+        try:
+            self.queue.put_nowait(QueryRecord(transport, client, response, duration))
+        except queue.Full:
+            QUERY_LOG_DROPPED.inc()
+
+    def stop(self):
+        if self.listener is not None and threads.running(self):
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+        self.listener = None
+        threads.mark_stopped(self)
+
+
+QUERY_LOG = QueryLog()
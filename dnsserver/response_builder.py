@@ -1,29 +1,236 @@
+import struct
+
+import dns.edns
 import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
 import dns.rrset
 
 DNS_TYPE_MAP = {
     "A": 1, "AAAA": 28, "CNAME": 5, "MX": 15,
-    "TXT": 16, "PTR": 12, "NS": 2
+    "TXT": 16, "PTR": 12, "NS": 2, "SOA": 6
 }
 
-def build_dns_response(request, answers):
+# The EDNS0 UDP payload size we advertise and the most we send over UDP:
+# 1232 bytes fits an IPv6 minimum-MTU packet, so answers are never
+# fragmented (DNS flag day 2020). Without EDNS0 the limit is 512.
+EDNS_UDP_PAYLOAD = 1232
+MIN_UDP_PAYLOAD = 512
+MAX_MESSAGE_SIZE = 65535
+
+def build_rrset(ans):
+    record_type = ans["type"]
+    rdata_text = ans["data"]
+
+    if record_type == "MX" and " " not in rdata_text:
+        rdata_text = f"10 {rdata_text}"
+
+    return dns.rrset.from_text_list(
+        dns.name.from_text(ans["name"]),
+        ans["TTL"],
+        "IN",
+        record_type,
+        [rdata_text],
+        origin=dns.name.root,
+        relativize=False,
+    )
+
+
+def build_dns_response(request, answers, rcode=dns.rcode.NOERROR, authority=()):
 
-    response = dns.message.make_response(request)
+    # make_response echoes the client's OPT record when it sent one.
+    response = dns.message.make_response(request, our_payload=EDNS_UDP_PAYLOAD)
+    response.set_rcode(rcode)
 
     for ans in answers:
-        record_type = ans["type"]
-        rdata_text = ans["data"]
+        response.answer.append(build_rrset(ans))
 
-        if record_type == "MX" and " " not in rdata_text:
-            rdata_text = f"10 {rdata_text}"
+    for ans in authority:
+        response.authority.append(build_rrset(ans))
 
-        rrset = dns.rrset.from_text(
-            ans["name"],
-            ans["TTL"],
-            "IN",
-            record_type,
-            rdata_text,
-        )
-        response.answer.append(rrset)
+    # dnspython would otherwise cap the size at the client's EDNS0 buffer
+    # size and raise; UDP responses are truncated by the transport instead.
+    return response.to_wire(max_size=MAX_MESSAGE_SIZE)
 
+
+def badvers_response(request):
+    """
+    BADVERS for a request using an EDNS version we do not implement
+    (RFC 6891 section 6.1.3), or None when the version is fine.
+    """
+
+    if request.edns <= 0:
+        return None
+    response = dns.message.make_response(request, our_payload=EDNS_UDP_PAYLOAD)
+    response.set_rcode(dns.rcode.BADVERS)
     return response.to_wire()
+
+
+HEADER_SIZE = 12
+RD_BIT = 0x01
+TC_BIT = 0x02
+
+
+class ResponseTemplate:
+    """
+    A response rendered once by build_dns_response, with the offsets of
+    every TTL field recorded so later hits can be served by patching bytes.
+    """
+
+    __slots__ = ("wire", "qname_size", "ttl_offsets", "ttls")
+
+    def __init__(self, wire: bytes, qname_size: int, ttl_offsets, ttls):
+        self.wire = wire
+        self.qname_size = qname_size
+        self.ttl_offsets = ttl_offsets
+        self.ttls = ttls
+
+
+def template_key(request):
+    """
+    Return the part of ``request`` that changes the response bytes beyond
+    the id, RD bit, question case and TTLs, or None when the request cannot
+    be answered from a template (TSIG, EDNS padding, multiple questions, or
+    a class other than IN, which the template would not echo).
+    """
+
+    if len(request.question) != 1 or request.had_tsig:
+        return None
+    if request.question[0].rdclass != dns.rdataclass.IN:
+        return None
+    if request.opcode() != dns.opcode.QUERY:
+        return None
+    if request.edns >= 0:
+        for option in request.options:
+            if option.otype == dns.edns.OptionType.PADDING:
+                return None
+        return True
+    return False
+
+
+def skip_name(wire: bytes, offset: int) -> int:
+    while True:
+        length = wire[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+
+def build_response_template(
+    request, answers, rcode=dns.rcode.NOERROR, authority=()
+) -> ResponseTemplate:
+    wire = build_dns_response(request, answers, rcode, authority)
+
+    qdcount, ancount, nscount = struct.unpack_from("!HHH", wire, 4)
+    offset = HEADER_SIZE
+    for _ in range(qdcount):
+        offset = skip_name(wire, offset) + 4
+    qname_size = skip_name(wire, HEADER_SIZE) - HEADER_SIZE
+
+    ttl_offsets = []
+    ttls = []
+    for _ in range(ancount + nscount):
+        offset = skip_name(wire, offset) + 4
+        ttl_offsets.append(offset)
+        ttls.append(struct.unpack_from("!I", wire, offset)[0])
+        offset += 4
+        rdlength = struct.unpack_from("!H", wire, offset)[0]
+        offset += 2 + rdlength
+
+    return ResponseTemplate(wire, qname_size, tuple(ttl_offsets), tuple(ttls))
+
+
+def min_ttl(wire: bytes):
+    """
+    Smallest TTL in the answer and authority sections of a response, or
+    None when both are empty.
+    """
+
+    qdcount, ancount, nscount = struct.unpack_from("!HHH", wire, 4)
+    offset = HEADER_SIZE
+    for _ in range(qdcount):
+        offset = skip_name(wire, offset) + 4
+
+    ttl = None
+    for _ in range(ancount + nscount):
+        offset = skip_name(wire, offset) + 4
+        rr_ttl, rdlength = struct.unpack_from("!IH", wire, offset)
+        ttl = rr_ttl if ttl is None else min(ttl, rr_ttl)
+        offset += 6 + rdlength
+
+    return ttl
+
+
+def udp_payload_size(request) -> int:
+    """
+    Largest UDP response ``request`` can take (RFC 6891): the buffer size
+    in its OPT record, capped at EDNS_UDP_PAYLOAD, or 512 without EDNS0.
+    """
+
+    if request.edns < 0:
+        return MIN_UDP_PAYLOAD
+    return max(MIN_UDP_PAYLOAD, min(request.payload, EDNS_UDP_PAYLOAD))
+
+
+def truncate_response(wire: bytes, max_size: int) -> bytes:
+    """
+    Return ``wire`` if it fits in ``max_size`` bytes; otherwise the same
+    response cut down to its header, question and OPT record with TC set,
+    which tells the client to retry over TCP.
+    """
+
+    if len(wire) <= max_size:
+        return wire
+
+    qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHH", wire, 4)
+    offset = HEADER_SIZE
+    for _ in range(qdcount):
+        offset = skip_name(wire, offset) + 4
+    question_end = offset
+
+    # The OPT record has the root as owner, so unlike the answers it holds
+    # no compression pointers and can be copied as is.
+    opt = b""
+    for index in range(ancount + nscount + arcount):
+        start = offset
+        offset = skip_name(wire, offset)
+        rr_type, _, _, rdlength = struct.unpack_from("!HHIH", wire, offset)
+        offset += 10 + rdlength
+        if index >= ancount + nscount and rr_type == dns.rdatatype.OPT:
+            opt = wire[start:offset]
+
+    header = bytearray(wire[:HEADER_SIZE])
+    header[2] |= TC_BIT
+    struct.pack_into("!HHH", header, 6, 0, 0, 1 if opt else 0)
+    return bytes(header) + wire[HEADER_SIZE:question_end] + opt
+
+
+def render_template(template: ResponseTemplate, request, elapsed: int = 0):
+    """
+    Produce the same bytes build_dns_response would for ``request`` with
+    every answer and authority TTL reduced by ``elapsed`` seconds, or None
+    if the template was built for a different name.
+    """
+
+    wire = bytearray(template.wire)
+    struct.pack_into("!H", wire, 0, request.id)
+    wire[2] = (wire[2] & ~RD_BIT) | ((request.flags >> 8) & RD_BIT)
+
+    # Names that differ only in case have the same wire length, and answer
+    # owners compress to a pointer at the question, so echoing the client's
+    # spelling of the name keeps every offset valid.
+    qname = request.question[0].name.to_wire()
+    if len(qname) != template.qname_size:
+        return None
+    wire[HEADER_SIZE:HEADER_SIZE + template.qname_size] = qname
+
+    if elapsed:
+        for offset, ttl in zip(template.ttl_offsets, template.ttls):
+            struct.pack_into("!I", wire, offset, max(ttl - elapsed, 0))
+
+    return bytes(wire)
@@ -1,3 +1,4 @@
+import argparse
 import os
 import socket
 import sys
@@ -9,45 +10,99 @@ import dns.message
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR)
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "DNS.settings")
+# Only the ORM is needed here; see DNS/settings_dns.py.
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "DNS.settings_dns")
 django.setup()
 
+from dnsserver.engine import (
+    MAX_TCP_CONNECTIONS,
+    MAX_WORKERS,
+    TCP_IDLE_TIMEOUT,
+    TLS_CERTFILE,
+    TLS_KEYFILE,
+    TLS_PORT,
+    UDP_BATCH_SIZE,
+    run,
+)
 from dnsserver.handler import handle_query
+from dnsserver.metrics import METRICS_PORT
+from dnsserver.response_builder import truncate_response, udp_payload_size
+from dnsserver.snapshot import CACHE_SNAPSHOT_PATH
+from dnsserver.upstream import UPSTREAM
 
 DNS_PORT = 8053
 BUFFER_SIZE = 4096
 
 
 
-def start_udp_dns_server():
+def answer_udp(data, addr):
+    try:
+        dns_request = dns.message.from_wire(data)
+        response = handle_query(dns_request=dns_request)
+        return truncate_response(response, udp_payload_size(dns_request))
+    except Exception as e:
+        print(f"UDP DNS error from {addr}: {e}")
+        return None
+
+
+def start_udp_dns_server(batch_size=0):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind(("0.0.0.0", DNS_PORT))
     print(f"DNS UDP Server running on port {DNS_PORT}")
 
+    if batch_size:
+        from dnsserver.udpbatch import DatagramBatcher
+
+        # Whatever queued up while the last batch was being answered is
+        # read, and answered, in one go.
+        batcher = DatagramBatcher(sock, batch_size, BUFFER_SIZE)
+        while True:
+            responses = []
+            for view, addr in batcher.recv():
+                # dnspython only parses bytes, so each query is copied once.
+                response = answer_udp(bytes(view), addr)
+                if response is not None:
+                    responses.append((response, addr))
+            batcher.send(responses)
+
     while True:
         data, addr = sock.recvfrom(BUFFER_SIZE)
-        try:
-            dns_request = dns.message.from_wire(data)
-            response = handle_query(dns_request=dns_request)
+        response = answer_udp(data, addr)
+        if response is not None:
             sock.sendto(response, addr)
-        except Exception as e:
-            print(f"UDP DNS error from {addr}: {e}")
+
+
+def recv_exactly(conn, length):
+    # recv() may return less than asked for; None means the peer closed.
+    data = b""
+    while len(data) < length:
+        chunk = conn.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
 
 
 def handle_tcp_client(conn, addr):
+    conn.settimeout(TCP_IDLE_TIMEOUT)
     try:
-        length_bytes = conn.recv(2)
-        if not length_bytes:
-            return
+        while True:
+            length_bytes = recv_exactly(conn, 2)
+            if not length_bytes:
+                return
 
-        length = int.from_bytes(length_bytes, "big")
-        data = conn.recv(length)
+            length = int.from_bytes(length_bytes, "big")
+            data = recv_exactly(conn, length)
+            if data is None:
+                return
 
-        dns_request = dns.message.from_wire(data)
-        response = handle_query(dns_request=dns_request)
+            dns_request = dns.message.from_wire(data)
+            response = handle_query(dns_request=dns_request)
 
-        conn.sendall(len(response).to_bytes(2, "big") + response)
+            conn.sendall(len(response).to_bytes(2, "big") + response)
 
+    except TimeoutError:
+        pass
     except Exception as e:
         print(f"TCP DNS error from {addr}: {e}")
     finally:
@@ -69,10 +124,124 @@ def start_tcp_dns_server():
         ).start()
 
 
-if __name__ == "__main__":
-    threading.Thread(target=start_udp_dns_server, daemon=True).start()
-    threading.Thread(target=start_tcp_dns_server, daemon=True).start()
+def start_threaded_dns_server(udp_batch_size=0):
+    threads = [
+        threading.Thread(target=start_udp_dns_server, args=(udp_batch_size,), daemon=True),
+        threading.Thread(target=start_tcp_dns_server, daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
 
     print("✅ DNS Server (UDP + TCP) started")
-    while True:
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
         pass
+
+
+def start_asyncio_dns_server(options):
+    engine_options = {
+        "host": options.host,
+        "port": options.port,
+        "max_workers": options.max_workers,
+        "metrics_port": options.metrics_port,
+        "max_tcp_connections": options.max_tcp_connections,
+        "tls_port": options.tls_port,
+        "tls_certfile": options.tls_cert,
+        "tls_keyfile": options.tls_key,
+        "udp_batch_size": options.udp_batch,
+        "cache_snapshot_path": options.cache_snapshot,
+    }
+
+    if options.workers:
+        from dnsserver.workers import WorkerSupervisor
+
+        print(
+            f"✅ DNS Server (UDP + TCP, asyncio) running on port {options.port} "
+            f"with {options.workers} workers"
+        )
+        WorkerSupervisor(options.workers, **engine_options).run()
+        return
+
+    print(f"✅ DNS Server (UDP + TCP, asyncio) running on port {options.port}")
+    run(**engine_options)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the DNS server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=DNS_PORT)
+    parser.add_argument(
+        "--engine",
+        choices=("asyncio", "threaded"),
+        default="asyncio",
+        help="'threaded' runs the legacy blocking server (for benchmarking)",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=MAX_WORKERS,
+        help="size of the executor running blocking ORM lookups",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="fork N worker processes sharing the port via SO_REUSEPORT "
+             "(SIGHUP restarts them; settings changes need a full restart)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="serve Prometheus metrics on this port (worker N uses port + N); 0 disables",
+    )
+    parser.add_argument(
+        "--max-tcp-connections",
+        type=int,
+        default=MAX_TCP_CONNECTIONS,
+        help="open TCP/TLS connections per process beyond which new ones are refused",
+    )
+    parser.add_argument(
+        "--tls-port",
+        type=int,
+        default=TLS_PORT,
+        help="also serve DNS over TLS on this port (needs --tls-cert); 0 disables",
+    )
+    parser.add_argument("--tls-cert", default=TLS_CERTFILE, help="PEM certificate chain")
+    parser.add_argument("--tls-key", default=TLS_KEYFILE, help="PEM private key")
+    parser.add_argument(
+        "--udp-batch",
+        type=int,
+        default=UDP_BATCH_SIZE,
+        metavar="N",
+        help="read and write up to N UDP datagrams per system call (recvmmsg/sendmmsg); 0 disables",
+    )
+    parser.add_argument(
+        "--cache-snapshot",
+        default=CACHE_SNAPSHOT_PATH,
+        metavar="PATH",
+        help="save the cache here periodically and reload it on start "
+             "(with --workers, {worker} in PATH is replaced by the worker's index, "
+             "which is otherwise appended)",
+    )
+    parser.add_argument(
+        "--upstream",
+        action="append",
+        metavar="ADDRESS[:PORT]",
+        help="upstream nameserver, overriding DNS_UPSTREAM_NAMESERVERS (repeatable)",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.upstream:
+        UPSTREAM.set_nameservers(args.upstream)
+
+    if args.engine == "threaded":
+        DNS_PORT = args.port
+        start_threaded_dns_server(args.udp_batch)
+    else:
+        start_asyncio_dns_server(args)
@@ -0,0 +1,310 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from django.conf import settings
+
+from dnsserver import threads
+from dnsserver.cache import DNS_CACHE, NEGATIVE_CACHE, clear_cache, invalidate
+from dnsserver.invalidation import LISTENER, oldest_change_id
+
+logger = logging.getLogger(__name__)
+
+CACHE_SNAPSHOT_PATH = getattr(settings, "DNS_CACHE_SNAPSHOT_PATH", None)
+CACHE_SNAPSHOT_INTERVAL = getattr(settings, "DNS_CACHE_SNAPSHOT_INTERVAL", 60)
+
+# File layout:
+#   MAGIC, change log position (HEADER)
+#   one JSON object per entry, back to back
+#   the index: per entry an INDEX_ENTRY followed by its key
+#   index offset, entry count, MAGIC (TRAILER)
+MAGIC = b"DNSSNAP2"
+HEADER = struct.Struct("<8sQ")
+INDEX_ENTRY = struct.Struct("<BdQIH")
+TRAILER = struct.Struct("<QQ8s")
+KEY_SEPARATOR = b"\0"
+
+# Entries written between yields of the GIL, so a snapshot of a large
+# cache does not hold up the threads answering queries.
+WRITE_CHUNK = 256
+
+PERSISTED_FIELDS = ("answers", "rcode", "authority", "ttl", "stored_at", "expires_at", "hits", "local")
+
+
+class WarmEntries:
+    """
+    The entries a snapshot holds for one cache, not yet decoded. Each is
+    read from the memory-mapped file and decoded the first time its key is
+    looked up (see DNSCache.attach_snapshot), so loading a snapshot costs
+    one pass over the index, and names nobody asks for again are never
+    decoded at all.
+    """
+
+    def __init__(self, data: mmap.mmap):
+        self.data = data
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def pop(self, key):
+        entry = self.index.pop(key, None)
+        if entry is None:
+            return None
+
+        discard_at, offset, length = entry
+        if time.time() > discard_at:
+            return None
+
+        item = json.loads(self.data[offset:offset + length])
+        item["discard_at"] = discard_at
+        return item
+
+    def discard(self, key):
+        return self.index.pop(key, None) is not None
+
+    def records(self) -> list:
+        """``(key, discard_at, payload)`` for every entry still waiting."""
+        return [
+            (key, discard_at, self.data[offset:offset + length])
+            for key, (discard_at, offset, length) in list(self.index.items())
+        ]
+
+
+def encode_key(key) -> bytes:
+    return KEY_SEPARATOR.join(part.encode() for part in key)
+
+
+def decode_key(raw: bytes):
+    return tuple(part.decode() for part in raw.split(KEY_SEPARATOR))
+
+
+def worker_snapshot_path(path: str, worker: int) -> str:
+    """
+    The snapshot path of worker ``worker`` under --workers: ``{worker}`` in
+    ``path`` is replaced by the worker's index, or else the index is
+    appended, so that workers never write over each other's snapshots.
+    """
+
+    if "{worker}" in path:
+        return path.format(worker=worker)
+    return f"{path}.{worker}"
+
+
+def write_snapshot(path: str, caches, change_id: int = 0) -> int:
+    """
+    Write every entry of ``caches`` that has not been discarded to ``path``,
+    replacing it atomically. Returns the number of entries written.
+    """
+
+    now = time.time()
+    entries = []
+    for kind, cache in enumerate(caches):
+        items, warm = cache.snapshot_items()
+        for key, item in items:
+            if item["discard_at"] > now:
+                entries.append((kind, key, item["discard_at"], item))
+        # Entries loaded from the last snapshot and not used since are
+        # copied over as they are.
+        if warm is not None:
+            for key, discard_at, payload in warm.records():
+                if discard_at > now:
+                    entries.append((kind, key, discard_at, payload))
+
+    index = []
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as snapshot:
+        snapshot.write(HEADER.pack(MAGIC, change_id))
+        offset = HEADER.size
+
+        for count, (kind, key, discard_at, item) in enumerate(entries, 1):
+            if isinstance(item, dict):
+                item = json.dumps(
+                    {field: item[field] for field in PERSISTED_FIELDS},
+                    separators=(",", ":"),
+                ).encode()
+            snapshot.write(item)
+            index.append((kind, discard_at, offset, len(item), encode_key(key)))
+            offset += len(item)
+            if count % WRITE_CHUNK == 0:
+                time.sleep(0)
+
+        for kind, discard_at, offset_, length, key in index:
+            snapshot.write(INDEX_ENTRY.pack(kind, discard_at, offset_, length, len(key)))
+            snapshot.write(key)
+        snapshot.write(TRAILER.pack(offset, len(index), MAGIC))
+
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+
+    os.replace(temporary, path)
+    return len(index)
+
+
+def read_snapshot(path: str, kinds: int):
+    """
+    Map ``path`` and index its entries, skipping those already discarded.
+    Returns ``(change_id, [WarmEntries per cache])``, or None when there is
+    no usable snapshot.
+    """
+
+    try:
+        with open(path, "rb") as snapshot:
+            data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        # ValueError: an empty file cannot be mapped.
+        return None
+
+    if len(data) < HEADER.size + TRAILER.size:
+        return None
+    magic, change_id = HEADER.unpack_from(data)
+    index_offset, count, end_magic = TRAILER.unpack_from(data, len(data) - TRAILER.size)
+    if magic != MAGIC or end_magic != MAGIC:
+        logger.warning("Ignoring cache snapshot %s: not a snapshot or incomplete", path)
+        return None
+
+    now = time.time()
+    warm = [WarmEntries(data) for _ in range(kinds)]
+    offset = index_offset
+    for _ in range(count):
+        kind, discard_at, entry_offset, length, key_length = INDEX_ENTRY.unpack_from(data, offset)
+        offset += INDEX_ENTRY.size
+        if discard_at > now and kind < kinds:
+            key = decode_key(data[offset:offset + key_length])
+            warm[kind].index[key] = (discard_at, entry_offset, length)
+        offset += key_length
+
+    return change_id, warm
+
+
+class CacheSnapshots:
+    """
+    Periodically saves DNS_CACHE and NEGATIVE_CACHE to ``path``, and loads
+    the last snapshot on startup so a restarted server starts with a warm
+    cache.
+
+    Entries are stored with their absolute expiry times, so their TTLs keep
+    counting down while the server is stopped; entries already past their
+    serve-stale window when loaded are dropped. Record changes made while
+    the server was down are replayed from the change log, so a snapshot
+    never brings back a local record that has since been edited; a snapshot
+    older than what the log still holds is not loaded at all.
+
+    The snapshot is written by a background thread, from a copy of the
+    cache's entry list taken under its lock.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_SNAPSHOT_PATH,
+        interval: float = CACHE_SNAPSHOT_INTERVAL,
+        caches=(DNS_CACHE, NEGATIVE_CACHE),
+    ):
+        self.path = path
+        self.interval = interval
+        self.caches = caches
+
+        self._stopped = threading.Event()
+        self._write_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def load(self) -> int:
+        if not self.enabled:
+            return 0
+
+        snapshot = read_snapshot(self.path, len(self.caches))
+        if snapshot is None:
+            return 0
+
+        change_id, warm = snapshot
+        for cache, entries in zip(self.caches, warm):
+            cache.attach_snapshot(entries)
+        if not self.replay_changes(change_id, os.path.getmtime(self.path)):
+            logger.warning(
+                "Cache snapshot %s dropped: record changes made since it was written "
+                "are no longer in the change log", self.path,
+            )
+            return 0
+
+        loaded = sum(len(entries) for entries in warm)
+        logger.info("Loaded %s cache entries from %s", loaded, self.path)
+        return loaded
+
+    @staticmethod
+    def replay_changes(change_id: int, written_at: float) -> bool:
+        """
+        Invalidate what the record changes logged after ``change_id`` touched.
+
+        The log only keeps CHANGE_LOG_RETENTION of history. When changes
+        made since the snapshot may have been pruned from it (the oldest
+        change left is not the next one, or the log is empty and the
+        snapshot is older than the retention), the caches are cleared
+        instead and False is returned.
+        """
+
+        from records.models import RecordChange
+        from records.signals import CHANGE_LOG_RETENTION
+
+        oldest = oldest_change_id()
+        if oldest is None:
+            pruned = time.time() - written_at > CHANGE_LOG_RETENTION.total_seconds()
+        else:
+            pruned = oldest > change_id + 1
+        if pruned:
+            clear_cache()
+            return False
+
+        changes = (
+            RecordChange.objects.filter(id__gt=change_id)
+            .order_by("id")
+            .values_list("domain", "record_type")
+        )
+        for domain, record_type in changes.iterator():
+            if not domain:
+                clear_cache()
+                return True
+            invalidate(domain.lower(), record_type)
+        return True
+
+    def write(self) -> int:
+        with self._write_lock:
+            started = time.perf_counter()
+            written = write_snapshot(self.path, self.caches, LISTENER.last_id)
+            logger.info(
+                "Wrote %s cache entries to %s in %.3fs",
+                written, self.path, time.perf_counter() - started,
+            )
+            return written
+
+    def ensure_started(self):
+        if self.enabled and self.interval:
+            threads.ensure_started(self, self._start)
+
+    def _start(self):
+        self._stopped = threading.Event()
+        threads.start_daemon(self._write_forever, "dns-cache-snapshot")
+
+    def stop(self):
+        """Stop the periodic writes and take a final snapshot."""
+        self._stopped.set()
+        threads.mark_stopped(self)
+        if self.enabled:
+            try:
+                self.write()
+            except OSError:
+                logger.exception("Could not write cache snapshot to %s", self.path)
+
+    def _write_forever(self):
+        stopped = self._stopped
+        while not stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                logger.exception("Could not write cache snapshot to %s", self.path)
@@ -0,0 +1,317 @@
+"""
+Stub authoritative DNS server standing in for the upstream resolvers, so
+the server can be tested and benchmarked offline against an upstream whose
+behaviour is known:
+
+    python -m dnsserver.stub --port 5300 --fixture benchmarks/fixtures/stub.json
+    python dnsserver/server.py --upstream 127.0.0.1:5300
+
+Answers come from the fixture's records. Names it does not list get a
+synthetic answer (A and AAAA addresses derived from the name, an empty
+answer with an SOA for other types) unless the fixture sets "synthesize"
+to false, in which case they are NXDOMAIN. Names whose first label starts
+with "nx" are always NXDOMAIN.
+
+Latency, jitter, packet loss, TTLs and the NXDOMAIN rate are set by the
+fixture's "defaults" or on the command line, and "rules" override them for
+names under a suffix:
+
+    {
+        "defaults": {"ttl": 300, "latency": 0.01, "jitter": 0.005},
+        "records": [
+            {"name": "www.example.com", "type": "A", "value": "192.0.2.1", "ttl": 60},
+            {"name": "alias.example.com", "type": "CNAME", "value": "www.example.com"}
+        ],
+        "rules": [
+            {"suffix": "slow.example", "latency": 2.5},
+            {"suffix": "lossy.example", "loss": 0.5},
+            {"suffix": "broken.example", "rcode": "SERVFAIL"},
+            {"suffix": "big.example", "truncate": true}
+        ]
+    }
+
+Loss and jitter come from a seeded random generator, and the NXDOMAIN rate
+picks names by hash, so a run can be repeated exactly.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rdata
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+logger = logging.getLogger(__name__)
+
+STUB_PORT = 5300
+STUB_TTL = 300
+SOA_TEXT = "ns.stub.invalid. hostmaster.stub.invalid. 1 3600 600 86400 {ttl}"
+MAX_CNAME_CHAIN = 8
+
+BEHAVIOUR = {
+    "ttl": STUB_TTL,
+    "latency": 0.0,
+    "jitter": 0.0,
+    "loss": 0.0,
+    "nxdomain_rate": 0.0,
+    "rcode": None,
+    "truncate": False,
+}
+
+
+def name_hash(name) -> bytes:
+    return hashlib.blake2b(name.to_wire().lower(), digest_size=16).digest()
+
+
+class StubResolver:
+
+    def __init__(self, fixture=None, seed: int = 0, **behaviour):
+        fixture = fixture or {}
+        unknown = set(behaviour) - set(BEHAVIOUR)
+        if unknown:
+            raise TypeError(f"Unknown stub behaviour: {', '.join(sorted(unknown))}")
+
+        self.defaults = dict(BEHAVIOUR, **fixture.get("defaults", {}))
+        self.defaults.update((k, v) for k, v in behaviour.items() if v is not None)
+        self.synthesize = fixture.get("synthesize", True)
+
+        self.rules = [
+            (dns.name.from_text(rule["suffix"]), dict(rule))
+            for rule in fixture.get("rules", [])
+        ]
+        self.records = {}
+        self.owners = set()
+        for record in fixture.get("records", []):
+            self.add_record(**record)
+
+        self.random = random.Random(seed)
+        self.queries = 0
+        self.dropped = 0
+
+    def add_record(self, name, type, value, ttl=None):
+        owner = dns.name.from_text(name)
+        rdtype = dns.rdatatype.from_text(type)
+        ttl = self.defaults["ttl"] if ttl is None else ttl
+        rrset = self.records.get((owner, rdtype))
+        if rrset is None:
+            rrset = self.records[(owner, rdtype)] = dns.rrset.RRset(owner, 1, rdtype)
+        rrset.add(dns.rdata.from_text(1, rdtype, value, origin=dns.name.root, relativize=False), ttl)
+        self.owners.add(owner)
+
+    def behaviour(self, qname) -> dict:
+        for suffix, rule in self.rules:
+            if qname.is_subdomain(suffix):
+                return dict(self.defaults, **rule)
+        return self.defaults
+
+    def delay(self, behaviour) -> float:
+        jitter = behaviour["jitter"]
+        return behaviour["latency"] + (self.random.uniform(0, jitter) if jitter else 0.0)
+
+    def answer(self, query, behaviour):
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        qname, rdtype = question.name, question.rdtype
+        ttl = behaviour["ttl"]
+
+        if behaviour["rcode"]:
+            response.set_rcode(dns.rcode.from_text(behaviour["rcode"]))
+            return response
+
+        # Follow CNAMEs within the fixture, as an authoritative server
+        # answering for all of it would.
+        name = qname
+        for _ in range(MAX_CNAME_CHAIN):
+            cname = self.records.get((name, dns.rdatatype.CNAME))
+            if cname is None or rdtype == dns.rdatatype.CNAME:
+                break
+            response.answer.append(cname)
+            name = cname[0].target
+
+        rrset = self.records.get((name, rdtype))
+        if rrset is not None:
+            response.answer.append(rrset)
+        elif name in self.owners:
+            response.authority.append(self.soa(name, ttl))
+        elif not self.synthesize or self.nxdomain(name, behaviour):
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(self.soa(name, ttl))
+        elif rdtype == dns.rdatatype.A:
+            digest = name_hash(name)
+            response.answer.append(dns.rrset.from_text(
+                name, ttl, "IN", "A", f"198.18.{digest[0]}.{digest[1]}",
+            ))
+        elif rdtype == dns.rdatatype.AAAA:
+            digest = name_hash(name).hex()
+            response.answer.append(dns.rrset.from_text(
+                name, ttl, "IN", "AAAA", f"2001:db8::{digest[:4]}:{digest[4:8]}",
+            ))
+        else:
+            response.authority.append(self.soa(name, ttl))
+
+        return response
+
+    @staticmethod
+    def nxdomain(name, behaviour) -> bool:
+        if name.labels and name.labels[0].lower().startswith(b"nx"):
+            return True
+        rate = behaviour["nxdomain_rate"]
+        # By hash rather than at random, so a name is consistently present or
+        # absent, as it would be on a real server.
+        return rate > 0 and int.from_bytes(name_hash(name)[:4], "big") < rate * 2**32
+
+    @staticmethod
+    def soa(qname, ttl):
+        zone = qname.parent() if len(qname) > 2 else qname
+        return dns.rrset.from_text(zone, ttl, "IN", "SOA", SOA_TEXT.format(ttl=ttl))
+
+    def respond(self, data: bytes, tcp: bool = False):
+        """
+        Return ``(response wire, delay)``, or None when the query is dropped
+        (malformed, or lost to the configured packet loss).
+        """
+
+        try:
+            query = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return None
+        if not query.question:
+            return None
+
+        self.queries += 1
+        behaviour = self.behaviour(query.question[0].name)
+        if behaviour["loss"] and self.random.random() < behaviour["loss"]:
+            self.dropped += 1
+            return None
+
+        if behaviour["truncate"] and not tcp:
+            return self.truncated(query), self.delay(behaviour)
+
+        response = self.answer(query, behaviour)
+        if tcp:
+            max_size = 65535
+        else:
+            max_size = max(query.payload, 512) if query.edns >= 0 else 512
+        try:
+            return response.to_wire(max_size=max_size), self.delay(behaviour)
+        except dns.exception.TooBig:
+            return self.truncated(query), self.delay(behaviour)
+
+    @staticmethod
+    def truncated(query) -> bytes:
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA | dns.flags.TC
+        return response.to_wire()
+
+
+class StubDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        answer = self.resolver.respond(data)
+        if answer is None:
+            return
+        response, delay = answer
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+
+async def handle_tcp_client(resolver, reader, writer):
+    try:
+        while True:
+            length = int.from_bytes(await reader.readexactly(2), "big")
+            answer = resolver.respond(await reader.readexactly(length), tcp=True)
+            if answer is None:
+                break
+            response, delay = answer
+            if delay:
+                await asyncio.sleep(delay)
+            writer.write(len(response).to_bytes(2, "big") + response)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start(resolver, host: str = "127.0.0.1", port: int = STUB_PORT):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: StubDatagramProtocol(resolver),
+        local_addr=(host, port),
+    )
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_tcp_client(resolver, reader, writer),
+        host,
+        port,
+    )
+    return transport, server
+
+
+async def serve(resolver, host, port):
+    await start(resolver, host, port)
+    logger.info("Stub upstream listening on %s:%s", host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        logger.info("Stub answered %s queries, dropped %s", resolver.queries, resolver.dropped)
+
+
+def load_fixture(path):
+    if not path:
+        return None
+    with open(path) as fixture:
+        return json.load(fixture)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stub upstream DNS server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=STUB_PORT)
+    parser.add_argument("--fixture", help="JSON file with records, defaults and rules")
+    parser.add_argument("--latency", type=float, help="seconds before each answer")
+    parser.add_argument("--jitter", type=float, help="extra random delay, up to this many seconds")
+    parser.add_argument("--loss", type=float, help="fraction of queries silently dropped")
+    parser.add_argument("--nxdomain-rate", type=float,
+                        help="fraction of synthetic names that do not exist")
+    parser.add_argument("--ttl", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    resolver = StubResolver(
+        load_fixture(args.fixture),
+        seed=args.seed,
+        latency=args.latency,
+        jitter=args.jitter,
+        loss=args.loss,
+        nxdomain_rate=args.nxdomain_rate,
+        ttl=args.ttl,
+    )
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(resolver, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1133 @@
+import asyncio
+import functools
+import logging
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
+
+import dns.asyncquery
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+
+from dnsserver import workers
+from dnsserver.cache import (
+    DNS_CACHE,
+    NEGATIVE_CACHE,
+    PREFETCH_MIN_HITS,
+    SERVE_STALE_TTL,
+    SERVE_STALE_WINDOW,
+    DNSCache,
+    clear_cache,
+    get_cache_entry,
+    set_cache,
+    set_negative_cache,
+)
+from dnsserver.engine import DNSServerEngine
+from dnsserver.handler import handle_query
+from dnsserver.invalidation import LISTENER, latest_change_id
+from dnsserver.logs import BackgroundHandler, dropped_records
+from dnsserver.metrics import CONTENT_TYPE, REGISTRY, TCP_REJECTED, Counter, Histogram
+from dnsserver.response_builder import (
+    EDNS_UDP_PAYLOAD,
+    MIN_UDP_PAYLOAD,
+    badvers_response,
+    build_dns_response,
+    build_response_template,
+    render_template,
+    template_key,
+    truncate_response,
+    udp_payload_size,
+)
+from dnsserver.snapshot import CacheSnapshots
+from dnsserver.stub import StubDatagramProtocol, StubResolver, load_fixture, start
+from dnsserver.stub import handle_tcp_client as stub_tcp_client
+from dnsserver.udpbatch import (
+    MMSG_AVAILABLE,
+    DatagramBatcher,
+    decode_sockaddr,
+    encode_sockaddr,
+)
+from dnsserver.upstream import FAILURE_BACKOFF, MAX_FAILURE_BACKOFF, UpstreamResolver
+from dnsserver.zone_index import LOCAL_NEGATIVE_TTL, ZONE_INDEX, ZoneIndex
+from records.models import DNSRecord, RecordChange
+from records.signals import CHANGE_LOG_RETENTION, log_record_changes
+
+
+def answer_data(answers):
+    return [ans["data"] for ans in answers]
+
+
+def a_record(name, address="192.0.2.1", ttl=300):
+    return {"name": name, "type": 1, "TTL": ttl, "data": address}
+
+
+class DNSCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1_000_000.0
+        patcher = mock.patch("dnsserver.cache.time")
+        patcher.start().time.side_effect = lambda: self.now
+        self.addCleanup(patcher.stop)
+
+    def cache(self, **options):
+        return DNSCache(sweep_interval=0, **options)
+
+    def test_evicts_least_recently_used(self):
+        cache = self.cache(max_entries=2)
+        cache.set(("a.test", "A"), [a_record("a.test")], 300)
+        cache.set(("b.test", "A"), [a_record("b.test")], 300)
+        cache.get(("a.test", "A"))
+        cache.set(("c.test", "A"), [a_record("c.test")], 300)
+
+        self.assertIsNotNone(cache.get(("a.test", "A")))
+        self.assertIsNone(cache.get(("b.test", "A")))
+        self.assertIsNotNone(cache.get(("c.test", "A")))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_evicts_by_size(self):
+        cache = self.cache(max_bytes=2000)
+        for name in ("a.test", "b.test", "c.test"):
+            cache.set((name, "A"), [a_record(name)], 300)
+
+        self.assertLessEqual(cache.bytes, 2000)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(("a.test", "A")))
+
+    def test_entries_expire_then_serve_stale_until_discarded(self):
+        cache = self.cache(stale_window=100)
+        key = ("a.test", "A")
+        cache.set(key, [a_record("a.test")], 60)
+
+        self.now += 59
+        self.assertIsNotNone(cache.get(key))
+
+        self.now += 2
+        self.assertIsNone(cache.get(key))
+        self.assertIsNotNone(cache.get_stale(key))
+
+        self.now += 100
+        self.assertIsNone(cache.get_stale(key))
+        self.assertEqual(cache.purge_expired(), 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_purge_skips_keys_set_again(self):
+        cache = self.cache(stale_window=0)
+        key = ("a.test", "A")
+        cache.set(key, [a_record("a.test")], 10)
+        self.now += 5
+        cache.set(key, [a_record("a.test")], 10)
+
+        self.now += 6
+        self.assertEqual(cache.purge_expired(), 0)
+        self.assertIsNotNone(cache.get(key))
+
+
+class CacheLookupTests(SimpleTestCase):
+    def setUp(self):
+        clear_cache()
+        self.addCleanup(clear_cache)
+
+    def lookup_stats(self):
+        stats = DNS_CACHE.stats(), NEGATIVE_CACHE.stats()
+        return sum(s["hits"] for s in stats), sum(s["misses"] for s in stats)
+
+    def test_each_lookup_counts_one_hit_or_miss(self):
+        set_cache("a.test", "A", [a_record("a.test")])
+        soa = {"name": "test", "type": 6, "TTL": 300,
+               "data": "ns.test hostmaster.test 1 3600 600 86400 300"}
+        set_negative_cache("b.test", "A", 3, [soa])
+        hits, misses = self.lookup_stats()
+
+        self.assertIsNotNone(get_cache_entry("a.test", "A"))
+        self.assertIsNotNone(get_cache_entry("b.test", "A"))
+        self.assertIsNone(get_cache_entry("c.test", "A"))
+
+        self.assertEqual(self.lookup_stats(), (hits + 2, misses + 1))
+
+
+def make_query(name, record_type, edns=True, rd=True):
+    query = dns.message.make_query(name, record_type, use_edns=0 if edns else None)
+    if not rd:
+        query.flags &= ~dns.flags.RD
+    return query
+
+
+def with_elapsed(records, elapsed):
+    return [dict(ans, TTL=max(ans["TTL"] - elapsed, 0)) for ans in records]
+
+
+class ResponseTemplateTests(SimpleTestCase):
+    ANSWERS = {
+        "A": [a_record("www.example.test", f"192.0.2.{i}", ttl=300) for i in (1, 2)],
+        "MX": [
+            {"name": "www.example.test", "type": 15, "TTL": 3600, "data": "10 mail.example.test"},
+            {"name": "www.example.test", "type": 15, "TTL": 60, "data": "20 backup.example.net"},
+        ],
+        "TXT": [{"name": "www.example.test", "type": 16, "TTL": 120, "data": "v=spf1 -all"}],
+        "CNAME": [
+            {"name": "www.example.test", "type": 5, "TTL": 30, "data": "host.example.net"},
+        ],
+    }
+    SOA = [{
+        "name": "example.test", "type": 6, "TTL": 300,
+        "data": "ns.example.test hostmaster.example.test 1 3600 600 86400 300",
+    }]
+
+    def assert_identical(self, record_type, answers, rcode=dns.rcode.NOERROR, authority=()):
+        for edns in (False, True):
+            seed = make_query("www.example.test", record_type, edns)
+            template = build_response_template(seed, answers, rcode, authority)
+
+            for name in ("www.example.test", "WwW.Example.TEST"):
+                for rd in (True, False):
+                    for elapsed in (0, 1, 299, 5000):
+                        with self.subTest(edns=edns, name=name, rd=rd, elapsed=elapsed):
+                            query = make_query(name, record_type, edns, rd)
+                            self.assertEqual(template_key(query), template_key(seed))
+                            self.assertEqual(
+                                render_template(template, query, elapsed),
+                                build_dns_response(
+                                    query,
+                                    with_elapsed(answers, elapsed),
+                                    rcode,
+                                    with_elapsed(authority, elapsed),
+                                ),
+                            )
+
+    def test_answers_render_byte_identical(self):
+        for record_type, answers in self.ANSWERS.items():
+            with self.subTest(record_type=record_type):
+                self.assert_identical(record_type, answers)
+
+    def test_negative_answers_render_byte_identical(self):
+        self.assert_identical("A", [], dns.rcode.NXDOMAIN, self.SOA)
+        self.assert_identical("AAAA", [], dns.rcode.NOERROR, self.SOA)
+
+    def test_other_names_are_not_rendered(self):
+        template = build_response_template(make_query("www.example.test", "A"), self.ANSWERS["A"])
+        self.assertIsNone(render_template(template, make_query("ww.example.test", "A")))
+
+    def test_template_key(self):
+        self.assertIs(template_key(make_query("www.example.test", "A", edns=False)), False)
+        self.assertIs(template_key(make_query("www.example.test", "A")), True)
+
+        padded = dns.message.make_query("www.example.test", "A", use_edns=0, pad=128)
+        self.assertIsNone(template_key(dns.message.from_wire(padded.to_wire())))
+
+        # The template would echo class IN back to these.
+        for rdclass in ("CH", "ANY"):
+            query = dns.message.make_query("www.example.test", "A", rdclass=rdclass)
+            self.assertIsNone(template_key(query))
+
+
+class ZoneIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for domain, record_type, value in (
+            ("example.test", "NS", "ns1.example.test"),
+            ("www.example.test", "A", "192.0.2.1"),
+            ("host.deep.example.test", "A", "192.0.2.2"),
+            ("*.wild.example.test", "A", "192.0.2.3"),
+            ("*.alias.example.test", "CNAME", "www.example.test"),
+            ("other.test", "A", "192.0.2.4"),
+        ):
+            DNSRecord.objects.create(domain=domain, record_type=record_type, value=value)
+
+    def setUp(self):
+        self.index = ZoneIndex()
+        self.index.load()
+
+    def assert_negative(self, result, status):
+        answers, rcode, authority = result
+        self.assertEqual((answers, rcode), ([], status))
+        self.assertEqual([(soa["name"], soa["type"], soa["TTL"]) for soa in authority],
+                         [("example.test", 6, LOCAL_NEGATIVE_TTL)])
+        self.assertTrue(authority[0]["data"].startswith("ns1.example.test hostmaster.example.test"))
+
+    def test_exact_match(self):
+        self.assertEqual(
+            self.index.resolve("WWW.example.test", "A"),
+            ([a_record("WWW.example.test", ttl=300)], 0, []),
+        )
+
+    def test_wildcard(self):
+        self.assertEqual(
+            self.index.resolve("a.wild.example.test", "A"),
+            ([a_record("a.wild.example.test", "192.0.2.3")], 0, []),
+        )
+        answers, status, _ = self.index.resolve("x.alias.example.test", "AAAA")
+        self.assertEqual((answers[0]["name"], answers[0]["data"], status),
+                         ("x.alias.example.test", "www.example.test", 0))
+
+    def test_wildcard_without_the_type_is_nodata(self):
+        self.assert_negative(self.index.resolve("a.wild.example.test", "TXT"), 0)
+
+    def test_nodata(self):
+        self.assert_negative(self.index.resolve("www.example.test", "AAAA"), 0)
+        # An empty non-terminal exists too.
+        self.assert_negative(self.index.resolve("deep.example.test", "A"), 0)
+
+    def test_nxdomain(self):
+        self.assert_negative(self.index.resolve("missing.example.test", "A"), 3)
+        self.assert_negative(self.index.resolve("a.b.deep.example.test", "A"), 3)
+
+    def test_names_outside_our_zones_go_upstream(self):
+        self.assertIsNone(self.index.resolve("www.example.com", "A"))
+        # Records without an NS at or above them answer only exact matches.
+        self.assertIsNone(self.index.resolve("missing.other.test", "A"))
+
+    def test_names_under_a_delegation_go_upstream(self):
+        DNSRecord.objects.create(domain="child.example.test", record_type="NS",
+                                 value="ns.example.net")
+        self.index.load()
+
+        self.assertEqual(answer_data(self.index.resolve("child.example.test", "NS")[0]),
+                         ["ns.example.net"])
+        self.assertIsNone(self.index.resolve("child.example.test", "A"))
+        self.assertIsNone(self.index.resolve("www.child.example.test", "A"))
+        self.assert_negative(self.index.resolve("other.example.test", "A"), 3)
+
+        # Unless we host the child zone too.
+        with mock.patch("dnsserver.zone_index.AUTHORITATIVE_ZONES", ["child.example.test"]):
+            self.index.load()
+        answers, status, authority = self.index.resolve("www.child.example.test", "A")
+        self.assertEqual((answers, status, authority[0]["name"]), ([], 3, "child.example.test"))
+
+    def test_changes_update_the_trie(self):
+        self.index.upsert(999, "new.example.test", "A", "192.0.2.9", 60, None)
+        self.assertEqual(self.index.resolve("new.example.test", "A")[0][0]["data"], "192.0.2.9")
+
+        self.index.remove(999, "new.example.test", "A")
+        self.assert_negative(self.index.resolve("new.example.test", "A"), 3)
+
+
+class LocalZoneTestCase(TestCase):
+    """
+    Loads the zone index and follows the change log by hand (poll()), rather
+    than from the listener's background thread.
+    """
+
+    def setUp(self):
+        clear_cache()
+        ZONE_INDEX.load()
+        LISTENER.last_id = latest_change_id()
+        patcher = mock.patch.object(LISTENER, "ensure_started")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(clear_cache)
+
+    def upstream(self, response):
+        patcher = mock.patch("dnsserver.handler.query_upstream_dns", return_value=response)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def upstream_async(self, response):
+        patcher = mock.patch(
+            "dnsserver.handler.query_upstream_dns_async", new=mock.AsyncMock(return_value=response)
+        )
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+
+class RecordChangeTests(LocalZoneTestCase):
+    def logged_keys(self):
+        return list(
+            RecordChange.objects.order_by("id").values_list("domain", "record_type")
+        )
+
+    def assert_renames(self, record):
+        RecordChange.objects.all().delete()
+        record.domain = "new.example.test"
+        record.save()
+
+        self.assertEqual(self.logged_keys(),
+                         [("old.example.test", "A"), ("new.example.test", "A")])
+        self.assertIsNone(ZONE_INDEX.resolve("old.example.test", "A"))
+        self.assertEqual(answer_data(ZONE_INDEX.resolve("new.example.test", "A")[0]),
+                         ["192.0.2.1"])
+
+        RecordChange.objects.all().delete()
+        record.delete()
+        self.assertEqual(self.logged_keys(), [("new.example.test", "A")])
+        self.assertIsNone(ZONE_INDEX.resolve("new.example.test", "A"))
+
+    def create_record(self):
+        # The default record_type is a RecordType member, not a plain str.
+        return DNSRecord.objects.create(domain="old.example.test", value="192.0.2.1")
+
+    def test_rename_of_a_loaded_record(self):
+        self.assert_renames(DNSRecord.objects.get(pk=self.create_record().pk))
+
+    def test_rename_of_a_created_record(self):
+        self.assert_renames(self.create_record())
+
+
+class CNAMEChainTests(LocalZoneTestCase):
+    def setUp(self):
+        DNSRecord.objects.create(domain="alias.test", record_type="CNAME", value="target.test")
+        self.target = DNSRecord.objects.create(domain="target.test", record_type="A", value="1.1.1.1")
+        super().setUp()
+
+    def test_local_chain_is_flattened(self):
+        self.assertEqual(
+            answer_data(handle_query("alias.test", "A")), ["target.test", "1.1.1.1"]
+        )
+
+    def test_chain_through_cached_local_record_follows_its_changes(self):
+        handle_query("target.test", "A")
+        handle_query("alias.test", "A")
+
+        self.target.value = "2.2.2.2"
+        self.target.save()
+        LISTENER.poll()
+
+        self.assertEqual(answer_data(handle_query("target.test", "A")), ["2.2.2.2"])
+        self.assertEqual(
+            answer_data(handle_query("alias.test", "A")), ["target.test", "2.2.2.2"]
+        )
+
+    def test_chain_to_upstream_is_cached_until_the_cname_changes(self):
+        cname = DNSRecord.objects.create(
+            domain="www.alias.test", record_type="CNAME", value="www.example.com"
+        )
+        LISTENER.poll()
+        upstream = self.upstream({
+            "Status": 0,
+            "Answer": [{"name": "www.example.com", "type": 1, "TTL": 300, "data": "192.0.2.1"}],
+        })
+
+        handle_query("www.alias.test", "A")
+        handle_query("www.alias.test", "A")
+        self.assertEqual(upstream.call_count, 1)
+        self.assertIsNotNone(DNS_CACHE.get(("www.alias.test", "A")))
+
+        cname.delete()
+        LISTENER.poll()
+        self.assertIsNone(DNS_CACHE.get(("www.alias.test", "A")))
+
+
+class ServeStaleTests(LocalZoneTestCase):
+    def setUp(self):
+        super().setUp()
+        # The cache's sweeper thread sleeps through the same module.
+        patcher = mock.patch("dnsserver.cache.time", wraps=time)
+        self.clock = patcher.start()
+        self.clock.time.return_value = 1_000_000.0
+        self.addCleanup(patcher.stop)
+
+    def test_expired_answer_is_served_when_upstream_fails(self):
+        set_cache("www.example.com", "A", [a_record("www.example.com", ttl=60)])
+
+        self.clock.time.return_value += 120
+        self.upstream({"Status": 2, "Comment": "Upstream DNS timeout"})
+        answers = handle_query("www.example.com", "A")
+
+        self.assertEqual(answers, [a_record("www.example.com", ttl=SERVE_STALE_TTL)])
+
+    def test_hot_entry_is_refreshed_once_before_it_expires(self):
+        set_cache("www.example.com", "A", [a_record("www.example.com", ttl=100)])
+        upstream = self.upstream({
+            "Status": 0, "Answer": [a_record("www.example.com", "192.0.2.2", ttl=100)],
+        })
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+
+        with mock.patch("dnsserver.handler.PREFETCH_EXECUTOR", executor):
+            for _ in range(PREFETCH_MIN_HITS):
+                handle_query("www.example.com", "A")
+            self.clock.time.return_value += 95
+            self.assertEqual(handle_query("www.example.com", "A"),
+                             [a_record("www.example.com", ttl=5)])
+            handle_query("www.example.com", "A")
+            handle_query("www.example.com", "A")
+        executor.shutdown(wait=True)
+
+        self.assertEqual(upstream.call_count, 1)
+        self.assertEqual(handle_query("www.example.com", "A"),
+                         [a_record("www.example.com", "192.0.2.2", ttl=100)])
+
+
+class BlockingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.emitting = threading.Event()
+        self.unblock = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.emitting.set()
+        self.unblock.wait(5)
+        self.messages.append(record.getMessage())
+
+
+class BackgroundHandlerTests(SimpleTestCase):
+    def test_full_queue_drops_and_counts_records(self):
+        target = BlockingHandler()
+        handler = BackgroundHandler(target, queue_size=1)
+        self.addCleanup(handler.close)
+        self.addCleanup(target.unblock.set)
+        logger = logging.getLogger("dnsserver.tests.background")
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        dropped = dropped_records()
+
+        logger.warning("first")
+        self.assertTrue(target.emitting.wait(5))
+        logger.warning("queued")
+        logger.info("dropped")
+        with mock.patch("dnsserver.logs.LOG_QUEUE_TIMEOUT", 0.01):
+            logger.error("dropped after waiting")
+
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual(dropped_records(), dropped + 2)
+        self.assertIn(f"dns_log_dropped_total {dropped + 2}\n", REGISTRY.render())
+
+        target.unblock.set()
+        handler.close()
+        self.assertEqual(target.messages, ["first", "queued"])
+
+
+class MetricsTests(SimpleTestCase):
+    def in_thread(self, func):
+        thread = threading.Thread(target=func)
+        thread.start()
+        thread.join()
+
+    def test_counter_sums_every_thread(self):
+        counter = Counter("test_total", "Test counter.", labels=("kind", "type"))
+        counter.inc("a", "A")
+        counter.inc("a", "A", amount=2)
+        self.in_thread(lambda: counter.inc("a", "A"))
+        self.in_thread(lambda: counter.inc("b", "MX"))
+
+        self.assertEqual(counter.render(), [
+            "# HELP test_total Test counter.",
+            "# TYPE test_total counter",
+            'test_total{kind="a",type="A"} 4',
+            'test_total{kind="b",type="MX"} 1',
+        ])
+
+        counter.reset()
+        self.assertEqual(len(counter.render()), 2)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("test_seconds", "Test histogram.", labels=("stage",),
+                              buckets=(0.1, 1.0))
+        histogram.observe(0.05, "parse")
+        self.in_thread(lambda: histogram.observe(0.5, "parse"))
+        histogram.observe(0.1, "parse")
+        histogram.observe(3.0, "parse")
+
+        self.assertEqual(histogram.render(), [
+            "# HELP test_seconds Test histogram.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{stage="parse",le="0.1"} 2',
+            'test_seconds_bucket{stage="parse",le="1.0"} 3',
+            'test_seconds_bucket{stage="parse",le="+Inf"} 4',
+            'test_seconds_sum{stage="parse"} 3.650000',
+            'test_seconds_count{stage="parse"} 4',
+        ])
+
+    def test_metrics_view(self):
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], CONTENT_TYPE)
+        body = response.content.decode()
+        for line in (
+            "# TYPE dns_queries_total counter",
+            "# TYPE dns_query_duration_seconds histogram",
+            "# TYPE dns_cache_entries gauge",
+            'dns_cache_hits_total{cache="positive"} ',
+            "process_resident_memory_bytes ",
+        ):
+            self.assertIn(line, body)
+
+
+class StubResolverTests(SimpleTestCase):
+    def setUp(self):
+        fixture = load_fixture(settings.BASE_DIR / "benchmarks" / "fixtures" / "stub.json")
+        self.stub = StubResolver(fixture)
+
+    def respond(self, name, record_type="A", tcp=False):
+        query = dns.message.make_query(name, record_type)
+        wire, delay = self.stub.respond(query.to_wire(), tcp)
+        return dns.message.from_wire(wire), delay
+
+    def test_fixture_records(self):
+        response, delay = self.respond("www.example.com")
+        self.assertEqual(response.answer[0].to_text(), "www.example.com. 60 IN A 192.0.2.1")
+        self.assertTrue(0.005 <= delay <= 0.007)
+
+        response, _ = self.respond("cdn.example.com")
+        self.assertEqual([rrset.to_text() for rrset in response.answer], [
+            "cdn.example.com. 300 IN CNAME edge.cdn.example.net.",
+            "edge.cdn.example.net. 20 IN A 198.51.100.7",
+        ])
+
+        response, _ = self.respond("www.example.com", "TXT")
+        self.assertEqual((response.rcode(), response.answer), (dns.rcode.NOERROR, []))
+        self.assertEqual(response.authority[0].rdtype, dns.rdatatype.SOA)
+
+    def test_nxdomain_and_synthetic_names(self):
+        response, _ = self.respond("nx1.example.org")
+        self.assertEqual(response.rcode(), dns.rcode.NXDOMAIN)
+        self.assertEqual(response.authority[0].rdtype, dns.rdatatype.SOA)
+
+        # The same address every time, derived from the name.
+        first, second = (self.respond("host.example.org")[0].answer[0][0] for _ in range(2))
+        self.assertEqual(first, second)
+        self.assertTrue(first.address.startswith("198.18."))
+
+        self.stub.synthesize = False
+        self.assertEqual(self.respond("host.example.org")[0].rcode(), dns.rcode.NXDOMAIN)
+
+    def test_rules(self):
+        self.assertGreaterEqual(self.respond("a.slow.example")[1], 2.5)
+        self.assertEqual(self.respond("a.broken.example")[0].rcode(), dns.rcode.SERVFAIL)
+        self.assertTrue(self.respond("a.big.example")[0].flags & dns.flags.TC)
+        self.assertFalse(self.respond("a.big.example", tcp=True)[0].flags & dns.flags.TC)
+
+        query = dns.message.make_query("a.lossy.example", "A").to_wire()
+        answered = sum(self.stub.respond(query) is not None for _ in range(200))
+        self.assertEqual(self.stub.dropped, 200 - answered)
+        self.assertTrue(50 < answered < 150)
+
+    async def test_answers_over_udp_after_the_delay(self):
+        self.stub.defaults["latency"] = self.stub.defaults["jitter"] = 0
+        self.stub.rules.append((dns.name.from_text("delayed.example"), {"latency": 0.05}))
+        transport, server = await start(self.stub, port=0)
+        address = transport.get_extra_info("sockname")
+
+        try:
+            for name, min_delay in (("www.example.com", 0), ("a.delayed.example", 0.05)):
+                started = time.monotonic()
+                response = await dns.asyncquery.udp(
+                    dns.message.make_query(name, "A"), address[0], port=address[1], timeout=2
+                )
+                self.assertGreaterEqual(time.monotonic() - started, min_delay)
+                self.assertEqual(len(response.answer), 1)
+        finally:
+            transport.close()
+            server.close()
+
+
+class TruncationTests(SimpleTestCase):
+    ANSWERS = [
+        {"name": "big.example.test", "type": "TXT", "TTL": 300, "data": f'"{i:02d}{"x" * 60}"'}
+        for i in range(40)
+    ]
+
+    def response(self, query):
+        return build_dns_response(query, self.ANSWERS)
+
+    def test_udp_payload_size(self):
+        self.assertEqual(udp_payload_size(make_query("a.test", "A", edns=False)), MIN_UDP_PAYLOAD)
+        for advertised, size in ((4096, EDNS_UDP_PAYLOAD), (1000, 1000), (100, MIN_UDP_PAYLOAD)):
+            with self.subTest(advertised=advertised):
+                query = dns.message.make_query("a.test", "A", use_edns=0, payload=advertised)
+                self.assertEqual(udp_payload_size(query), size)
+
+    def test_answers_that_fit_are_untouched(self):
+        query = make_query("big.example.test", "TXT")
+        wire = build_dns_response(query, self.ANSWERS[:2])
+        self.assertIs(truncate_response(wire, udp_payload_size(query)), wire)
+
+    def test_truncation_without_edns(self):
+        query = make_query("big.example.test", "TXT", edns=False)
+        wire = truncate_response(self.response(query), udp_payload_size(query))
+
+        self.assertLessEqual(len(wire), MIN_UDP_PAYLOAD)
+        response = dns.message.from_wire(wire)
+        self.assertTrue(response.flags & dns.flags.TC)
+        self.assertEqual((response.id, response.question), (query.id, query.question))
+        self.assertEqual((response.answer, response.edns), ([], -1))
+
+    def test_truncation_keeps_the_opt_record(self):
+        query = dns.message.make_query("big.example.test", "TXT", use_edns=0, payload=1000)
+        full = self.response(query)
+        self.assertGreater(len(full), 1000)
+        wire = truncate_response(full, udp_payload_size(query))
+
+        response = dns.message.from_wire(wire)
+        self.assertTrue(response.flags & dns.flags.TC)
+        self.assertEqual(response.answer, [])
+        self.assertEqual((response.edns, response.payload), (0, EDNS_UDP_PAYLOAD))
+
+    def test_badvers(self):
+        self.assertIsNone(badvers_response(make_query("a.test", "A")))
+        self.assertIsNone(badvers_response(make_query("a.test", "A", edns=False)))
+
+        query = dns.message.make_query("a.test", "A", use_edns=1)
+        response = dns.message.from_wire(badvers_response(query))
+        self.assertEqual((response.id, response.rcode()), (query.id, dns.rcode.BADVERS))
+        self.assertEqual(response.edns, 0)
+
+
+class UpstreamResolverTests(SimpleTestCase):
+    def setUp(self):
+        self.servers = []
+
+    def test_ranking_and_backoff(self):
+        resolver = UpstreamResolver(["192.0.2.1", "192.0.2.2:5353", "[2001:db8::3]:53"])
+        fast, slow, unmeasured = resolver.nameservers
+        self.assertEqual((slow.port, unmeasured.address), (5353, "2001:db8::3"))
+
+        slow.record_success(0.2)
+        fast.record_success(0.01)
+        self.assertEqual(resolver.ordered_nameservers(), [unmeasured, fast, slow])
+
+        backoffs = ((1, FAILURE_BACKOFF), (2, 2 * FAILURE_BACKOFF), (10, MAX_FAILURE_BACKOFF))
+        for failures, backoff in backoffs:
+            while fast.consecutive_failures < failures:
+                fast.record_failure(timeout=True)
+            self.assertAlmostEqual(fast.failed_until - time.monotonic(), backoff, delta=1)
+        self.assertEqual(resolver.ordered_nameservers(), [unmeasured, slow, fast])
+
+        fast.record_success(0.01)
+        self.assertEqual((fast.consecutive_failures, fast.failed_until), (0, 0.0))
+        self.assertEqual(fast.as_dict()["timeouts"], 10)
+
+    def test_blocking_lookups_are_coalesced(self):
+        resolver = UpstreamResolver([])
+        started = threading.Event()
+        finish = threading.Event()
+
+        def resolve(domain, record_type):
+            started.set()
+            finish.wait(5)
+            return {"Status": 0, "Answer": []}
+
+        with mock.patch.object(resolver, "_resolve", side_effect=resolve) as upstream:
+            with ThreadPoolExecutor(4) as pool:
+                leader = pool.submit(resolver.query, "www.example.com", "A")
+                started.wait(5)
+                followers = [pool.submit(resolver.query, "WWW.example.com", "A") for _ in range(3)]
+                while resolver.coalesced < 3:
+                    time.sleep(0.01)
+                finish.set()
+                results = [future.result() for future in [leader, *followers]]
+
+        self.assertEqual(upstream.call_count, 1)
+        self.assertEqual(results, [{"Status": 0, "Answer": []}] * 4)
+
+    async def serve(self, stub):
+        # UDP and TCP on the same port, so a truncated answer can be retried.
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: StubDatagramProtocol(stub), local_addr=("127.0.0.1", 0)
+        )
+        address = transport.get_extra_info("sockname")
+        server = await asyncio.start_server(
+            lambda reader, writer: stub_tcp_client(stub, reader, writer), *address
+        )
+        self.servers.extend((transport, server))
+        return f"{address[0]}:{address[1]}"
+
+    async def resolver(self, *stubs):
+        return UpstreamResolver([await self.serve(stub) for stub in stubs], timeout=1, lifetime=2)
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+        # Let the stub's TCP handlers see the client hang up.
+        handlers = asyncio.all_tasks() - {asyncio.current_task()}
+        if handlers:
+            await asyncio.wait(handlers, timeout=1)
+
+    async def test_concurrent_lookups_send_one_query(self):
+        stub = StubResolver(latency=0.05)
+        try:
+            resolver = await self.resolver(stub)
+            results = await asyncio.gather(
+                *(resolver.query_async("www.example.com", "A") for _ in range(5))
+            )
+        finally:
+            await self.close()
+
+        self.assertEqual((stub.queries, resolver.coalesced), (1, 4))
+        self.assertEqual(len({result["Answer"][0]["data"] for result in results}), 1)
+
+    async def test_failover_to_the_next_nameserver(self):
+        broken, working = StubResolver(rcode="SERVFAIL"), StubResolver()
+        try:
+            resolver = await self.resolver(broken, working)
+            first = await resolver.query_async("a.example.com", "A")
+            second = await resolver.query_async("b.example.com", "A")
+        finally:
+            await self.close()
+
+        self.assertEqual((first["Status"], second["Status"]), (0, 0))
+        # The broken server is backed off after its failure, so the second
+        # lookup goes straight to the working one.
+        self.assertEqual((broken.queries, working.queries), (1, 2))
+        stats = resolver.stats()["nameservers"]
+        self.assertEqual([(ns["errors"], ns["healthy"]) for ns in stats], [(1, False), (0, True)])
+
+    async def test_every_nameserver_failing(self):
+        try:
+            resolver = await self.resolver(
+                StubResolver(rcode="REFUSED"), StubResolver(rcode="SERVFAIL")
+            )
+            result = await resolver.query_async("a.example.com", "A")
+        finally:
+            await self.close()
+
+        self.assertEqual(result, {"Status": 2, "Comment": "Upstream DNS error: SERVFAIL"})
+
+    async def test_truncated_answers_are_retried_over_tcp(self):
+        stub = StubResolver({"rules": [{"suffix": "big.example", "truncate": True}]})
+        try:
+            resolver = await self.resolver(stub)
+            result = await resolver.query_async("a.big.example", "A")
+        finally:
+            await self.close()
+
+        self.assertEqual(stub.queries, 2)
+        self.assertEqual((result["Status"], len(result["Answer"])), (0, 1))
+
+
+class EngineTCPTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = DNSServerEngine(
+            host="127.0.0.1", port=0, max_tcp_connections=2, tcp_idle_timeout=0.2,
+            cache_snapshot_path=None,
+        )
+        self.addCleanup(self.engine.executor.shutdown)
+        self.delays = {}
+        self.resolving = 0
+
+    async def resolve(self, data, started, udp=False):
+        query = dns.message.from_wire(data)
+        self.resolving += 1
+        await asyncio.sleep(self.delays.get(query.question[0].name.labels[0], 0))
+        return dns.message.make_response(query).to_wire()
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(*self.address)
+        self.writers.append(writer)
+        return reader, writer
+
+    async def serve(self, test):
+        self.writers = []
+        with mock.patch.object(self.engine, "resolve", self.resolve):
+            server = await asyncio.start_server(self.engine.handle_tcp_client, "127.0.0.1", 0)
+            self.address = server.sockets[0].getsockname()
+            try:
+                await asyncio.wait_for(test(), 5)
+            finally:
+                for writer in self.writers:
+                    writer.close()
+                server.close()
+                await asyncio.sleep(0.01)
+
+    @staticmethod
+    def send(writer, name):
+        query = dns.message.make_query(name, "A")
+        wire = query.to_wire()
+        writer.write(len(wire).to_bytes(2, "big") + wire)
+        return query.id
+
+    @staticmethod
+    async def answer(reader):
+        length = int.from_bytes(await reader.readexactly(2), "big")
+        return dns.message.from_wire(await reader.readexactly(length)).id
+
+    async def test_pipelined_queries_are_answered_as_they_finish(self):
+        self.delays[b"slow"] = 0.1
+
+        async def test():
+            reader, writer = await self.connect()
+            slow = self.send(writer, "slow.example.test")
+            fast = self.send(writer, "fast.example.test")
+            self.assertEqual([await self.answer(reader) for _ in range(2)], [fast, slow])
+            # The connection stays open for more.
+            query = self.send(writer, "again.example.test")
+            self.assertEqual(await self.answer(reader), query)
+
+        await self.serve(test)
+
+    async def test_pipeline_depth_is_limited(self):
+        self.delays[b"slow"] = 0.1
+
+        async def test():
+            reader, writer = await self.connect()
+            sent = [self.send(writer, "slow.example.test") for _ in range(3)]
+            await asyncio.sleep(0.05)
+            self.assertEqual(self.resolving, 2)
+            self.assertEqual(sorted([await self.answer(reader) for _ in sent]), sorted(sent))
+
+        with mock.patch("dnsserver.engine.MAX_TCP_PIPELINE", 2):
+            await self.serve(test)
+
+    async def test_idle_connections_are_closed(self):
+        self.delays[b"slow"] = 0.5
+
+        async def test():
+            reader, _ = await self.connect()
+            started = time.monotonic()
+            self.assertEqual(await reader.read(), b"")
+            self.assertGreaterEqual(time.monotonic() - started, 0.15)
+
+            # An answer still in flight keeps the connection open past the
+            # idle timeout.
+            reader, writer = await self.connect()
+            query = self.send(writer, "slow.example.test")
+            self.assertEqual(await self.answer(reader), query)
+            self.assertEqual(await reader.read(), b"")
+
+        await self.serve(test)
+
+    async def test_connection_limit(self):
+        rejected = TCP_REJECTED.values().get((), 0)
+
+        async def test():
+            for _ in range(2):
+                reader, writer = await self.connect()
+                query = self.send(writer, "www.example.test")
+                self.assertEqual(await self.answer(reader), query)
+
+            reader, _ = await self.connect()
+            self.assertEqual(await reader.read(), b"")
+            self.assertEqual(TCP_REJECTED.values()[()], rejected + 1)
+
+        await self.serve(test)
+
+
+class DatagramBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(2)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+        self.client.settimeout(2)
+        for sock in (self.server, self.client):
+            self.addCleanup(sock.close)
+
+    def round_trip(self, batcher):
+        queries = [b"query %d" % i for i in range(3)]
+        for query in queries:
+            self.client.sendto(query, self.server.getsockname())
+
+        datagrams = batcher.recv()
+        self.assertEqual([bytes(view) for view, _ in datagrams], queries)
+        self.assertEqual({addr for _, addr in datagrams}, {self.client.getsockname()})
+
+        replies = [(b"reply to " + bytes(view), addr) for view, addr in datagrams]
+        replies.append((b"x" * 100, datagrams[0][1]))
+        self.assertEqual(batcher.send(replies), 4)
+        self.assertEqual([self.client.recv(512) for _ in replies], [data for data, _ in replies])
+
+        # The next read reuses the slots.
+        self.client.sendto(b"again", self.server.getsockname())
+        view = datagrams[0][0]
+        self.assertEqual(bytes(batcher.recv()[0][0]), b"again")
+        self.assertEqual(bytes(view), b"again 0")
+
+    @skipUnless(MMSG_AVAILABLE, "recvmmsg/sendmmsg are Linux only")
+    def test_recvmmsg_round_trip(self):
+        # The oversized reply does not fit a 64 byte slot and is sent alone.
+        batcher = DatagramBatcher(self.server, batch_size=4, buffer_size=64)
+        self.assertTrue(batcher.batched)
+        self.round_trip(batcher)
+
+    def test_fallback_round_trip(self):
+        self.round_trip(DatagramBatcher(self.server, batch_size=4, buffer_size=64, use_mmsg=False))
+
+    def test_nonblocking_recv(self):
+        self.server.setblocking(False)
+        for use_mmsg in (True, False):
+            with self.subTest(use_mmsg=use_mmsg):
+                self.assertEqual(DatagramBatcher(self.server, 4, use_mmsg=use_mmsg).recv(), [])
+
+    def test_sockaddr_round_trip(self):
+        for addr in (("192.0.2.1", 53), ("2001:db8::1", 5353, 0, 0)):
+            with self.subTest(addr=addr):
+                self.assertEqual(decode_sockaddr(encode_sockaddr(addr)), addr)
+
+
+class CacheSnapshotTests(LocalZoneTestCase):
+    SOA = {"name": "example.com.", "type": 6, "TTL": 300,
+           "data": "ns.example.com. hostmaster.example.com. 1 3600 600 86400 300"}
+
+    def setUp(self):
+        super().setUp()
+        self.now = time.time()
+        for module in ("dnsserver.cache", "dnsserver.snapshot"):
+            patcher = mock.patch(f"{module}.time", wraps=time)
+            patcher.start().time.side_effect = lambda: self.now
+            self.addCleanup(patcher.stop)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.snapshots = CacheSnapshots(os.path.join(directory.name, "cache.snap"), interval=0)
+
+        set_cache("short.example.com", "A", [a_record("short.example.com", ttl=60)])
+        set_cache("www.example.com", "A", [a_record("www.example.com", ttl=7200)])
+        set_negative_cache("nx.example.com", "A", 3, [self.SOA])
+        # The snapshot's position in the change log.
+        log_record_changes(("seed.example.com", "A"))
+        LISTENER.last_id = latest_change_id()
+        self.assertEqual(self.snapshots.write(), 3)
+        clear_cache()
+
+    def test_round_trip(self):
+        # Past the short entry's serve-stale window: it is not loaded.
+        self.now += 60 + SERVE_STALE_WINDOW + 1
+        self.assertEqual(self.snapshots.load(), 2)
+        self.assertEqual(DNS_CACHE.stats()["snapshot_entries"], 1)
+        self.assertIsNone(get_cache_entry("short.example.com", "A"))
+
+        # Entries are decoded when first looked up, then live in the cache.
+        self.assertEqual(get_cache_entry("www.example.com", "A")["answers"],
+                         [a_record("www.example.com", ttl=7200)])
+        self.assertEqual(DNS_CACHE.stats()["snapshot_entries"], 0)
+        self.assertEqual(DNS_CACHE.stats()["entries"], 1)
+
+        # Expired, but still within its serve-stale window.
+        entry = NEGATIVE_CACHE.get_stale(("nx.example.com", "A"))
+        self.assertEqual((entry["rcode"], entry["authority"]), (3, [self.SOA]))
+
+    def test_changes_since_the_snapshot_are_replayed(self):
+        log_record_changes(("WWW.example.com", "A"))
+
+        self.assertEqual(self.snapshots.load(), 2)
+        self.assertIsNone(get_cache_entry("www.example.com", "A"))
+        self.assertIsNotNone(get_cache_entry("nx.example.com", "A"))
+
+    def test_pruned_changes_drop_the_snapshot(self):
+        log_record_changes(("mail.example.com", "A"))
+        log_record_changes(("www.example.com", "TXT"))
+        RecordChange.objects.filter(domain__in=("seed.example.com", "mail.example.com")).delete()
+
+        self.assertEqual(self.snapshots.load(), 0)
+        self.assertIsNone(get_cache_entry("nx.example.com", "A"))
+
+    def test_old_snapshot_with_an_empty_log_is_dropped(self):
+        RecordChange.objects.all().delete()
+        self.assertEqual(self.snapshots.load(), 3)
+
+        clear_cache()
+        age = CHANGE_LOG_RETENTION.total_seconds() + 1
+        os.utime(self.snapshots.path, (self.now - age, self.now - age))
+        self.assertEqual(self.snapshots.load(), 0)
+        self.assertEqual(DNS_CACHE.stats()["snapshot_entries"], 0)
+
+
+def fake_worker(log_path, **options):
+    """Stands in for the engine in forked workers, logging what it is sent."""
+
+    def log(event):
+        line = f"{os.getpid()} {options['metrics_port']} {event}\n"
+        fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        os.write(fd, line.encode())
+        os.close(fd)
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGUSR1, lambda *_: log("flush"))
+    signal.signal(signal.SIGHUP, lambda *_: stopped.set())
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    log(f"start {options['cache_snapshot_path']} {options['reuse_port']}")
+    while not stopped.wait(0.01):
+        pass
+
+
+class WorkerSupervisorTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log_path = os.path.join(directory.name, "workers.log")
+
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGCHLD):
+            self.addCleanup(signal.signal, sig, signal.getsignal(sig))
+        self.addCleanup(signal.set_wakeup_fd, -1)
+
+    def events(self):
+        try:
+            with open(self.log_path) as log:
+                return [line.split() for line in log]
+        except FileNotFoundError:
+            return []
+
+    def wait_for(self, count, event):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            matching = [line for line in self.events() if line[2] == event]
+            if len(matching) >= count:
+                return matching
+            time.sleep(0.01)
+        return []
+
+    def test_workers_follow_the_supervisor_signals(self):
+        supervisor = workers.WorkerSupervisor(
+            2, metrics_port=9100, cache_snapshot_path="/var/cache/dns.snap"
+        )
+        seen = {}
+
+        def drive():
+            # Signals are handled on the main thread, where run() loops.
+            try:
+                seen["started"] = self.wait_for(2, "start")
+                os.kill(os.getpid(), signal.SIGUSR1)
+                seen["flushed"] = self.wait_for(2, "flush")
+                os.kill(os.getpid(), signal.SIGHUP)
+                seen["restarted"] = self.wait_for(4, "start")
+            finally:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        driver = threading.Thread(target=drive)
+        worker = functools.partial(fake_worker, self.log_path)
+        with mock.patch.object(workers, "run", worker), mock.patch.object(workers, "connections"):
+            driver.start()
+            supervisor.run()
+        driver.join()
+        for fd in supervisor._wakeup:
+            os.close(fd)
+
+        self.assertEqual(sorted(line[1:] for line in seen["started"]), [
+            ["9100", "start", "/var/cache/dns.snap.0", "True"],
+            ["9101", "start", "/var/cache/dns.snap.1", "True"],
+        ])
+        pids = {line[0] for line in seen["started"]}
+        self.assertEqual({line[0] for line in seen["flushed"]}, pids)
+        self.assertEqual(len({line[0] for line in seen["restarted"]} - pids), 2)
+        self.assertEqual(supervisor.children, {})
+
+    def reap(self, supervisor, status, uptime):
+        supervisor.children[100] = 0
+        supervisor.started_at[0] = time.monotonic() - uptime
+        with mock.patch("os.waitpid", side_effect=[(100, status), (0, 0)]):
+            supervisor.reap()
+
+    def test_crashing_worker_is_restarted_with_backoff(self):
+        supervisor = workers.WorkerSupervisor(1)
+        with mock.patch.object(supervisor, "spawn") as spawn:
+            for delay in (1, 2, 4, 8, 16, workers.MAX_RESTART_DELAY, workers.MAX_RESTART_DELAY):
+                self.reap(supervisor, status=1 << 8, uptime=0)
+                self.assertEqual(supervisor.restart_delay[0], delay)
+                self.assertAlmostEqual(supervisor.restart_at[0] - time.monotonic(), delay, delta=1)
+            spawn.assert_not_called()
+
+            supervisor.restart_at[0] = time.monotonic()
+            supervisor.restart_due()
+            spawn.assert_called_once_with(0)
+
+            # A worker that ran for a while is restarted at once, and its
+            # backoff starts over.
+            self.reap(supervisor, status=1 << 8, uptime=workers.MIN_WORKER_UPTIME + 1)
+            self.assertEqual(spawn.call_count, 2)
+            self.assertNotIn(0, supervisor.restart_delay)
+
+            self.reap(supervisor, status=0, uptime=0)
+            self.assertEqual(spawn.call_count, 3)
@@ -0,0 +1,54 @@
+"""
+Background threads for objects shared by forked worker processes.
+
+Threads do not survive fork(), so an object that needs one starts it
+lazily, on first use, once in every process that uses it. The process that
+started it is remembered on the owner, so after a fork the worker sees the
+thread as not running and starts its own.
+
+Kept free of Django imports: dnsserver.logs uses it while logging is being
+configured.
+"""
+
+import os
+import threading
+
+
+def running(owner) -> bool:
+    """Whether ``owner``'s background work was started in this process."""
+    return getattr(owner, "_thread_pid", None) == os.getpid()
+
+
+def ensure_started(owner, start) -> bool:
+    """
+    Call ``start()`` for ``owner`` unless it already ran in this process.
+    Concurrent callers wait for the first one, so it runs once. Returns
+    True when this call started it.
+    """
+
+    if running(owner):
+        return False
+
+    lock = vars(owner).setdefault("_thread_lock", threading.Lock())
+    with lock:
+        if running(owner):
+            return False
+        start()
+        owner._thread_pid = os.getpid()
+        return True
+
+
+def ensure_thread(owner, target, name: str) -> bool:
+    """Run ``target`` on a daemon thread for ``owner``, once per process."""
+    return ensure_started(owner, lambda: start_daemon(target, name))
+
+
+def start_daemon(target, name: str) -> threading.Thread:
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def mark_stopped(owner):
+    """Let the next ensure_started() for ``owner`` start it again."""
+    owner._thread_pid = None
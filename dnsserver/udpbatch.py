@@ -0,0 +1,336 @@
+"""
+Batched UDP I/O: many datagrams per system call, into preallocated buffers.
+
+On Linux, recvmmsg(2) and sendmmsg(2) (called through ctypes) move up to a
+whole batch of datagrams per system call. Received datagrams land in one
+preallocated bytearray, sliced into a fixed slot per datagram, so no
+buffer is allocated per read; responses are sent straight from their
+``bytes`` objects.
+
+Elsewhere, or with ``use_mmsg=False``, the same interface falls back to
+one recvfrom_into(2) per datagram into the same buffer pool and one
+sendto(2) per response.
+
+The slots are reused by the next ``recv``, so a caller that keeps a
+datagram beyond that must copy it. The servers copy every query once, at
+its exact size, in any case: dnspython cannot parse a memoryview (2.x
+fails turning its labels into a name), so the saving is in the buffers and
+system calls, not in that copy.
+"""
+
+import ctypes
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+
+UDP_BATCH_SIZE = 32
+# Large enough for any EDNS0 payload size a client is likely to offer.
+UDP_BUFFER_SIZE = 4096
+
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+MSG_WAITFORONE = 0x10000
+SOCKADDR_SIZE = 128  # sizeof(struct sockaddr_storage)
+ADDRESS_CACHE_SIZE = 4096
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+def load_mmsg():
+    if not sys.platform.startswith("linux"):
+        return None, None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None, None
+
+    recvmmsg.argtypes = [
+        ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p,
+    ]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_recvmmsg, _sendmmsg = load_mmsg()
+MMSG_AVAILABLE = _recvmmsg is not None
+
+MMSGHDR_SIZE = ctypes.sizeof(mmsghdr)
+MSG_LEN_OFFSET = mmsghdr.msg_len.offset
+MSG_NAMELEN_OFFSET = msghdr.msg_namelen.offset
+IOVEC_SIZE = ctypes.sizeof(iovec)
+IOV_LEN_OFFSET = iovec.iov_len.offset
+UINT = struct.Struct("I")
+SIZE_T = struct.Struct("N")
+
+
+def decode_sockaddr(raw: bytes):
+    family = struct.unpack_from("=H", raw)[0]
+    port = struct.unpack_from("!H", raw, 2)[0]
+    if family == socket.AF_INET:
+        return socket.inet_ntop(socket.AF_INET, raw[4:8]), port
+    flowinfo = struct.unpack_from("!I", raw, 4)[0]
+    scope_id = struct.unpack_from("=I", raw, 24)[0]
+    return socket.inet_ntop(socket.AF_INET6, raw[8:24]), port, flowinfo, scope_id
+
+
+def encode_sockaddr(addr) -> bytes:
+    if len(addr) == 2:
+        return (
+            struct.pack("=H", socket.AF_INET)
+            + struct.pack("!H", addr[1])
+            + socket.inet_pton(socket.AF_INET, addr[0])
+            + bytes(8)
+        )
+    host, port, flowinfo, scope_id = addr
+    return (
+        struct.pack("=H", socket.AF_INET6)
+        + struct.pack("!HI", port, flowinfo)
+        + socket.inet_pton(socket.AF_INET6, host)
+        + struct.pack("=I", scope_id)
+    )
+
+
+class DatagramBatcher:
+    """
+    Receives and sends datagrams on ``sock`` in batches of up to
+    ``batch_size``.
+
+    ``recv`` returns ``[(memoryview, address), ...]``: on a blocking socket
+    it waits for the first datagram (raising socket.timeout if the socket
+    has a timeout and it expires) and then takes whatever else is already
+    queued; on a non-blocking one it returns an empty list when there is
+    nothing to read. ``send`` takes ``[(data, address), ...]`` and returns
+    how many were handed to the kernel, which is fewer than given only when
+    the socket buffer is full.
+    """
+
+    def __init__(
+        self,
+        sock,
+        batch_size: int = UDP_BATCH_SIZE,
+        buffer_size: int = UDP_BUFFER_SIZE,
+        use_mmsg: bool = None,
+    ):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.batched = MMSG_AVAILABLE if use_mmsg is None else use_mmsg and MMSG_AVAILABLE
+
+        self.buffer = bytearray(batch_size * buffer_size)
+        view = memoryview(self.buffer)
+        self.slots = [
+            view[i * buffer_size:(i + 1) * buffer_size] for i in range(batch_size)
+        ]
+
+        # Client addresses seen recently, both ways, so a reply does not
+        # need its address converted back.
+        self._addresses = {}
+        self._sockaddrs = {}
+
+        if self.batched:
+            self._recv = MessageVector(self.buffer, batch_size, buffer_size)
+            self._send = MessageVector(bytearray(batch_size * buffer_size), batch_size, buffer_size)
+
+    def address(self, raw: bytes):
+        addr = self._addresses.get(raw)
+        if addr is None:
+            if len(self._addresses) >= ADDRESS_CACHE_SIZE:
+                self._addresses.clear()
+                self._sockaddrs.clear()
+            addr = self._addresses[raw] = decode_sockaddr(raw)
+            self._sockaddrs[addr] = raw
+        return addr
+
+    def sockaddr(self, addr) -> bytes:
+        raw = self._sockaddrs.get(addr)
+        if raw is None:
+            raw = encode_sockaddr(addr)
+        return raw
+
+    def recv(self) -> list:
+        if self.batched:
+            return self._recvmmsg()
+        return self._recvfrom()
+
+    def send(self, datagrams) -> int:
+        if self.batched:
+            return self._sendmmsg(datagrams)
+        return self._sendto(datagrams)
+
+    def _recvmmsg(self) -> list:
+        vector = self._recv
+        vector.reset()
+        timeout = self.sock.gettimeout()
+        flags = MSG_DONTWAIT if timeout == 0 else 0
+        while True:
+            count = _recvmmsg(
+                self.sock.fileno(), vector.messages, self.batch_size, flags | MSG_WAITFORONE, None
+            )
+            if count >= 0:
+                break
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise OSError(err, os.strerror(err))
+            if timeout == 0:
+                return []
+            # A socket with a timeout is non-blocking underneath, so wait
+            # for it here as socket.recv() would.
+            if not select.select([self.sock], [], [], timeout)[0]:
+                raise socket.timeout("timed out")
+
+        headers, names, slots, address = vector.headers, vector.names, self.slots, self.address
+        datagrams = []
+        for i in range(count):
+            offset = i * MMSGHDR_SIZE
+            size = UINT.unpack_from(headers, offset + MSG_LEN_OFFSET)[0]
+            namelen = UINT.unpack_from(headers, offset + MSG_NAMELEN_OFFSET)[0]
+            offset = i * SOCKADDR_SIZE
+            datagrams.append((slots[i][:size], address(bytes(names[offset:offset + namelen]))))
+        return datagrams
+
+    def _recvfrom(self) -> list:
+        datagrams = []
+        blocking = self.sock.gettimeout() != 0
+        for slot in self.slots:
+            # Only wait for the first datagram. MSG_DONTWAIT would not do
+            # for the rest: on a socket with a timeout, Python waits out the
+            # timeout rather than report that nothing is queued.
+            if datagrams and blocking and not select.select([self.sock], [], [], 0)[0]:
+                break
+            try:
+                size, addr = self.sock.recvfrom_into(slot)
+            except (BlockingIOError, InterruptedError):
+                break
+            datagrams.append((slot[:size], addr))
+        return datagrams
+
+    def _sendmmsg(self, datagrams) -> int:
+        vector = self._send
+        buffer, iovecs, names, headers = vector.buffer, vector.iovecs, vector.names, vector.headers
+        loaded = vector.loaded
+        slot_size = self.buffer_size
+        flags = 0 if self.sock.gettimeout() is None else MSG_DONTWAIT
+        sent = 0
+        while sent < len(datagrams):
+            count = 0
+            for data, addr in datagrams[sent:sent + self.batch_size]:
+                size = len(data)
+                if size > slot_size:
+                    break
+                offset = count * slot_size
+                buffer[offset:offset + size] = data
+                SIZE_T.pack_into(iovecs, count * IOVEC_SIZE + IOV_LEN_OFFSET, size)
+                # Replies mostly go to the same few addresses, so the slot
+                # often holds the right one already.
+                raw = self.sockaddr(addr)
+                if loaded[count] is not raw:
+                    offset = count * SOCKADDR_SIZE
+                    names[offset:offset + len(raw)] = raw
+                    UINT.pack_into(headers, count * MMSGHDR_SIZE + MSG_NAMELEN_OFFSET, len(raw))
+                    loaded[count] = raw
+                count += 1
+
+            if not count:
+                # Too big for a slot: sent on its own.
+                if self._sendto(datagrams[sent:sent + 1]) == 0:
+                    break
+                sent += 1
+                continue
+
+            count = _sendmmsg(self.sock.fileno(), vector.messages, count, flags)
+            if count >= 0:
+                sent += count
+                if count == 0:
+                    break
+                continue
+
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                break
+            # sendmmsg() only reports an error when the first datagram
+            # fails; skip it, as sendto() would fail for that one alone.
+            sent += 1
+        return sent
+
+    def _sendto(self, datagrams) -> int:
+        for sent, (data, addr) in enumerate(datagrams):
+            try:
+                self.sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                return sent
+            except OSError:
+                continue
+        return len(datagrams)
+
+
+class MessageVector:
+    """
+    A ``struct mmsghdr`` array for recvmmsg/sendmmsg, one message per slot
+    of ``buffer``, each with its own sockaddr. The headers live in a
+    bytearray, so the per-datagram fields are read and written with struct
+    rather than through ctypes attribute access, which costs more than the
+    system calls saved.
+    """
+
+    def __init__(self, buffer: bytearray, size: int, slot_size: int):
+        self.buffer = buffer
+        self.slot_size = slot_size
+        self.names = bytearray(size * SOCKADDR_SIZE)
+        self.headers = bytearray(size * MMSGHDR_SIZE)
+        self.iovecs = bytearray(size * IOVEC_SIZE)
+
+        self._buffer = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+        self._names = (ctypes.c_char * len(self.names)).from_buffer(self.names)
+        self._iovecs = (iovec * size).from_buffer(self.iovecs)
+        self.messages = (mmsghdr * size).from_buffer(self.headers)
+
+        base = ctypes.addressof(self._buffer)
+        names = ctypes.addressof(self._names)
+        for i in range(size):
+            self._iovecs[i].iov_base = base + i * slot_size
+            self._iovecs[i].iov_len = slot_size
+            hdr = self.messages[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_SIZE
+            hdr.msg_namelen = SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+        self._template = bytes(self.headers)
+        # The sockaddr currently in each slot, on the sending side.
+        self.loaded = [None] * size
+
+    def reset(self):
+        # The kernel overwrites msg_namelen and msg_len on every receive.
+        self.headers[:] = self._template
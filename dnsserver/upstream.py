@@ -1,6 +1,17 @@
-import dns.resolver
-import dns.rdatatype
+import asyncio
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+
 import dns.exception
+import dns.flags
+import dns.inet
+import dns.message
+import dns.rcode
+import dns.rdatatype
+from django.conf import settings
 
 
 DNS_TYPE_MAP = {
@@ -13,91 +24,470 @@ DNS_TYPE_MAP = {
     "NS": dns.rdatatype.NS,
 }
 
+UPSTREAM_NAMESERVERS = getattr(settings, "DNS_UPSTREAM_NAMESERVERS", ["8.8.8.8", "1.1.1.1"])
+UPSTREAM_PORT = 53
+UPSTREAM_TIMEOUT = getattr(settings, "DNS_UPSTREAM_TIMEOUT", 3)
+UPSTREAM_LIFETIME = getattr(settings, "DNS_UPSTREAM_LIFETIME", 5)
+# Advertised to upstreams, so most answers come back over UDP without a
+# truncated response and a TCP retry.
+UPSTREAM_EDNS_PAYLOAD = 1232
+
+FAILURE_BACKOFF = 5
+MAX_FAILURE_BACKOFF = 60
+RTT_SMOOTHING = 0.3
+
+
+class UpstreamError(Exception):
+    pass
+
+
+def negative_authority(message) -> list:
+    # RFC 2308: a negative answer is cached for min(SOA TTL, SOA MINIMUM),
+    # and that is also the TTL the SOA must carry when it is passed on.
+    for rrset in message.authority:
+        if rrset.rdtype != dns.rdatatype.SOA:
+            continue
+
+        return [
+            {
+                "name": rrset.name.to_text(),
+                "type": dns.rdatatype.SOA,
+                "TTL": min(rrset.ttl, rdata.minimum),
+                "data": rdata.to_text(),
+            }
+            for rdata in rrset
+        ]
+
+    return []
 
-def query_upstream_dns(domain: str, record_type: str) -> dict:
 
+def rdata_to_data(rdata) -> str:
+    rdtype = rdata.rdtype
 
-    resolver = dns.resolver.Resolver()
-    resolver.nameservers = ["8.8.8.8", "1.1.1.1"]
-    resolver.timeout = 3
-    resolver.lifetime = 5
+    if rdtype in (dns.rdatatype.A, dns.rdatatype.AAAA):
+        return rdata.address
 
-    try:
-        answers = resolver.resolve(
-            domain,
-            DNS_TYPE_MAP[record_type],
-            raise_on_no_answer=False,
+    if rdtype in (dns.rdatatype.CNAME, dns.rdatatype.PTR, dns.rdatatype.NS):
+        return str(rdata.target).rstrip(".")
+
+    if rdtype == dns.rdatatype.MX:
+        return f"{rdata.preference} {str(rdata.exchange).rstrip('.')}"
+
+    if rdtype == dns.rdatatype.TXT:
+        return "".join(
+            part.decode() if isinstance(part, bytes) else part
+            for part in rdata.strings
         )
 
-        response = {
-            "Status": 0,
-            "Question": [
-                {
-                    "name": domain,
-                    "type": DNS_TYPE_MAP[record_type],
-                }
-            ],
-            "Answer": [],
+    return rdata.to_text()
+
+
+def rrset_to_answers(domain: str, rrset) -> list:
+    owner = rrset.name.to_text(omit_final_dot=True)
+    # Keep the client's spelling for records owned by the query name.
+    if owner.lower() == domain.lower():
+        owner = domain
+
+    return [
+        {
+            "name": owner,
+            "type": rrset.rdtype,
+            "TTL": rrset.ttl,
+            "data": rdata_to_data(rdata),
         }
+        for rdata in rrset
+    ]
 
-        if answers.rrset is None:
-            return response
 
-        for rdata in answers:
-            answer = {
-                "name": domain,
-                "type": DNS_TYPE_MAP[record_type],
-                "TTL": answers.rrset.ttl,
-            }
+def response_to_dict(domain: str, record_type: str, message) -> dict:
+    question = [
+        {
+            "name": domain,
+            "type": DNS_TYPE_MAP[record_type],
+        }
+    ]
 
-            if record_type == "A":
-                answer["data"] = rdata.address
+    # The answer section may hold a CNAME chain ahead of the final rrset;
+    # all of it is kept so one response carries the complete answer.
+    chain = message.resolve_chaining()
+    answers = []
+    for rrset in chain.cnames:
+        answers.extend(rrset_to_answers(domain, rrset))
+    if chain.answer is not None:
+        answers.extend(rrset_to_answers(domain, chain.answer))
 
-            elif record_type == "AAAA":
-                answer["data"] = rdata.address
+    if message.rcode() == dns.rcode.NXDOMAIN:
+        return {
+            "Status": 3,
+            "Question": question,
+            "Answer": answers,
+            "Authority": negative_authority(message),
+        }
 
-            elif record_type == "CNAME":
-                answer["data"] = str(rdata.target).rstrip(".")
+    response = {
+        "Status": 0,
+        "Question": question,
+        "Answer": answers,
+    }
 
-            elif record_type == "MX":
-                answer["data"] = f"{rdata.preference} {str(rdata.exchange).rstrip('.')}"
+    if chain.answer is None:
+        response["Authority"] = negative_authority(message)
 
-            elif record_type == "TXT":
-                answer["data"] = "".join(
-                    part.decode() if isinstance(part, bytes) else part
-                    for part in rdata.strings
-                )
+    return response
 
-            elif record_type == "PTR":
-                answer["data"] = str(rdata.target).rstrip(".")
 
-            elif record_type == "NS":
-                answer["data"] = str(rdata.target).rstrip(".")
+def parse_nameserver(nameserver):
+    """
+    ``(address, port)`` from "192.0.2.1", "192.0.2.1:5353", "2001:db8::1",
+    "[2001:db8::1]:5353" or an ``(address, port)`` tuple.
+    """
 
-            response["Answer"].append(answer)
+    if isinstance(nameserver, tuple):
+        return nameserver
+    if nameserver.startswith("["):
+        address, _, port = nameserver[1:].partition("]")
+        return address, int(port[1:]) if port else UPSTREAM_PORT
+    if nameserver.count(":") == 1:
+        address, port = nameserver.split(":")
+        return address, int(port)
+    return nameserver, UPSTREAM_PORT
 
-        return response
 
-    except dns.resolver.NXDOMAIN:
+class Nameserver:
+
+    def __init__(self, address: str, port: int = UPSTREAM_PORT):
+        self.address = address
+        self.port = port
+        self.family = dns.inet.af_for_address(address)
+
+        self.srtt = None
+        self.queries = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.consecutive_failures = 0
+        self.failed_until = 0.0
+
+    def record_success(self, rtt: float):
+        self.queries += 1
+        self.consecutive_failures = 0
+        self.failed_until = 0.0
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += RTT_SMOOTHING * (rtt - self.srtt)
+
+    def record_failure(self, timeout: bool):
+        self.queries += 1
+        self.errors += 1
+        if timeout:
+            self.timeouts += 1
+
+        self.consecutive_failures += 1
+        backoff = min(
+            FAILURE_BACKOFF * 2 ** (self.consecutive_failures - 1),
+            MAX_FAILURE_BACKOFF,
+        )
+        self.failed_until = time.monotonic() + backoff
+
+    def rank(self, now: float):
+        # Healthy servers first, fastest first; unmeasured ones are tried
+        # before measured ones so every server gets an RTT sample.
+        return (
+            self.failed_until > now,
+            -1 if self.srtt is None else self.srtt,
+        )
+
+    def as_dict(self) -> dict:
         return {
-            "Status": 3,
-            "Question": [
-                {
-                    "name": domain,
-                    "type": DNS_TYPE_MAP[record_type],
-                }
-            ],
-            "Answer": [],
+            "nameserver": f"{self.address}:{self.port}",
+            "queries": self.queries,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "srtt_ms": None if self.srtt is None else round(self.srtt * 1000, 3),
+            "healthy": self.failed_until <= time.monotonic(),
         }
 
-    except dns.exception.Timeout:
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 2:
+            return
+        future = self.pending.get(int.from_bytes(data[:2], "big"))
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("upstream socket closed"))
+
+    async def exchange(self, query, timeout: float):
+        while query.id in self.pending:
+            query.id = random.randint(0, 0xFFFF)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        future = self.pending[query.id] = loop.create_future()
+        try:
+            self.transport.sendto(query.to_wire())
+            while True:
+                wire = await asyncio.wait_for(future, deadline - loop.time())
+                response = dns.message.from_wire(wire)
+                if query.is_response(response):
+                    return response
+                future = self.pending[query.id] = loop.create_future()
+        finally:
+            self.pending.pop(query.id, None)
+
+
+class UpstreamResolver:
+    """
+    Shared upstream client: nameservers are tried fastest-first by smoothed
+    RTT, failing ones are backed off, and concurrent lookups of the same
+    (name, type) share a single upstream query.
+
+    Every UDP query goes out on a socket of its own, so it gets a fresh
+    random source port from the OS: next to the 16-bit query ID, the port
+    is what keeps spoofed answers from poisoning the cache (RFC 5452).
+    """
+
+    def __init__(
+        self,
+        nameservers=UPSTREAM_NAMESERVERS,
+        timeout: float = UPSTREAM_TIMEOUT,
+        lifetime: float = UPSTREAM_LIFETIME,
+    ):
+        self.set_nameservers(nameservers)
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._loops = weakref.WeakKeyDictionary()
+
+    def set_nameservers(self, nameservers):
+        self.nameservers = [Nameserver(*parse_nameserver(ns)) for ns in nameservers]
+
+    def ordered_nameservers(self):
+        now = time.monotonic()
+        return sorted(self.nameservers, key=lambda ns: ns.rank(now))
+
+    def stats(self) -> dict:
         return {
-            "Status": 2,
-            "Comment": "Upstream DNS timeout",
+            "coalesced": self.coalesced,
+            "nameservers": [ns.as_dict() for ns in self.nameservers],
         }
 
-    except Exception as exc:
+    def make_query(self, domain: str, record_type: str):
+        return dns.message.make_query(
+            domain, DNS_TYPE_MAP[record_type], use_edns=0, payload=UPSTREAM_EDNS_PAYLOAD
+        )
+
+    def error_response(self, comment: str) -> dict:
         return {
             "Status": 2,
-            "Comment": f"Upstream DNS error: {str(exc)}",
+            "Comment": comment,
         }
+
+    # Blocking API, used from executor threads and the threaded server.
+
+    def query(self, domain: str, record_type: str) -> dict:
+        key = (domain.lower(), record_type)
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = self._resolve(domain, record_type)
+            future.set_result(result)
+            return result
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _resolve(self, domain: str, record_type: str) -> dict:
+        # dns.query (and the TLS, QUIC and zone transfer support it pulls in)
+        # is only needed by the blocking path, which the asyncio engine
+        # never takes, so it is not loaded at startup.
+        import dns.query
+
+        if record_type not in DNS_TYPE_MAP:
+            return self.error_response(f"Unsupported record type: {record_type}")
+
+        try:
+            query = self.make_query(domain, record_type)
+        except dns.exception.DNSException as exc:
+            # An invalid name (empty or overlong label, ...) is the
+            # client's error, not the nameservers'.
+            return self.error_response(f"Invalid query: {exc}")
+
+        deadline = time.monotonic() + self.lifetime
+        comment = "Upstream DNS timeout"
+
+        for ns in self.ordered_nameservers():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            started = time.monotonic()
+            try:
+                response = dns.query.udp(
+                    query,
+                    ns.address,
+                    timeout=min(self.timeout, remaining),
+                    port=ns.port,
+                    ignore_unexpected=True,
+                )
+                if response.flags & dns.flags.TC:
+                    response = dns.query.tcp(
+                        query,
+                        ns.address,
+                        timeout=max(deadline - time.monotonic(), 0.1),
+                        port=ns.port,
+                    )
+                result = self._handle_response(ns, domain, record_type, response, started)
+            except dns.exception.Timeout:
+                ns.record_failure(timeout=True)
+                comment = "Upstream DNS timeout"
+                continue
+            except (UpstreamError, dns.exception.DNSException, OSError) as exc:
+                ns.record_failure(timeout=False)
+                comment = f"Upstream DNS error: {str(exc)}"
+                continue
+
+            return result
+
+        return self.error_response(comment)
+
+    def _handle_response(self, ns, domain, record_type, response, started):
+        if response.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            raise UpstreamError(dns.rcode.to_text(response.rcode()))
+
+        result = response_to_dict(domain, record_type, response)
+        ns.record_success(time.monotonic() - started)
+        return result
+
+    # Non-blocking API, used from the asyncio engine.
+
+    async def query_async(self, domain: str, record_type: str) -> dict:
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = {"inflight": {}}
+
+        key = (domain.lower(), record_type)
+        inflight = state["inflight"]
+
+        future = inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = inflight[key] = loop.create_future()
+        try:
+            result = await self._resolve_async(state, domain, record_type)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Mark the exception retrieved when nobody else was waiting.
+            future.exception()
+            raise
+        finally:
+            inflight.pop(key, None)
+
+    async def _exchange(self, ns, query, timeout: float):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            UpstreamProtocol,
+            remote_addr=(ns.address, ns.port),
+            family=ns.family,
+        )
+        try:
+            return await protocol.exchange(query, timeout)
+        finally:
+            transport.close()
+
+    async def _resolve_async(self, state, domain: str, record_type: str) -> dict:
+        if record_type not in DNS_TYPE_MAP:
+            return self.error_response(f"Unsupported record type: {record_type}")
+
+        try:
+            query = self.make_query(domain, record_type)
+        except dns.exception.DNSException as exc:
+            # An invalid name (empty or overlong label, ...) is the
+            # client's error, not the nameservers'.
+            return self.error_response(f"Invalid query: {exc}")
+
+        deadline = time.monotonic() + self.lifetime
+        comment = "Upstream DNS timeout"
+
+        for ns in self.ordered_nameservers():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            started = time.monotonic()
+            try:
+                response = await self._exchange(ns, query, min(self.timeout, remaining))
+                if response.flags & dns.flags.TC:
+                    from dns import asyncquery
+
+                    response = await asyncquery.tcp(
+                        query,
+                        ns.address,
+                        timeout=max(deadline - time.monotonic(), 0.1),
+                        port=ns.port,
+                    )
+                result = self._handle_response(ns, domain, record_type, response, started)
+            except (asyncio.TimeoutError, dns.exception.Timeout):
+                ns.record_failure(timeout=True)
+                comment = "Upstream DNS timeout"
+                continue
+            except (UpstreamError, dns.exception.DNSException, OSError) as exc:
+                ns.record_failure(timeout=False)
+                comment = f"Upstream DNS error: {str(exc)}"
+                continue
+
+            return result
+
+        return self.error_response(comment)
+
+
+UPSTREAM = UpstreamResolver()
+
+
+def query_upstream_dns(domain: str, record_type: str) -> dict:
+    return UPSTREAM.query(domain, record_type)
+
+
+async def query_upstream_dns_async(domain: str, record_type: str) -> dict:
+    return await UPSTREAM.query_async(domain, record_type)
@@ -0,0 +1,11 @@
+from django.http import HttpResponse
+from django.views import View
+
+from dnsserver.metrics import CONTENT_TYPE, REGISTRY
+
+
+class MetricsView(View):
+    """Prometheus metrics of this process (the DoH side of the server)."""
+
+    def get(self, request):
+        return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,204 @@
+import logging
+import os
+import select
+import signal
+import time
+
+from django.db import connections
+
+from dnsserver.engine import run
+from dnsserver.metrics import REGISTRY
+from dnsserver.snapshot import worker_snapshot_path
+
+logger = logging.getLogger(__name__)
+
+# Longest the supervisor waits between checks; signals and worker exits
+# wake it immediately.
+SUPERVISOR_INTERVAL = 1.0
+MIN_WORKER_UPTIME = 1.0
+MAX_RESTART_DELAY = 30.0
+
+
+class WorkerSupervisor:
+    """
+    Forks one engine per slot, all bound to the same port with SO_REUSEPORT.
+
+    Signals:
+        SIGTERM/SIGINT  stop every worker and exit
+        SIGHUP          gracefully restart every worker with fresh state
+        SIGUSR1         flush the cache of every worker
+
+    SIGHUP only restarts the workers: they are forked from the supervisor,
+    which keeps the settings and code it started with, so a change to the
+    settings takes a restart of the whole server. The new workers reread
+    the records from the database; their caches start empty, or, with
+    --cache-snapshot, from the snapshot the old worker in the same slot
+    wrote as it stopped.
+
+    A worker that exits is restarted straight away, unless it exited with
+    an error soon after starting; then its restart is delayed, doubling up
+    to MAX_RESTART_DELAY while it keeps failing. The supervisor waits on a
+    signal wakeup pipe, so it reacts to signals and worker exits at once,
+    never sleeping through a restart delay.
+    """
+
+    def __init__(self, workers: int, **options):
+        self.workers = workers
+        self.options = dict(options, reuse_port=True)
+
+        self.children = {}
+        self.started_at = {}
+        self.restart_delay = {}
+        self.restart_at = {}
+        self.stopping = False
+        self.reloading = False
+        self._wakeup = None
+
+    def spawn(self, slot: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.set_wakeup_fd(-1)
+            for fd in self._wakeup or ():
+                os.close(fd)
+            for sig in (
+                signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGCHLD,
+            ):
+                signal.signal(sig, signal.SIG_DFL)
+
+            # Each worker reports only its own queries, on its own port.
+            REGISTRY.reset()
+            options = dict(self.options)
+            if options.get("metrics_port"):
+                options["metrics_port"] += slot
+            if options.get("cache_snapshot_path"):
+                options["cache_snapshot_path"] = worker_snapshot_path(
+                    options["cache_snapshot_path"], slot
+                )
+
+            code = 0
+            try:
+                run(**options)
+            except BaseException:
+                logger.exception("DNS worker %s crashed", slot)
+                code = 1
+            finally:
+                # os._exit() skips atexit, and with it the flush of log
+                # records still queued for the background log thread.
+                logging.shutdown()
+                os._exit(code)
+
+        self.children[pid] = slot
+        self.started_at[slot] = time.monotonic()
+        logger.info("Started DNS worker %s (pid %s)", slot, pid)
+
+    def broadcast(self, sig):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+
+    def handle_flush(self, signum, frame):
+        self.broadcast(signal.SIGUSR1)
+
+    def handle_child(self, signum, frame):
+        # Only here so SIGCHLD is delivered and wakes wait(); reap() does
+        # the work.
+        pass
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            slot = self.children.pop(pid)
+            if self.stopping:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            uptime = time.monotonic() - self.started_at[slot]
+
+            if code != 0 and uptime < MIN_WORKER_UPTIME:
+                delay = min(self.restart_delay.get(slot, 0.5) * 2, MAX_RESTART_DELAY)
+                self.restart_delay[slot] = delay
+                logger.warning(
+                    "DNS worker %s (pid %s) exited with %s, restarting in %.1fs",
+                    slot, pid, code, delay,
+                )
+                self.restart_at[slot] = time.monotonic() + delay
+                continue
+
+            self.restart_delay.pop(slot, None)
+            if code != 0:
+                logger.warning(
+                    "DNS worker %s (pid %s) exited with %s, restarting",
+                    slot, pid, code,
+                )
+            self.spawn(slot)
+
+    def restart_due(self):
+        now = time.monotonic()
+        for slot, due in list(self.restart_at.items()):
+            if due <= now:
+                del self.restart_at[slot]
+                self.spawn(slot)
+
+    def wait(self):
+        timeout = SUPERVISOR_INTERVAL
+        if self.restart_at:
+            timeout = min(timeout, max(min(self.restart_at.values()) - time.monotonic(), 0))
+
+        readable, _, _ = select.select([self._wakeup[0]], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self._wakeup[0], 512):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def run(self):
+        connections.close_all()
+
+        # Every signal writes its number to this pipe, which wait() selects
+        # on, so a signal or a worker exit (SIGCHLD) ends the wait at once.
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self._wakeup[1])
+
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGUSR1, self.handle_flush)
+        signal.signal(signal.SIGCHLD, self.handle_child)
+
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                logger.info("Restarting DNS workers")
+                self.broadcast(signal.SIGHUP)
+
+            self.reap()
+            self.restart_due()
+            self.wait()
+
+        self.broadcast(signal.SIGTERM)
+        for pid in list(self.children):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.children.clear()
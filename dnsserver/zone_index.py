@@ -0,0 +1,339 @@
+import logging
+import sys
+import threading
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from records.models import DNSRecord
+from dnsserver.response_builder import DNS_TYPE_MAP
+
+logger = logging.getLogger(__name__)
+
+LOAD_CHUNK_SIZE = 10_000
+
+# Zones we answer for even without an NS record in the database. Names
+# under an authoritative zone are never forwarded upstream. List a zone
+# here too if it sits below another local zone: otherwise its NS records
+# are taken for a delegation to other servers.
+AUTHORITATIVE_ZONES = getattr(settings, "DNS_AUTHORITATIVE_ZONES", [])
+
+# TTL of the SOA synthesized for local NXDOMAIN/NODATA answers.
+LOCAL_NEGATIVE_TTL = getattr(settings, "DNS_LOCAL_NEGATIVE_TTL", 300)
+
+
+def index_key(domain, record_type):
+    # Names are matched case-insensitively, like the rest of DNS. str()
+    # because a saved instance may still hold a RecordType member, which
+    # sys.intern() rejects.
+    return sys.intern(domain.lower()), sys.intern(str(record_type))
+
+
+def record_data(record_type, value, priority):
+    if record_type == "MX":
+        return f"{priority} {value}"
+    return value
+
+
+def name_labels(domain):
+    domain = domain.lower().rstrip(".")
+    return domain.split(".")[::-1] if domain else []
+
+
+class TrieNode:
+    __slots__ = ("children", "types", "zone", "configured")
+
+    def __init__(self):
+        self.children = {}
+        # Number of record types owned by exactly this name.
+        self.types = 0
+        # Number of reasons this name is a zone apex (NS records, settings).
+        self.zone = 0
+        # Listed in DNS_AUTHORITATIVE_ZONES: an apex even below another zone.
+        self.configured = False
+
+
+class DomainTrie:
+    """
+    Trie over domain names keyed by label from the root down, so
+    "www.example.com" is stored as com -> example -> www.
+
+    Everything under a zone shares the zone's path, which makes exact,
+    wildcard and closest-enclosing-zone lookups cost one dict lookup per
+    label of the query name.
+    """
+
+    def __init__(self):
+        self.root = TrieNode()
+
+    def add(self, domain, types=0, zone=0, configured=False):
+        node = self.root
+        for label in name_labels(domain):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[sys.intern(label)] = TrieNode()
+            node = child
+        node.types += types
+        node.zone += zone
+        node.configured |= configured
+
+    def discard(self, domain, types=0, zone=0):
+        path = [self.root]
+        labels = name_labels(domain)
+        for label in labels:
+            node = path[-1].children.get(label)
+            if node is None:
+                return
+            path.append(node)
+
+        node = path[-1]
+        node.types = max(node.types - types, 0)
+        node.zone = max(node.zone - zone, 0)
+
+        # Prune nodes that no longer own records, zones or children.
+        for depth in range(len(labels), 0, -1):
+            node = path[depth]
+            if node.types or node.zone or node.children:
+                break
+            del path[depth - 1].children[labels[depth - 1]]
+
+    def find(self, domain):
+        """
+        Return ``(node, depth, zone_depth)``: the deepest existing node on the
+        path to ``domain`` (the closest encloser, or the name itself when
+        depth equals its label count), how many labels matched, and how many
+        labels the closest enclosing zone has (None outside all zones, or
+        at or below a delegation).
+
+        The outermost apex on the path starts a zone. An NS record further
+        down is a zone cut delegating that subtree to other servers, unless
+        the name is configured as a zone of its own.
+        """
+
+        node = self.root
+        depth = 0
+        zone_depth = None
+        for label in name_labels(domain):
+            child = node.children.get(label)
+            if child is None:
+                break
+            node = child
+            depth += 1
+            if node.zone:
+                if zone_depth is not None and not node.configured:
+                    return node, depth, None
+                zone_depth = depth
+        return node, depth, zone_depth
+
+
+def suffix_name(labels, depth):
+    return ".".join(reversed(labels[:depth]))
+
+
+class ZoneIndex:
+    """
+    In-memory copy of every DNSRecord, keyed by (domain, record_type).
+
+    Each key maps to a tuple of ``(pk, ttl, data)`` rows with ``data``
+    already in the presentation form the response builder expects, so a
+    local answer is a single dict lookup. Domain strings are interned and
+    rows are plain tuples to keep millions of records affordable.
+
+    A DomainTrie over the same names tracks zone apexes (names with NS
+    records, plus DNS_AUTHORITATIVE_ZONES) so that resolve() can answer
+    wildcards and NXDOMAIN/NODATA for our own zones without going upstream.
+    NS records below an apex are delegations: names under them that have
+    no record of their own go upstream.
+
+    The index is filled once from the database and then kept current from
+    DNSRecord post_save/post_delete signals in this process and from the
+    record change log for writes made elsewhere (see invalidation.py).
+    """
+
+    def __init__(self):
+        self._records = {}
+        self._trie = DomainTrie()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._records.values())
+
+    def load(self):
+        records = {}
+        rows = DNSRecord.objects.values_list(
+            "pk", "domain", "record_type", "value", "ttl", "priority"
+        ).iterator(chunk_size=LOAD_CHUNK_SIZE)
+
+        for pk, domain, record_type, value, ttl, priority in rows:
+            key = index_key(domain, record_type)
+            row = (pk, ttl, record_data(record_type, value, priority))
+            records.setdefault(key, []).append(row)
+
+        trie = DomainTrie()
+        for domain, record_type in records:
+            trie.add(domain, 1, record_type == "NS")
+        for zone in AUTHORITATIVE_ZONES:
+            trie.add(zone, zone=1, configured=True)
+
+        with self._lock:
+            self._records = {key: tuple(rows) for key, rows in records.items()}
+            self._trie = trie
+            self.loaded = True
+
+        logger.info("Zone index loaded: %s records", len(self))
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        with self._load_lock:
+            if not self.loaded:
+                self.load()
+
+    def lookup(self, domain: str, record_type: str):
+        rows = self._records.get((domain.lower(), record_type))
+        if not rows:
+            return []
+
+        rdtype = DNS_TYPE_MAP[record_type]
+        return [
+            {"name": domain, "type": rdtype, "TTL": ttl, "data": data}
+            for _, ttl, data in rows
+        ]
+
+    def lookup_or_cname(self, domain: str, record_type: str):
+        answers = self.lookup(domain, record_type)
+        if not answers and record_type != "CNAME":
+            # RFC 1034 3.6.2: a CNAME owner has no other data, so its CNAME
+            # answers queries of every type.
+            answers = self.lookup(domain, "CNAME")
+        return answers
+
+    def resolve(self, domain: str, record_type: str):
+        """
+        Answer ``domain``/``record_type`` from local data. Returns
+        ``(answers, status, authority)``, or None when the name is outside
+        every zone we are authoritative for, or delegated away from one, and
+        should go upstream.
+
+        Follows RFC 1034 section 4.3.2 / RFC 4592 for names inside our
+        zones: an exact match wins; a name that exists (including an empty
+        non-terminal) without the type is NODATA; otherwise the closest
+        encloser's wildcard is used; otherwise the answer is NXDOMAIN.
+        A CNAME stands in for any type, at the name or the wildcard.
+        """
+
+        answers = self.lookup_or_cname(domain, record_type)
+        if answers:
+            return answers, 0, []
+
+        node, depth, zone_depth = self._trie.find(domain)
+        if zone_depth is None:
+            return None
+
+        labels = name_labels(domain)
+        authority = [self.zone_soa(suffix_name(labels, zone_depth))]
+
+        if depth == len(labels):
+            return [], 0, authority
+
+        if "*" in node.children:
+            wildcard = self.lookup_or_cname(f"*.{suffix_name(labels, depth)}", record_type)
+            if wildcard:
+                return [dict(ans, name=domain) for ans in wildcard], 0, []
+            return [], 0, authority
+
+        return [], 3, authority
+
+    def zone_soa(self, zone: str):
+        # DNSRecord has no SOA type, so negative answers carry a synthesized
+        # one naming the zone's first NS as primary.
+        ns = self._records.get((zone, "NS"))
+        mname = ns[0][2] if ns else f"ns.{zone}"
+        return {
+            "name": zone,
+            "type": DNS_TYPE_MAP["SOA"],
+            "TTL": LOCAL_NEGATIVE_TTL,
+            "data": f"{mname} hostmaster.{zone} 1 3600 600 86400 {LOCAL_NEGATIVE_TTL}",
+        }
+
+    def refresh(self, domain: str, record_type: str):
+        key = index_key(domain, record_type)
+        rows = tuple(
+            (pk, ttl, record_data(record_type, value, priority))
+            for pk, value, ttl, priority in DNSRecord.objects.filter(
+                domain=domain, record_type=record_type
+            ).values_list("pk", "value", "ttl", "priority")
+        )
+
+        with self._lock:
+            existed = key in self._records
+            if rows:
+                self._records[key] = rows
+            else:
+                self._records.pop(key, None)
+            self._track(key, existed, bool(rows))
+
+    def upsert(self, pk, domain, record_type, value, ttl, priority):
+        key = index_key(domain, record_type)
+        row = (pk, ttl, record_data(record_type, value, priority))
+
+        with self._lock:
+            existed = key in self._records
+            rows = tuple(r for r in self._records.get(key, ()) if r[0] != pk)
+            self._records[key] = rows + (row,)
+            self._track(key, existed, True)
+
+    def remove(self, pk, domain, record_type):
+        key = index_key(domain, record_type)
+
+        with self._lock:
+            existed = key in self._records
+            rows = tuple(r for r in self._records.get(key, ()) if r[0] != pk)
+            if rows:
+                self._records[key] = rows
+            else:
+                self._records.pop(key, None)
+            self._track(key, existed, bool(rows))
+
+    def _track(self, key, existed, exists):
+        domain, record_type = key
+        if exists and not existed:
+            self._trie.add(domain, 1, record_type == "NS")
+        elif existed and not exists:
+            self._trie.discard(domain, 1, record_type == "NS")
+
+
+ZONE_INDEX = ZoneIndex()
+
+
+def record_saved(sender, instance, **kwargs):
+    if not ZONE_INDEX.loaded:
+        return
+
+    old_key = getattr(instance, "_original_key", None)
+    new_key = (instance.domain, instance.record_type)
+    if old_key and old_key != new_key:
+        ZONE_INDEX.remove(instance.pk, *old_key)
+
+    ZONE_INDEX.upsert(
+        instance.pk,
+        instance.domain,
+        instance.record_type,
+        instance.value,
+        instance.ttl,
+        instance.priority,
+    )
+
+
+def record_deleted(sender, instance, **kwargs):
+    if not ZONE_INDEX.loaded:
+        return
+
+    key = getattr(instance, "_original_key", None)
+    ZONE_INDEX.remove(instance.pk, *(key or (instance.domain, instance.record_type)))
+
+
+post_save.connect(record_saved, sender=DNSRecord, dispatch_uid="zone_index_save")
+post_delete.connect(record_deleted, sender=DNSRecord, dispatch_uid="zone_index_delete")
@@ -0,0 +1,116 @@
+import binascii
+import json
+import time
+from urllib.parse import parse_qs
+
+import dns.exception as dexception
+import dns.message as dmessage
+
+from dnsserver.handler import handle_query_async
+from dnsserver.metrics import QUERY_SECONDS, record_response, since
+from dnsserver.querylog import QUERY_LOG
+from dnsserver.response_builder import badvers_response
+from doh.views import DNS_MESSAGE, decode_base64url, wire_max_age
+
+DOH_PATH = "/dns-query"
+
+# A DNS message over TCP (and so over HTTP) is at most 65535 bytes.
+MAX_MESSAGE_SIZE = 65535
+
+
+class DoHApplication:
+    """
+    Raw ASGI fast path for RFC 8484 wire-format queries.
+
+    GET /dns-query?dns=... and POST /dns-query with an application/dns-message
+    body are answered here without building an HttpRequest or running the
+    middleware stack. Everything else, including the JSON flavour of
+    /dns-query and the DRF admin API, is passed through to ``django_app``.
+    """
+
+    def __init__(self, django_app, path=DOH_PATH):
+        self.django_app = django_app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            return await self.django_app(scope, receive, send)
+
+        method = scope["method"]
+
+        if method == "GET":
+            encoded = parse_qs(scope["query_string"].decode("latin-1")).get("dns")
+            if not encoded:
+                return await self.django_app(scope, receive, send)
+            try:
+                wire = decode_base64url(encoded[0])
+            except (binascii.Error, ValueError):
+                return await self.error(send, 400, "Invalid base64url 'dns' parameter")
+            return await self.answer(scope, send, wire)
+
+        if method == "POST" and self.content_type(scope) == DNS_MESSAGE:
+            wire = await self.read_body(receive)
+            if wire is None:
+                return await self.error(send, 413, "DNS message too large")
+            return await self.answer(scope, send, wire)
+
+        return await self.django_app(scope, receive, send)
+
+    @staticmethod
+    def content_type(scope):
+        for name, value in scope["headers"]:
+            if name == b"content-type":
+                return value.decode("latin-1").split(";", 1)[0].strip().lower()
+        return None
+
+    @staticmethod
+    async def read_body(receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > MAX_MESSAGE_SIZE:
+                return None
+            if not message.get("more_body"):
+                return body
+
+    async def answer(self, scope, send, wire):
+        started = time.perf_counter()
+        try:
+            dns_request = dmessage.from_wire(wire)
+        except dexception.DNSException:
+            return await self.error(send, 400, "Invalid DNS binary message")
+        since(started, "parse")
+
+        if not dns_request.question:
+            return await self.error(send, 400, "DNS message has no question")
+
+        response = badvers_response(dns_request) or await handle_query_async(
+            dns_request=dns_request
+        )
+        record_response(response)
+
+        sending = time.perf_counter()
+        await self.respond(send, 200, DNS_MESSAGE, response, [
+            (b"cache-control", b"max-age=%d" % wire_max_age(response)),
+        ])
+        elapsed = since(sending, "send") - started
+        QUERY_SECONDS.observe(elapsed, "doh")
+        QUERY_LOG.log("doh", scope.get("client"), response, elapsed)
+
+    async def error(self, send, status, message):
+        body = json.dumps({"error": message}).encode()
+        await self.respond(send, status, "application/json", body)
+
+    @staticmethod
+    async def respond(send, status, content_type, body, headers=()):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type.encode()),
+                (b"content-length", str(len(body)).encode()),
+                *headers,
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
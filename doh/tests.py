@@ -0,0 +1,217 @@
+import base64
+import json
+from unittest import mock
+
+import dns.message
+import dns.rcode
+
+from dnsserver.tests import LocalZoneTestCase
+from doh.asgi import DoHApplication
+from doh.views import DNS_MESSAGE
+from dnsserver.zone_index import LOCAL_NEGATIVE_TTL
+from records.models import DNSRecord
+
+
+class DoHTestCase(LocalZoneTestCase):
+    def setUp(self):
+        DNSRecord.objects.create(domain="example.test", record_type="NS", value="ns1.example.test")
+        DNSRecord.objects.create(domain="www.example.test", record_type="A", value="192.0.2.1")
+        super().setUp()
+
+
+class JSONQueryTests(DoHTestCase):
+    def get(self, name, record_type="A"):
+        return self.client.get("/dns-query", {"name": name, "type": record_type})
+
+    def post(self, name, record_type="A"):
+        return self.client.post(
+            "/dns-query", {"name": name, "type": record_type}, content_type="application/json"
+        )
+
+    def assert_negative(self, response, status):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], f"max-age={LOCAL_NEGATIVE_TTL}")
+        body = response.json()
+        self.assertEqual((body["Status"], body["Answer"]), (status, []))
+        self.assertEqual([(soa["name"], soa["type"]) for soa in body["Authority"]],
+                         [("example.test.", 6)])
+
+    def test_answer(self):
+        for send in (self.get, self.post):
+            with self.subTest(send=send.__name__):
+                response = send("www.example.test")
+                self.assertEqual(response["Cache-Control"], "max-age=300")
+                body = response.json()
+                self.assertEqual(body["Status"], 0)
+                self.assertEqual([ans["data"] for ans in body["Answer"]], ["192.0.2.1"])
+
+    def test_nxdomain(self):
+        for send in (self.get, self.post):
+            with self.subTest(send=send.__name__):
+                self.assert_negative(send("nxa.example.test"), 3)
+
+    def test_nodata(self):
+        for send in (self.get, self.post):
+            with self.subTest(send=send.__name__):
+                self.assert_negative(send("www.example.test", "AAAA"), 0)
+
+    def test_invalid_name(self):
+        for send in (self.get, self.post):
+            with self.subTest(send=send.__name__):
+                response = send("a..b")
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {"error": "Invalid domain name"})
+
+    def test_cached_upstream_nxdomain_keeps_its_soa(self):
+        soa = {"name": "example.com.", "type": 6, "TTL": 900,
+               "data": "ns.example.com. hostmaster.example.com. 1 3600 600 86400 900"}
+        upstream = self.upstream_async({"Status": 3, "Answer": [], "Authority": [soa]})
+
+        for _ in range(2):
+            response = self.get("nx.example.com")
+            self.assertEqual(response["Cache-Control"], "max-age=900")
+            body = response.json()
+            self.assertEqual((body["Status"], body["Answer"]), (3, []))
+            self.assertEqual([(ns["name"], ns["TTL"]) for ns in body["Authority"]],
+                             [("example.com.", 900)])
+        self.assertEqual(upstream.await_count, 1)
+
+
+class BatchQueryTests(DoHTestCase):
+    QUERIES = [
+        {"name": "www.example.test"},
+        {"name": "nxa.example.test", "type": "a"},
+        {"type": "A"},
+        {"name": "www.example.test", "type": "AAAA"},
+        {"name": "a..b"},
+        "www.example.test",
+        {"name": "www.example.test", "type": "BOGUS"},
+        {"name": "WWW.example.test"},
+    ]
+
+    def post(self, queries, **headers):
+        return self.client.post(
+            "/dns-query", {"queries": queries}, content_type="application/json", headers=headers
+        )
+
+    def assert_results(self, results):
+        summary = [
+            item.get("error")
+            or (item["Status"], item["TTL"], [ans["data"] for ans in item["Answer"]])
+            for item in results
+        ]
+        self.assertEqual(summary, [
+            (0, 300, ["192.0.2.1"]),
+            (3, LOCAL_NEGATIVE_TTL, []),
+            "'name' is required",
+            (0, LOCAL_NEGATIVE_TTL, []),
+            "Invalid domain name",
+            "Each query must be an object",
+            "Unsupported record type 'BOGUS'",
+            (0, 300, ["192.0.2.1"]),
+        ])
+        self.assertEqual(results[1]["Authority"][0]["name"], "example.test.")
+
+    def test_results_follow_the_questions(self):
+        response = self.post(self.QUERIES)
+        self.assertEqual(response.status_code, 200)
+        # The errors are not cacheable, so neither is the batch.
+        self.assertEqual(response["Cache-Control"], "max-age=0")
+        self.assert_results(response.json()["Responses"])
+
+    def test_max_age_is_the_smallest_ttl(self):
+        response = self.post([{"name": "www.example.test"}, {"name": "nxa.example.test"}])
+        self.assertEqual(response["Cache-Control"], f"max-age={min(300, LOCAL_NEGATIVE_TTL)}")
+
+    async def test_ndjson_lines_carry_their_index(self):
+        response = await self.async_client.post(
+            "/dns-query", {"queries": self.QUERIES}, content_type="application/json",
+            headers={"accept": "application/x-ndjson"},
+        )
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+
+        lines = [json.loads(chunk) async for chunk in response.streaming_content]
+        self.assertEqual(sorted(line["index"] for line in lines), list(range(len(self.QUERIES))))
+        self.assert_results(sorted(lines, key=lambda line: line["index"]))
+
+    def test_batch_size_is_limited(self):
+        self.assertEqual(self.post([]).status_code, 400)
+        with mock.patch("doh.views.MAX_BATCH_SIZE", 2):
+            self.assertEqual(self.post(self.QUERIES[:3]).status_code, 400)
+
+
+class ASGIApplicationTests(DoHTestCase):
+    def setUp(self):
+        super().setUp()
+        self.django_app = mock.AsyncMock()
+        self.app = DoHApplication(self.django_app)
+
+    async def call(self, method="GET", path="/dns-query", query_string=b"", body=b"",
+                   content_type=None):
+        headers = [(b"content-type", content_type.encode())] if content_type else []
+        scope = {"type": "http", "method": method, "path": path,
+                 "query_string": query_string, "headers": headers, "client": ("192.0.2.9", 5000)}
+        chunks = [{"type": "http.request", "body": body[:10], "more_body": True},
+                  {"type": "http.request", "body": body[10:]}]
+        sent = []
+
+        async def receive():
+            return chunks.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app(scope, receive, send)
+        if not sent:
+            return None
+        start, body = sent
+        return start["status"], dict(start["headers"]), body["body"]
+
+    async def query(self, name, method="GET"):
+        query = dns.message.make_query(name, "A")
+        if method == "GET":
+            encoded = base64.urlsafe_b64encode(query.to_wire()).rstrip(b"=")
+            result = await self.call(query_string=b"dns=" + encoded)
+        else:
+            result = await self.call("POST", body=query.to_wire(), content_type=DNS_MESSAGE)
+        status, headers, body = result
+        self.assertEqual((status, headers[b"content-type"]), (200, DNS_MESSAGE.encode()))
+        response = dns.message.from_wire(body)
+        self.assertEqual(response.id, query.id)
+        return headers[b"cache-control"], response
+
+    async def test_wire_queries(self):
+        for method in ("GET", "POST"):
+            with self.subTest(method=method):
+                max_age, response = await self.query("www.example.test", method)
+                self.assertEqual(max_age, b"max-age=300")
+                self.assertEqual([rdata.address for rdata in response.answer[0]], ["192.0.2.1"])
+                self.django_app.assert_not_awaited()
+
+    async def test_negative_answer_max_age(self):
+        max_age, response = await self.query("nxa.example.test")
+        self.assertEqual(response.rcode(), dns.rcode.NXDOMAIN)
+        self.assertEqual(max_age, b"max-age=%d" % LOCAL_NEGATIVE_TTL)
+
+    async def test_invalid_queries(self):
+        status, _, body = await self.call(query_string=b"dns=abcde")
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(body), {"error": "Invalid base64url 'dns' parameter"})
+
+        status, _, _ = await self.call("POST", body=b"nope", content_type=DNS_MESSAGE)
+        self.assertEqual(status, 400)
+
+        with mock.patch("doh.asgi.MAX_MESSAGE_SIZE", 16):
+            status, _, _ = await self.call("POST", body=b"x" * 32, content_type=DNS_MESSAGE)
+        self.assertEqual(status, 413)
+
+    async def test_everything_else_goes_to_django(self):
+        requests = [
+            {"path": "/admin/record/"},
+            {"query_string": b"name=www.example.test"},
+            {"method": "POST", "body": b"{}", "content_type": "application/json"},
+            {"method": "PUT", "body": b"", "content_type": DNS_MESSAGE},
+        ]
+        for request in requests:
+            self.assertIsNone(await self.call(**request))
+        self.assertEqual(self.django_app.await_count, len(requests))
@@ -1,76 +1,245 @@
+import asyncio
+import base64
+import binascii
+import json
+
 import dns.exception as dexception
-import dns.rrset
 import dns.message as dmessage
-from django.http import HttpResponse
-from rest_framework.response import Response
-from rest_framework.views import APIView
-
-from dnsserver.handler import handle_query
-from dnsserver.response_builder import DNS_TYPE_MAP
-
-
-class DNSQueryView(APIView):
-
-
-    # def get(self, request):
-    #     name = request.query_params.get("name")
-    #     record_type = request.query_params.get("type", "A").upper()
-    #     accept = request.headers.get("Accept", "application/dns-json")
-    #
-    #     if not name:
-    #         return Response({"error": "Query parameter 'name' is required"}, status=400)
-    #
-    #     answers = handle_query(domain=name, record_type=record_type)
-    #
-    #     if accept == "application/dns-message":
-    #         query = dmessage.make_query(name, record_type)
-    #         response = dmessage.make_response(query)
-    #         for ans in answers:
-    #             rrset = dns.rrset.from_text(ans["name"], ans["TTL"], "IN", record_type, ans["data"])
-    #             response.answer.append(rrset)
-    #         return HttpResponse(response.to_wire(), content_type="application/dns-message")
-
-        # return Response({
-        #     "Status": 0,
-        #     "Question": [{"name": name, "type": DNS_TYPE_MAP[record_type]}],
-        #     "Answer": answers
-        # })
-
-    def post(self, request):
+import dns.rcode
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from dnsserver.handler import handle_query_async
+from dnsserver.response_builder import DNS_TYPE_MAP, badvers_response, min_ttl
+from dnsserver.upstream import response_to_dict
+
+DNS_MESSAGE = "application/dns-message"
+NDJSON = "application/x-ndjson"
+MAX_BATCH_SIZE = getattr(settings, "DNS_DOH_MAX_BATCH_SIZE", 100)
+
+
+def decode_base64url(value):
+    # RFC 8484 sends the query base64url-encoded with the padding stripped.
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def wire_max_age(wire):
+    # Only successful and NXDOMAIN answers are worth keeping in a cache.
+    rcode = wire[3] & 0x0F
+    if rcode not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+        return 0
+    return min_ttl(wire) or 0
+
+
+def cacheable(response, ttl):
+    # RFC 8484 section 5.1: an HTTP cache must not keep the answer longer
+    # than its smallest TTL.
+    patch_cache_control(response, max_age=ttl or 0)
+    return response
+
+
+def batch_questions(queries):
+    """
+    Validate a batch, returning ``(name, type)`` for each usable item and an
+    error string for each that is not, so one bad item fails on its own.
+    """
+
+    questions = []
+    for item in queries:
+        if not isinstance(item, dict):
+            questions.append("Each query must be an object")
+            continue
+
+        name = item.get("name")
+        record_type = str(item.get("type", "A")).upper()
+        if not name or not isinstance(name, str):
+            questions.append("'name' is required")
+        elif record_type not in DNS_TYPE_MAP:
+            questions.append(f"Unsupported record type '{record_type}'")
+        else:
+            questions.append((name, record_type))
+    return questions
+
+
+async def resolve_json(name, record_type):
+    # Goes through the wire path, like a DoH query, so the result carries
+    # the real RCODE and the TTLs as they stand in the cache.
+    try:
+        query = dmessage.make_query(name, record_type)
+    except (dexception.DNSException, ValueError):
+        return {"name": name, "type": record_type, "error": "Invalid domain name"}
+
+    wire = await handle_query_async(dns_request=query)
+    result = response_to_dict(name, record_type, dmessage.from_wire(wire))
+    result["Status"] = wire[3] & 0x0F
+    result["TTL"] = wire_max_age(wire)
+    return result
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class DNSQueryView(View):
+    """
+    DNS over HTTPS (RFC 8484), plus a JSON API.
+
+    GET  ?dns=<base64url wire query>      -> application/dns-message
+    GET  ?name=example.com&type=A         -> JSON (or wire, per Accept)
+    POST application/dns-message body     -> application/dns-message
+    POST application/json {"name", "type"} -> JSON (or wire, per Accept)
+    POST application/json {"queries": [{"name", "type"}, ...]}
+                                          -> JSON, or NDJSON per Accept
+
+    The handlers are async, so under ASGI (DNS/asgi.py) a cache miss waits
+    on upstream without holding a worker thread.
+
+    A batch resolves its questions concurrently and answers with one result
+    per question, in order, each with its own Status and TTL (the smallest
+    TTL of its records, 0 when it should not be cached). With
+    ``Accept: application/x-ndjson`` the results are instead streamed one
+    per line as they complete, tagged with their position in the batch.
+    """
+
+    async def get(self, request):
+        encoded = request.GET.get("dns")
+        if encoded is not None:
+            try:
+                wire = decode_base64url(encoded)
+            except (binascii.Error, ValueError):
+                return JsonResponse({"error": "Invalid base64url 'dns' parameter"}, status=400)
+            return await self.answer_wire(wire)
+
+        name = request.GET.get("name")
+        record_type = request.GET.get("type", "A").upper()
+
+        if not name:
+            return JsonResponse({"error": "Query parameter 'name' is required"}, status=400)
+
+        return await self.answer_json(request, name, record_type)
+
+    async def post(self, request):
         content_type = request.content_type
-        accept = request.headers.get("Accept", "application/dns-json")
 
         if content_type == "application/json":
-            name = request.data.get("name")
-            record_type = request.data.get("type", "A").upper()
+            try:
+                data = json.loads(request.body or b"{}")
+            except ValueError:
+                return JsonResponse({"error": "Invalid JSON body"}, status=400)
+
+            if isinstance(data, dict) and "queries" in data:
+                return await self.answer_batch(request, data["queries"])
+            if not isinstance(data, dict):
+                return JsonResponse({"error": "JSON body must be an object"}, status=400)
+
+            name = data.get("name")
+            record_type = str(data.get("type", "A")).upper()
 
             if not name:
-                return Response({"error": "'name' is required"}, status=400)
-
-            answers = handle_query(domain=name, record_type=record_type)
-
-            if accept == "application/dns-message":
-                import dns.message
-                query = dns.message.make_query(name, record_type)
-                import dns.rrset
-                response = dns.message.make_response(query)
-                for ans in answers:
-                    rrset = dns.rrset.from_text(ans["name"], ans["TTL"], "IN", record_type, ans["data"])
-                    response.answer.append(rrset)
-                return HttpResponse(response.to_wire(), content_type="application/dns-message")
-
-            return Response({
-                "Status": 0,
-                "Question": [{"name": name, "type": DNS_TYPE_MAP[record_type]}],
-                "Answer": answers
-            })
-
-        if content_type == "application/dns-message":
+                return JsonResponse({"error": "'name' is required"}, status=400)
+
+            return await self.answer_json(request, name, record_type)
+
+        if content_type == DNS_MESSAGE:
+            return await self.answer_wire(request.body)
+
+        return JsonResponse({"error": "Unsupported Content-Type"}, status=415)
+
+    async def answer_wire(self, wire):
+        try:
+            dns_request = dmessage.from_wire(wire)
+        except dexception.DNSException:
+            return JsonResponse({"error": "Invalid DNS binary message"}, status=400)
+
+        if not dns_request.question:
+            return JsonResponse({"error": "DNS message has no question"}, status=400)
+
+        response = badvers_response(dns_request) or await handle_query_async(
+            dns_request=dns_request
+        )
+        return self.wire_response(response)
+
+    async def answer_json(self, request, name, record_type):
+        if record_type not in DNS_TYPE_MAP:
+            return JsonResponse({"error": f"Unsupported record type '{record_type}'"}, status=400)
+
+        if request.headers.get("Accept") == DNS_MESSAGE:
             try:
-                dns_request = dmessage.from_wire(request.body)
-                response = handle_query(dns_request=dns_request)
-                return HttpResponse(response, content_type="application/dns-message")
-            except dexception.DNSException:
-                return Response({"error": "Invalid DNS binary message"}, status=400)
+                query = dmessage.make_query(name, record_type)
+            except (dexception.DNSException, ValueError):
+                return JsonResponse({"error": "Invalid domain name"}, status=400)
+            response = await handle_query_async(dns_request=query)
+            return self.wire_response(response)
+
+        result = await resolve_json(name, record_type)
+        if "error" in result:
+            return JsonResponse({"error": result["error"]}, status=400)
+
+        ttl = result.pop("TTL")
+        return cacheable(JsonResponse(result), ttl)
+
+    async def answer_batch(self, request, queries):
+        if not isinstance(queries, list) or not queries:
+            return JsonResponse({"error": "'queries' must be a non-empty list"}, status=400)
+        if len(queries) > MAX_BATCH_SIZE:
+            return JsonResponse(
+                {"error": f"At most {MAX_BATCH_SIZE} queries per batch"}, status=400
+            )
+
+        # A question asked twice in one batch is resolved once.
+        questions = batch_questions(queries)
+        tasks = {}
+        for question in questions:
+            if isinstance(question, tuple):
+                key = (question[0].lower(), question[1])
+                if key not in tasks:
+                    tasks[key] = asyncio.ensure_future(resolve_json(*question))
+
+        def result(index):
+            question = questions[index]
+            if isinstance(question, str):
+                item = queries[index]
+                return {
+                    "name": item.get("name") if isinstance(item, dict) else None,
+                    "error": question,
+                }
+            return tasks[(question[0].lower(), question[1])].result()
+
+        if request.headers.get("Accept") == NDJSON:
+            return StreamingHttpResponse(
+                self.stream_batch(questions, tasks, result), content_type=NDJSON
+            )
+
+        if tasks:
+            await asyncio.wait(tasks.values())
+        results = [result(index) for index in range(len(questions))]
+        response = JsonResponse({"Status": 0, "Responses": results})
+        return cacheable(response, min((item.get("TTL", 0) for item in results), default=0))
+
+    @staticmethod
+    async def stream_batch(questions, tasks, result):
+        # Invalid items are known up front; the rest are sent as soon as
+        # their lookup finishes, whatever their position in the batch.
+        waiting = {}
+        for index, question in enumerate(questions):
+            if isinstance(question, str):
+                yield json.dumps({"index": index, **result(index)}) + "\n"
+            else:
+                waiting.setdefault(tasks[(question[0].lower(), question[1])], []).append(index)
+
+        try:
+            while waiting:
+                done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for index in waiting.pop(task):
+                        yield json.dumps({"index": index, **result(index)}) + "\n"
+        finally:
+            # The client went away. Upstream lookups run as tasks of their
+            # own, so they still complete and fill the cache.
+            for task in waiting:
+                task.cancel()
 
-        return Response({"error": "Unsupported Content-Type"}, status=415)
+    def wire_response(self, wire):
+        response = HttpResponse(wire, content_type=DNS_MESSAGE)
+        return cacheable(response, wire_max_age(wire))
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class RecordsConfig(AppConfig):
     name = 'records'
+
+    def ready(self):
+        from . import signals  # noqa: F401
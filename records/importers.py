@@ -0,0 +1,410 @@
+import codecs
+import json
+import re
+
+import dns.exception
+import dns.ttl
+from django.db import transaction
+from django.db.models import Max
+from rest_framework import serializers
+
+from .models import DNSRecord, RecordType, reverse_domain
+from .serializers import DNSRecordImportSerializer
+from .signals import log_full_reload, log_record_changes
+
+IMPORT_CHUNK_SIZE = 1000
+
+# An import touching more (domain, type) keys than this logs one full
+# reload instead: each DNS server reloading its zone index once is then
+# cheaper than refreshing every key on its own.
+MAX_LOGGED_KEYS = 1000
+
+# Errors beyond this many are counted but not listed, so a file in the
+# wrong format does not produce a response as large as the file.
+MAX_REPORTED_ERRORS = 1000
+
+FORMATS = ("json", "ndjson", "zone")
+
+JSON_READ_SIZE = 64 * 1024
+# Largest single JSON value (one record, or a key's value skipped on the
+# way to "records") held in memory while reading a JSON body.
+MAX_JSON_VALUE_SIZE = 1024 * 1024
+JSON_WHITESPACE = " \t\n\r"
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+class JSONReader:
+    """
+    Reads a JSON document from a stream one value at a time, so a large
+    array of records is decoded record by record and only the values not
+    yet consumed are kept in memory.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+
+        chunk = self.stream.read(JSON_READ_SIZE)
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk, final=not chunk)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """The next non-whitespace character, or "" at the end."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in JSON_WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def take(self, expected: str) -> str:
+        char = self.peek()
+        if not char or char not in expected:
+            found = repr(char) if char else "end of input"
+            raise ImportFormatError(f"Invalid JSON: expected {' or '.join(expected)}, found {found}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buffer, self.pos)
+            except ValueError as e:
+                error = e
+            else:
+                # A number at the end of the buffer may go on in the next read.
+                if end < len(self.buffer) or not self.fill():
+                    self.pos = end
+                    return value
+                continue
+
+            # The value may simply not have been read in full yet.
+            if len(self.buffer) - self.pos > MAX_JSON_VALUE_SIZE or not self.fill():
+                raise ImportFormatError(f"Invalid JSON: {error}")
+
+    def array(self):
+        """Yield the values of the array starting here."""
+        self.take("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.take(",]") == "]":
+                return
+
+    def find_key(self, wanted: str) -> bool:
+        """Skip the object starting here up to the value of ``wanted``."""
+        self.take("{")
+        if self.peek() == "}":
+            return False
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ImportFormatError("Invalid JSON: object keys must be strings")
+            self.take(":")
+            if key == wanted:
+                return True
+            self.value()
+            if self.take(",}") == "}":
+                return False
+
+
+def parse_json(stream):
+    """
+    Yield ``(row, data)`` from a JSON array of records, or from an object
+    with a "records" array, decoding one record at a time.
+    """
+
+    reader = JSONReader(stream)
+    if reader.peek() == "{" and not reader.find_key("records"):
+        raise ImportFormatError("Expected a JSON array of records")
+    if reader.peek() != "[":
+        raise ImportFormatError("Expected a JSON array of records")
+
+    for row, item in enumerate(reader.array(), start=1):
+        yield row, item
+
+
+def parse_ndjson(stream):
+    """
+    Yield ``(line number, data)`` for each non-blank line of an NDJSON
+    stream, reading one line at a time. A line that is not valid JSON
+    yields an ImportFormatError as its data, so it is reported per row.
+    """
+
+    for row, line in enumerate(stream, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            yield row, json.loads(line)
+        except ValueError as e:
+            yield row, ImportFormatError(f"Invalid JSON: {e}")
+
+
+ZONE_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[()]|;.*|[^\s"();]+')
+ZONE_CLASSES = {"IN", "CH", "HS", "CS"}
+NAME_TYPES = {"CNAME", "NS", "PTR"}
+
+
+def zone_entries(stream):
+    """
+    Yield ``(line number, tokens, has_owner)`` for each logical entry of a
+    zone file, with comments stripped and ( ... ) continuations joined.
+    """
+
+    tokens, lineno, has_owner, depth = [], None, True, 0
+
+    for number, line in enumerate(stream, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+
+        if depth == 0:
+            tokens, lineno = [], number
+            # An entry starting with whitespace reuses the previous owner.
+            has_owner = bool(line) and not line[0].isspace()
+
+        for token in ZONE_TOKEN_RE.findall(line):
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth = max(depth - 1, 0)
+            elif not token.startswith(";"):
+                tokens.append(token)
+
+        if depth == 0 and tokens:
+            yield lineno, tokens, has_owner
+
+    if depth and tokens:
+        yield lineno, tokens, has_owner
+
+
+def zone_name(name, origin):
+    if name == "@":
+        if origin is None:
+            raise ImportFormatError("@ used without $ORIGIN")
+        name = origin
+    elif not name.endswith("."):
+        if origin is None:
+            raise ImportFormatError(f"Relative name '{name}' with no $ORIGIN")
+        name = f"{name}.{origin}" if origin != "." else f"{name}."
+    return name.rstrip(".") or "."
+
+
+def txt_value(tokens):
+    # Character-strings are concatenated, as the rest of the server does.
+    return "".join(
+        re.sub(r"\\(.)", r"\1", token[1:-1]) if token.startswith('"') else token
+        for token in tokens
+    )
+
+
+def zone_record(tokens, owner, origin, default_ttl):
+    ttl = None
+    record_type = None
+
+    while tokens:
+        token = tokens.pop(0)
+        if token.upper() in ZONE_CLASSES:
+            continue
+        if ttl is None and token[0].isdigit():
+            ttl = dns.ttl.from_text(token)
+            continue
+        record_type = token.upper()
+        break
+
+    if record_type is None:
+        raise ImportFormatError("Missing record type")
+    if record_type not in RecordType.values:
+        return ttl, None
+
+    record = {"domain": zone_name(owner, origin), "record_type": record_type}
+    if ttl is not None or default_ttl is not None:
+        record["ttl"] = ttl if ttl is not None else default_ttl
+
+    if record_type == "TXT":
+        record["value"] = txt_value(tokens)
+    elif record_type == "MX":
+        if len(tokens) != 2:
+            raise ImportFormatError("MX needs a preference and an exchange")
+        record["priority"] = tokens[0]
+        record["value"] = zone_name(tokens[1], origin)
+    elif len(tokens) != 1:
+        raise ImportFormatError(f"{record_type} needs exactly one value")
+    elif record_type in NAME_TYPES:
+        record["value"] = zone_name(tokens[0], origin)
+    else:
+        record["value"] = tokens[0]
+
+    return ttl, record
+
+
+def parse_zone(stream, origin=None):
+    """
+    Yield ``(line number, data)`` for every record of a BIND zone file whose
+    type DNSRecord can store, reading one line at a time. SOA and other
+    unsupported types are skipped; $ORIGIN and $TTL are honoured, and a
+    malformed entry yields an ImportFormatError as its data.
+    """
+
+    origin = origin if origin is None or origin.endswith(".") else origin + "."
+    default_ttl = None
+    owner = None
+
+    for lineno, tokens, has_owner in zone_entries(stream):
+        try:
+            if tokens[0].startswith("$"):
+                directive = tokens[0].upper()
+                if directive == "$ORIGIN" and len(tokens) > 1:
+                    origin = zone_name(tokens[1], origin).rstrip(".") + "."
+                elif directive == "$TTL" and len(tokens) > 1:
+                    default_ttl = dns.ttl.from_text(tokens[1])
+                else:
+                    raise ImportFormatError(f"Unsupported directive {tokens[0]}")
+                continue
+
+            if has_owner:
+                owner = tokens.pop(0)
+            if owner is None:
+                raise ImportFormatError("Record has no owner name")
+
+            ttl, record = zone_record(tokens, owner, origin, default_ttl)
+            if default_ttl is None and ttl is not None:
+                # RFC 1035: without $TTL, the last explicit TTL carries over.
+                default_ttl = ttl
+        except (ImportFormatError, dns.exception.DNSException) as e:
+            yield lineno, ImportFormatError(str(e))
+            continue
+
+        if record is not None:
+            yield lineno, record
+
+
+def parse_records(stream, fmt, origin=None):
+    if fmt == "json":
+        return parse_json(stream)
+    if fmt == "ndjson":
+        return parse_ndjson(stream)
+    if fmt == "zone":
+        return parse_zone(stream, origin)
+    raise ImportFormatError(f"Unknown format '{fmt}', expected one of {', '.join(FORMATS)}")
+
+
+def validate_chunk(chunk):
+    records = []
+    errors = []
+
+    # Building a ModelSerializer's fields costs far more than validating a
+    # row, so one instance validates the whole chunk via run_validation.
+    serializer = DNSRecordImportSerializer()
+
+    for row, data in chunk:
+        if isinstance(data, Exception):
+            errors.append({"row": row, "errors": str(data)})
+            continue
+        if not isinstance(data, dict):
+            errors.append({"row": row, "errors": "Expected a JSON object"})
+            continue
+
+        if "type" in data and "record_type" not in data:
+            data = dict(data, record_type=data["type"])
+
+        try:
+            record = DNSRecord(**serializer.run_validation(data))
+            # bulk_create skips save(), which normally fills this in.
+            record.reversed_domain = reverse_domain(record.domain)
+            records.append(record)
+        except serializers.ValidationError as e:
+            errors.append({"row": row, "errors": e.detail})
+
+    return records, errors
+
+
+def chunked(rows, size):
+    chunk = []
+    for item in rows:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_records(rows, chunk_size=IMPORT_CHUNK_SIZE, ignore_conflicts=True):
+    """
+    Validate ``(row, data)`` pairs in chunks with the DNSRecordSerializer
+    rules and insert the valid ones with bulk_create, all in one transaction.
+
+    Rows that fail validation are reported and skipped. Records that already
+    exist are skipped too, unless ``ignore_conflicts`` is False, in which
+    case the IntegrityError rolls the whole import back.
+
+    Bulk inserts bypass the post_save signals, so the (domain, type) keys
+    of the imported records are written to the change log once the
+    transaction commits, or a single full-reload entry past MAX_LOGGED_KEYS.
+    """
+
+    errors = []
+    total = invalid = created = 0
+    keys = set()
+
+    with transaction.atomic():
+        # Skipped conflicts are not reported by bulk_create, so the records
+        # created are counted afterwards: those with a higher id than any
+        # before the import.
+        last_id = DNSRecord.objects.aggregate(last_id=Max("id"))["last_id"] or 0
+
+        for chunk in chunked(rows, chunk_size):
+            records, chunk_errors = validate_chunk(chunk)
+            DNSRecord.objects.bulk_create(records, ignore_conflicts=ignore_conflicts)
+
+            total += len(chunk)
+            invalid += len(chunk_errors)
+            created += len(records)
+            errors.extend(chunk_errors[:MAX_REPORTED_ERRORS - len(errors)])
+
+            # Skipped conflicts are logged too; invalidating them is harmless.
+            if keys is not None:
+                keys.update((record.domain, record.record_type) for record in records)
+                if len(keys) > MAX_LOGGED_KEYS:
+                    keys = None
+
+        if ignore_conflicts and created:
+            created = DNSRecord.objects.filter(id__gt=last_id).count()
+        if created and keys is None:
+            transaction.on_commit(log_full_reload)
+        elif created:
+            transaction.on_commit(lambda: log_record_changes(*keys))
+
+    return {
+        "total": total,
+        "created": created,
+        "skipped": total - created - invalid,
+        "invalid": invalid,
+        "errors": errors,
+    }
@@ -0,0 +1,72 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from records.importers import (
+    FORMATS,
+    IMPORT_CHUNK_SIZE,
+    ImportFormatError,
+    import_records,
+    parse_records,
+)
+
+EXTENSION_FORMATS = {
+    ".json": "json",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+}
+
+
+class Command(BaseCommand):
+    help = "Bulk import DNS records from a JSON, NDJSON or BIND zone file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--format",
+            choices=FORMATS,
+            help="defaults to json/ndjson by file extension, zone otherwise",
+        )
+        parser.add_argument("--origin", help="origin for relative names in a zone file")
+        parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+        parser.add_argument(
+            "--fail-on-conflict",
+            action="store_true",
+            help="roll back the whole import if any record already exists",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"]
+        if fmt is None:
+            fmt = next(
+                (f for ext, f in EXTENSION_FORMATS.items() if path.endswith(ext)),
+                "zone",
+            )
+
+        started = time.monotonic()
+        try:
+            with open(path, "rb") as stream:
+                rows = parse_records(stream, fmt, options["origin"])
+                result = import_records(
+                    rows,
+                    chunk_size=options["chunk_size"],
+                    ignore_conflicts=not options["fail_on_conflict"],
+                )
+        except OSError as e:
+            raise CommandError(str(e))
+        except ImportFormatError as e:
+            raise CommandError(str(e))
+        except IntegrityError:
+            raise CommandError("Import contains existing records; nothing was imported")
+
+        for error in result["errors"]:
+            self.stderr.write(f"row {error['row']}: {json.dumps(error['errors'])}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['created']} created, {result['skipped']} already present, "
+            f"{result['invalid']} invalid of {result['total']} rows "
+            f"in {time.monotonic() - started:.2f}s"
+        ))
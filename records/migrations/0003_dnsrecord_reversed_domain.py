@@ -0,0 +1,42 @@
+# Generated by Django 6.0 on 2026-10-18 17:12
+
+from django.db import migrations, models
+
+
+def fill_reversed_domain(apps, schema_editor):
+    from records.models import reverse_domain
+
+    DNSRecord = apps.get_model('records', 'DNSRecord')
+    records = DNSRecord.objects.only('id', 'domain')
+    batch = []
+    for record in records.iterator(chunk_size=2000):
+        record.reversed_domain = reverse_domain(record.domain)
+        batch.append(record)
+        if len(batch) >= 2000:
+            DNSRecord.objects.bulk_update(batch, ['reversed_domain'])
+            batch = []
+    DNSRecord.objects.bulk_update(batch, ['reversed_domain'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('records', '0002_recordchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dnsrecord',
+            name='reversed_domain',
+            field=models.CharField(default='', editable=False, max_length=256),
+        ),
+        migrations.RunPython(fill_reversed_domain, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='dnsrecord',
+            index=models.Index(fields=['domain', 'id'], name='records_dns_domain_cd02c3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dnsrecord',
+            index=models.Index(fields=['reversed_domain', 'id'], name='records_dns_reverse_59acd0_idx'),
+        ),
+    ]
@@ -11,11 +11,23 @@ class RecordType(models.TextChoices):
     NS = "NS", "NS"
 
 
+def reverse_domain(domain):
+    # "www.Example.com" -> "com.example.www." so every name under a zone
+    # shares the zone's reversed prefix and suffix filters can use an index.
+    return ".".join(reversed(domain.lower().rstrip(".").split("."))) + "."
+
+
 class DNSRecord(models.Model):
     domain = models.CharField(
         max_length=255
     )
 
+    reversed_domain = models.CharField(
+        max_length=256,
+        editable=False,
+        default=""
+    )
+
     record_type = models.CharField(
         max_length=10,
         choices=RecordType.choices,
@@ -41,6 +53,8 @@ class DNSRecord(models.Model):
     class Meta:
         indexes = [
             models.Index(fields=["domain", "record_type"]),
+            models.Index(fields=["domain", "id"]),
+            models.Index(fields=["reversed_domain", "id"]),
         ]
         unique_together = ("domain", "record_type", "value")
         verbose_name = "DNS Record"
@@ -48,3 +62,40 @@ class DNSRecord(models.Model):
 
     def __str__(self):
         return f"{self.domain} {self.record_type} {self.value}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The key the row is stored under, so the post_save/post_delete
+        # receivers can drop the old key when a record is renamed.
+        if "domain" in field_names and "record_type" in field_names:
+            instance._original_key = (instance.domain, instance.record_type)
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.reversed_domain = reverse_domain(self.domain)
+        super().save(*args, **kwargs)
+        self._original_key = (self.domain, self.record_type)
+
+
+class RecordChange(models.Model):
+    # Append-only log of record writes. DNS server processes poll it to
+    # drop stale cache entries; an empty domain means "everything changed".
+    domain = models.CharField(
+        max_length=255,
+        blank=True
+    )
+
+    record_type = models.CharField(
+        max_length=10,
+        blank=True
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = "Record Change"
+        verbose_name_plural = "Record Changes"
+
+    def __str__(self):
+        return f"{self.domain or '*'} {self.record_type or '*'}"
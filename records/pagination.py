@@ -0,0 +1,70 @@
+import base64
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on (domain, id), or on the ordering the view's
+    ``get_keyset_ordering()`` picks: a column and then "id".
+
+    Each page continues strictly after the last row of the previous one, so
+    the database seeks straight to it through the matching index however
+    deep the client pages, and concurrent inserts never shift rows between
+    pages the way OFFSET does.
+    """
+
+    ordering = ("domain", "id")
+    page_size = 1000
+    max_page_size = 10_000
+    cursor_query_param = "cursor"
+    page_size_query_param = "limit"
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: "must be an integer"})
+        return max(1, min(size, self.max_page_size))
+
+    def get_ordering(self, view):
+        if view is not None and hasattr(view, "get_keyset_ordering"):
+            return view.get_keyset_ordering()
+        return self.ordering
+
+    def encode_cursor(self, record, field):
+        position = json.dumps([getattr(record, field), record.pk]).encode()
+        return base64.urlsafe_b64encode(position).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return str(value), int(pk)
+        except (ValueError, TypeError):
+            raise ValidationError({self.cursor_query_param: "invalid cursor"})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_size = self.get_page_size(request)
+        field, _ = ordering = self.get_ordering(view)
+        queryset = queryset.order_by(*ordering)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            value, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(**{f"{field}__gt": value}) | Q(**{field: value, "id__gt": pk})
+            )
+
+        page = list(queryset[:page_size + 1])
+        self.next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_cursor = self.encode_cursor(page[-1], field)
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({"status": "success", "data": data, "next": self.next_cursor})
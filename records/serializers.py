@@ -35,3 +35,10 @@ class DNSRecordSerializer(serializers.ModelSerializer):
             )
 
         return attrs
+
+
+class DNSRecordImportSerializer(DNSRecordSerializer):
+    # Bulk imports rely on the database constraint (bulk_create with
+    # ignore_conflicts) instead of one unique_together query per row.
+    class Meta(DNSRecordSerializer.Meta):
+        validators = []
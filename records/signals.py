@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import DNSRecord, RecordChange
+
+CHANGE_LOG_RETENTION = timedelta(hours=1)
+
+
+def log_record_changes(*keys):
+    RecordChange.objects.bulk_create(
+        [RecordChange(domain=domain, record_type=record_type) for domain, record_type in keys]
+    )
+    RecordChange.objects.filter(
+        created_at__lt=timezone.now() - CHANGE_LOG_RETENTION
+    ).delete()
+
+
+def log_full_reload():
+    log_record_changes(("", ""))
+
+
+@receiver(post_save, sender=DNSRecord, dispatch_uid="record_change_save")
+def record_saved(sender, instance, **kwargs):
+    key = (instance.domain, instance.record_type)
+    original = getattr(instance, "_original_key", key)
+
+    if original != key and original[0]:
+        log_record_changes(original, key)
+    else:
+        log_record_changes(key)
+
+
+@receiver(post_delete, sender=DNSRecord, dispatch_uid="record_change_delete")
+def record_deleted(sender, instance, **kwargs):
+    log_record_changes(getattr(instance, "_original_key", (instance.domain, instance.record_type)))
@@ -1,3 +1,195 @@
+import io
+import json
+from unittest import mock
+
 from django.test import TestCase
 
-# Create your tests here.
+from records import importers
+from records.importers import ImportFormatError, import_records, parse_records
+from records.models import DNSRecord, RecordChange
+
+
+ZONE = b"""\
+$ORIGIN example.test.
+$TTL 600
+@       IN  SOA  ns1 hostmaster 1 3600 600 86400 300
+@       IN  NS   ns1
+        IN  MX   10 mail
+www     300 IN A 192.0.2.1
+mail    IN  A    192.0.2.2
+alias   IN  CNAME www
+txt     IN  TXT  "hello " "world"
+$ORIGIN sub.example.test.
+@       IN  A    192.0.2.3
+"""
+
+
+def parse(body, fmt, origin=None):
+    return list(parse_records(io.BytesIO(body), fmt, origin))
+
+
+def records(body, fmt, origin=None):
+    return [data for _, data in parse(body, fmt, origin)]
+
+
+class ImporterTests(TestCase):
+    def test_json_array(self):
+        body = json.dumps([
+            {"domain": "a.test", "type": "A", "value": "192.0.2.1"},
+            {"domain": "b.test", "record_type": "TXT", "value": "x"},
+        ]).encode()
+        self.assertEqual(
+            parse(body, "json"),
+            [
+                (1, {"domain": "a.test", "type": "A", "value": "192.0.2.1"}),
+                (2, {"domain": "b.test", "record_type": "TXT", "value": "x"}),
+            ],
+        )
+
+    def test_json_object_with_records(self):
+        body = b'{"version": {"n": [1, 2]}, "records": [{"domain": "a.test"}, 12345], "x": 1}'
+        self.assertEqual(records(body, "json"), [{"domain": "a.test"}, 12345])
+        self.assertEqual(records(b"[]", "json"), [])
+
+    def test_json_is_read_incrementally(self):
+        body = json.dumps(
+            [{"domain": f"host{i}.test", "value": "192.0.2.1", "ttl": 12345} for i in range(50)]
+        ).encode()
+        stream = io.BytesIO(body)
+        with mock.patch.object(importers, "JSON_READ_SIZE", 7):
+            rows = parse_records(stream, "json")
+            self.assertEqual(next(rows), (1, {"domain": "host0.test", "value": "192.0.2.1", "ttl": 12345}))
+            self.assertLess(stream.tell(), len(body) // 10)
+            self.assertEqual(len(list(rows)), 49)
+
+    def test_invalid_json(self):
+        for body in (b'[{"domain": "a.test"}', b'{"domain": "a.test"}', b'[1 2]', b"nope"):
+            with self.subTest(body=body), self.assertRaises(ImportFormatError):
+                records(body, "json")
+
+    def test_ndjson_reports_bad_lines_per_row(self):
+        rows = parse(b'{"domain": "a.test"}\n\nnot json\n{"domain": "b.test"}\n', "ndjson")
+        self.assertEqual([row for row, _ in rows], [1, 3, 4])
+        self.assertIsInstance(rows[1][1], ImportFormatError)
+        self.assertEqual(rows[2][1], {"domain": "b.test"})
+
+    def test_zone_file(self):
+        self.assertEqual(records(ZONE, "zone"), [
+            {"domain": "example.test", "record_type": "NS", "ttl": 600, "value": "ns1.example.test"},
+            {"domain": "example.test", "record_type": "MX", "ttl": 600,
+             "priority": "10", "value": "mail.example.test"},
+            {"domain": "www.example.test", "record_type": "A", "ttl": 300, "value": "192.0.2.1"},
+            {"domain": "mail.example.test", "record_type": "A", "ttl": 600, "value": "192.0.2.2"},
+            {"domain": "alias.example.test", "record_type": "CNAME", "ttl": 600,
+             "value": "www.example.test"},
+            {"domain": "txt.example.test", "record_type": "TXT", "ttl": 600, "value": "hello world"},
+            {"domain": "sub.example.test", "record_type": "A", "ttl": 600, "value": "192.0.2.3"},
+        ])
+
+    def test_zone_origin_parameter(self):
+        self.assertEqual(
+            records(b"@ 60 IN A 192.0.2.1\nwww 60 IN A 192.0.2.2\n", "zone", origin="example.test"),
+            [
+                {"domain": "example.test", "record_type": "A", "ttl": 60, "value": "192.0.2.1"},
+                {"domain": "www.example.test", "record_type": "A", "ttl": 60, "value": "192.0.2.2"},
+            ],
+        )
+
+    def test_zone_names_without_origin_are_row_errors(self):
+        rows = parse(b"@ IN A 192.0.2.1\nwww IN A 192.0.2.2\nok.test. IN A 192.0.2.3\n", "zone")
+        self.assertEqual(str(rows[0][1]), "@ used without $ORIGIN")
+        self.assertIsInstance(rows[1][1], ImportFormatError)
+        self.assertEqual(rows[2], (3, {"domain": "ok.test", "record_type": "A", "value": "192.0.2.3"}))
+
+    def test_import_records(self):
+        DNSRecord.objects.create(domain="www.example.test", record_type="A", value="192.0.2.1")
+
+        result = import_records(parse(ZONE + b"bad IN MX mail\n", "zone"), chunk_size=3)
+
+        self.assertEqual(
+            {key: result[key] for key in ("total", "created", "skipped", "invalid")},
+            {"total": 8, "created": 6, "skipped": 1, "invalid": 1},
+        )
+        self.assertEqual(result["errors"][0]["row"], 12)
+        self.assertEqual(
+            DNSRecord.objects.get(domain="alias.example.test").reversed_domain,
+            "test.example.alias.",
+        )
+
+    def logged_changes(self, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            import_records(parse(ZONE, "zone"), **kwargs)
+        return set(RecordChange.objects.values_list("domain", "record_type"))
+
+    def test_import_logs_the_keys_it_touched(self):
+        self.assertEqual(self.logged_changes(), {
+            ("example.test", "NS"), ("example.test", "MX"), ("www.example.test", "A"),
+            ("mail.example.test", "A"), ("alias.example.test", "CNAME"),
+            ("txt.example.test", "TXT"), ("sub.example.test", "A"),
+        })
+
+    def test_large_import_logs_a_full_reload(self):
+        with mock.patch.object(importers, "MAX_LOGGED_KEYS", 3):
+            self.assertEqual(self.logged_changes(chunk_size=2), {("", "")})
+
+    def test_bulk_import_reports_at_without_origin_as_invalid(self):
+        response = self.client.post(
+            "/admin/record/bulk/", b"@ IN A 192.0.2.1\n", content_type="text/dns"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["invalid"], 1)
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for domain in ("b.example.test", "a.example.test", "example.test", "c.other.test"):
+            DNSRecord.objects.create(domain=domain, record_type="A", value="192.0.2.1")
+            DNSRecord.objects.create(domain=domain, record_type="TXT", value="x")
+
+    def pages(self, **params):
+        pages = []
+        cursor = None
+        while True:
+            query = dict(params, **({"cursor": cursor} if cursor else {}))
+            body = self.client.get("/admin/record/", query).json()
+            pages.append([(record["domain"], record["record_type"]) for record in body["data"]])
+            cursor = body["next"]
+            if cursor is None:
+                return pages
+
+    def test_pages_follow_domain_then_id(self):
+        pages = self.pages(limit=3)
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(sum(pages, []), [
+            (domain, record_type)
+            for domain in ("a.example.test", "b.example.test", "c.other.test", "example.test")
+            for record_type in ("A", "TXT")
+        ])
+
+    def test_suffix_pages_follow_reversed_domain(self):
+        self.assertEqual(sum(self.pages(limit=2, domain_suffix="example.test"), []), [
+            (domain, record_type)
+            for domain in ("example.test", "a.example.test", "b.example.test")
+            for record_type in ("A", "TXT")
+        ])
+
+    def test_cursor_skips_rows_inserted_before_it(self):
+        first = self.client.get("/admin/record/", {"limit": 4}).json()
+        DNSRecord.objects.create(domain="a.aaa.test", record_type="A", value="192.0.2.1")
+
+        rest = self.client.get("/admin/record/", {"limit": 10, "cursor": first["next"]}).json()
+        self.assertEqual(rest["data"][0]["domain"], "c.other.test")
+        self.assertEqual(len(first["data"]) + len(rest["data"]), 8)
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/admin/record/", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_export(self):
+        response = self.client.get("/admin/record/export/", {"domain_suffix": "other.test"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            [(json.loads(line)["domain"], json.loads(line)["record_type"]) for line in lines],
+            [("c.other.test", "A"), ("c.other.test", "TXT")],
+        )
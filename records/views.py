@@ -1,9 +1,44 @@
+import itertools
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, status, mixins
+from rest_framework.decorators import action
 from rest_framework.response import Response
 
-from .models import DNSRecord
+from .importers import ImportFormatError, import_records, parse_records
+from .models import DNSRecord, reverse_domain
+from .pagination import KeysetPagination
 from .serializers import DNSRecordSerializer
 
+EXPORT_CHUNK_SIZE = 2000
+
+IMPORT_CONTENT_TYPES = {
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "text/dns": "zone",
+    "text/plain": "zone",
+}
+
+
+async def iterate_in_thread(iterator, batch_size=EXPORT_CHUNK_SIZE):
+    """
+    Serve the strings of a blocking ``iterator`` to an async consumer,
+    joined ``batch_size`` at a time. Each batch is taken in the request's
+    sync thread, so a queryset iterator keeps using the same connection.
+    """
+
+    take = sync_to_async(lambda: "".join(itertools.islice(iterator, batch_size)))
+    while True:
+        chunk = await take()
+        if not chunk:
+            return
+        yield chunk
+
 
 class AdminRecordViewSet(
     mixins.CreateModelMixin,
@@ -12,8 +47,9 @@ class AdminRecordViewSet(
     viewsets.GenericViewSet,
 ):
 
-    queryset = DNSRecord.objects.all().order_by("domain")
+    queryset = DNSRecord.objects.all().order_by("domain", "id")
     serializer_class = DNSRecordSerializer
+    pagination_class = KeysetPagination
 
     lookup_url_kwarg = "domain"
     lookup_field = "domain"
@@ -81,11 +117,18 @@ class AdminRecordViewSet(
         )
 
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
-        domain = request.query_params.get("domain")
-        record_type = request.query_params.get("type")
-        value = request.query_params.get("value")
+    def filter_queryset(self, queryset):
+        params = self.request.query_params
+
+        domain = params.get("domain")
+        record_type = params.get("type")
+        value = params.get("value")
+        prefix = params.get("domain_prefix")
+        suffix = params.get("domain_suffix")
 
         if domain:
             queryset = queryset.filter(domain=domain)
@@ -94,5 +137,94 @@ class AdminRecordViewSet(
         if value:
             queryset = queryset.filter(value=value)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response({"status": "success", "data": serializer.data})
+        # Both are range scans rather than LIKE, which SQLite cannot serve
+        # from an index.
+        if prefix:
+            queryset = queryset.filter(domain__gte=prefix, domain__lt=prefix + "\U0010ffff")
+        if suffix:
+            # The zone itself and every name under it: "com.example." up
+            # to, but excluding, "com.example/".
+            reversed_suffix = reverse_domain(suffix)
+            queryset = queryset.filter(
+                reversed_domain__gte=reversed_suffix,
+                reversed_domain__lt=reversed_suffix[:-1] + "/",
+            )
+
+        return queryset
+
+    def get_keyset_ordering(self):
+        # A suffix filter scans the (reversed_domain, id) index, so its
+        # results are ordered and paged by that index too, without a sort.
+        if self.request.query_params.get("domain_suffix"):
+            return ("reversed_domain", "id")
+        return ("domain", "id")
+
+    @action(detail=False, methods=["get"], url_path="export")
+    def export(self, request):
+        """
+        Stream every matching record as NDJSON, one object per line, without
+        loading the result set into memory.
+        """
+
+        queryset = self.filter_queryset(self.get_queryset()).order_by(*self.get_keyset_ordering())
+        serializer = self.get_serializer()
+
+        def lines():
+            for record in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+                yield json.dumps(serializer.to_representation(record)) + "\n"
+
+        content = lines()
+        if isinstance(request._request, ASGIRequest):
+            # Under ASGI, Django reads a sync iterator whole (in a thread)
+            # before sending any of it; an async one is sent as it comes.
+            content = iterate_in_thread(content)
+
+        response = StreamingHttpResponse(content, content_type="application/x-ndjson")
+        response["Content-Disposition"] = 'attachment; filename="records.ndjson"'
+        return response
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        """
+        Import many records at once. The body is a JSON array, NDJSON
+        (application/x-ndjson) or a BIND zone file (text/dns, with an
+        optional ?origin= for relative names).
+        """
+
+        fmt = IMPORT_CONTENT_TYPES.get(request.content_type)
+        if fmt is None:
+            return Response(
+                {
+                    "status": "error",
+                    "message": "Content-Type must be one of "
+                    + ", ".join(IMPORT_CONTENT_TYPES),
+                },
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            )
+
+        if request.stream is None:
+            return Response(
+                {"status": "error", "message": "request body is empty"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        ignore_conflicts = request.query_params.get("on_conflict", "ignore") != "fail"
+
+        try:
+            rows = parse_records(request.stream, fmt, request.query_params.get("origin"))
+            result = import_records(rows, ignore_conflicts=ignore_conflicts)
+        except ImportFormatError as e:
+            return Response(
+                {"status": "error", "message": str(e)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        except IntegrityError:
+            return Response(
+                {"status": "error", "message": "import contains existing records"},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        return Response(
+            {"status": "success", "data": result},
+            status=status.HTTP_201_CREATED if result["created"] else status.HTTP_200_OK,
+        )